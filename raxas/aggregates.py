@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+def percentile(values, percent):
+    """This function returns a percentile of values, interpolating linearly
+       between the two closest ranks.
+
+    :param values: list of numbers
+    :param percent: percentile wanted, between 0 and 100
+    :returns: float
+    """
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def trimmed_mean(values, proportion=0.1):
+    """This function returns the mean of values without the lowest and the
+       highest proportion of them.
+
+    :param values: list of numbers
+    :param proportion: share of values cut from each end, below 0.5
+    :returns: float
+    """
+    ordered = sorted(values)
+    cut = int(len(ordered) * proportion)
+    return mean(ordered[cut:len(ordered) - cut] or ordered)
+
+
+def ewma(value, previous, alpha):
+    """This function returns the exponentially weighted moving average
+       after adding value.
+
+    :param value: newest value
+    :param previous: previous average, None if there is none
+    :param alpha: weight of the newest value, between 0 and 1
+    :returns: float
+    """
+    if previous is None:
+        return value
+    return alpha * value + (1 - alpha) * previous
+
+
+# aggregations selectable by name, taking the list of values to aggregate
+AGGREGATES = {
+    'mean': mean,
+    'max': max,
+    'p50': lambda values: percentile(values, 50),
+    'p90': lambda values: percentile(values, 90),
+    'p99': lambda values: percentile(values, 99),
+}
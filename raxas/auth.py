@@ -18,13 +18,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
+import contextlib
+import datetime
 import json
 import logging
 import os.path
 import pprint
 import pyrax
+import time
 import traceback
-from pyrax.exceptions import AuthenticationFailed
+from pyrax.exceptions import AuthenticationFailed, PyraxException
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# seconds before expiry at which a token is replaced instead of reused
+TOKEN_REFRESH_MARGIN = 600
+
+# seconds to wait for another process to replace the token
+TOKEN_LOCK_TIMEOUT = 60
 
 
 class Auth(object):
@@ -53,6 +68,10 @@ class Auth(object):
         self._token_filename = token_filename
         self._token = None
         self._tenant_id = None
+        self._tenant_name = None
+        self._expires = None
+        self._service_catalog = None
+        self._user = None
         logger.debug(self.__str__())
 
     def __str__(self, *args, **kwargs):
@@ -77,6 +96,20 @@ class Auth(object):
                 "tenant_id: %s" %
                 (pi.username, pi.api_key, pi.region, pi.token, pi.tenant_id))
 
+    @staticmethod
+    def is_authenticated():
+        """
+        This checks if pyrax holds a token which is not about to expire,
+        without making any API call
+
+        :returns: True or False (Boolean)
+        """
+        pi = pyrax.identity
+        if pi is None or not pi.authenticated or pi.expires is None:
+            return False
+        margin = datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+        return pi.expires - margin > datetime.datetime.utcnow()
+
     @property
     def token_filename(self):
         """
@@ -92,6 +125,43 @@ class Auth(object):
         authenticate with it, and if it fails then tries to authenticate
         with credentials
 
+        A token saved with its expiry and service catalog is reused without
+        any API call until it gets within TOKEN_REFRESH_MARGIN seconds of its
+        expiry, after which a new one is requested with the credentials.
+        Only one process at a time validates or replaces the token, others
+        wait for it and reuse the token it saved.
+
+        :returns: True or False (Boolean)
+        """
+        if self.reuse_token():
+            return True
+
+        with self.token_lock():
+            # the token may have been replaced while waiting for the lock
+            if self.reuse_token():
+                return True
+            return self.refresh_token()
+
+    def reuse_token(self):
+        """
+        This method loads a token from a file and uses it without any API
+        call if it is not about to expire
+
+        :returns: True or False (Boolean)
+        """
+        logger = logging.getLogger(__name__)
+        if self.load_token() and self.token_is_fresh() and self.restore_token():
+            logger.info('authenticated successfully')
+            logger.debug("reused token '%s' from file '%s'",
+                         self._token, self._token_filename)
+            return True
+        return False
+
+    def refresh_token(self):
+        """
+        This method validates the token from the file, unless it is about
+        to expire, and if it fails then tries to authenticate with credentials
+
         :returns: True or False (Boolean)
         """
         logger = logging.getLogger(__name__)
@@ -99,7 +169,10 @@ class Auth(object):
         if self.load_token():
             logger.debug("loaded token '%s' from file '%s'",
                          pprint.pformat(self._token), self._token_filename)
-            if self.authenticate_token():
+            if self._expires is not None and not self.token_is_fresh():
+                logger.debug("token '%s' from file '%s' is about to expire",
+                             self._token, self._token_filename)
+            elif self.authenticate_token():
                 logger.info('authenticated successfully')
                 logger.debug("authenticated with token '%s' from file '%s'",
                              self._token, self._token_filename)
@@ -120,6 +193,44 @@ class Auth(object):
                          self._username, self._apikey, self._region, self._identity_type)
             return False
 
+    @contextlib.contextmanager
+    def token_lock(self, timeout=TOKEN_LOCK_TIMEOUT):
+        """
+        This holds an exclusive lock on the token file while the token is
+        replaced. If the lock cannot be taken within timeout seconds, or
+        file locking is not available, the block runs without it.
+
+        :param timeout: seconds to wait for the lock
+        """
+        logger = logging.getLogger(__name__)
+
+        lock_file = None
+        if fcntl is not None:
+            try:
+                lock_file = open(self._token_filename + '.lock', 'a')
+            except IOError as error:
+                logger.warn("cannot open token lock file '%s.lock': %s",
+                            self._token_filename, error)
+
+        try:
+            if lock_file is not None:
+                deadline = time.time() + timeout
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except (IOError, OSError):
+                        if time.time() >= deadline:
+                            logger.warn("timed out waiting for lock on token file '%s'",
+                                        self._token_filename)
+                            break
+                        time.sleep(0.1)
+            yield
+        finally:
+            # closing the file releases the lock
+            if lock_file is not None:
+                lock_file.close()
+
     def authenticate_credentials(self):
         """
         This method try to authenticate with available credentials
@@ -139,8 +250,7 @@ class Auth(object):
                         self._username, self._apikey, self._region, self._identity_type)
             logger.debug("user authenticated: %s", pyrax.identity.authenticated)
             if pyrax.identity.authenticated:
-                self._token = pyrax.identity.auth_token
-                self._tenant_id = pyrax.identity.tenant_id
+                self.store_identity()
                 self.save_token()
             return pyrax.identity.authenticated
         except AuthenticationFailed:
@@ -159,6 +269,8 @@ class Auth(object):
             pyrax.auth_with_token(self._token, self._tenant_id, region=self._region)
             logging.info('authenticated with token:%s, tenant_id:%s, region:%s',
                          self._token, self._tenant_id, self._region)
+            self.store_identity()
+            self.save_token()
             return True
         except AuthenticationFailed:
             logging.info('cannot authenticate with token:%s, tenant_id:%s, region:%s',
@@ -166,6 +278,72 @@ class Auth(object):
             logger.debug(traceback.format_exc())
             return False
 
+    def token_is_fresh(self):
+        """
+        This checks if the loaded token can be reused without validating it,
+        which needs its expiry and service catalog
+
+        :returns: True or False (Boolean)
+        """
+        if None in (self._expires, self._service_catalog, self._user):
+            return False
+        return self._expires - TOKEN_REFRESH_MARGIN > time.time()
+
+    def restore_token(self):
+        """
+        This sets up pyrax with the loaded token and service catalog,
+        without calling the identity API
+
+        :returns: True or False (Boolean)
+        """
+        logger = logging.getLogger(__name__)
+        expires = datetime.datetime.utcfromtimestamp(self._expires)
+        access = {'access': {
+            'token': {'id': self._token,
+                      'tenant': {'id': self._tenant_id, 'name': self._tenant_name},
+                      'expires': expires.strftime('%Y-%m-%dT%H:%M:%S.000Z')},
+            'serviceCatalog': self._service_catalog,
+            'user': self._user}}
+
+        try:
+            pyrax.set_setting('identity_type', self._identity_type)
+            # pyrax has no public way to load a stored service catalog, so the
+            # identity is filled in the same way a token response would
+            pyrax._create_identity()
+            pyrax.identity._parse_response(access)
+            pyrax.identity.authenticated = True
+            pyrax.regions = tuple(pyrax.identity.regions)
+            pyrax.services = tuple(pyrax.identity.services.keys())
+            pyrax.connect_to_services(region=self._region)
+        except (KeyError, TypeError, AttributeError, PyraxException) as error:
+            logger.info('cannot reuse token:%s, tenant_id:%s, region:%s: %s',
+                        self._token, self._tenant_id, self._region, error)
+            logger.debug(traceback.format_exc())
+            return False
+
+        return True
+
+    def store_identity(self):
+        """
+        This copies the token, its expiry and the service catalog from pyrax,
+        so they can be saved to the token file
+        """
+        pi = pyrax.identity
+        self._token = pi.auth_token
+        self._tenant_id = pi.tenant_id
+        self._tenant_name = getattr(pi, 'tenant_name', None)
+        self._expires = None
+        if isinstance(pi.expires, datetime.datetime):
+            # pyrax keeps the expiry as a naive UTC datetime
+            self._expires = calendar.timegm(pi.expires.timetuple())
+        self._service_catalog = getattr(pi, 'service_catalog', None)
+        self._user = None
+        if isinstance(getattr(pi, 'user', None), dict):
+            self._user = dict(pi.user)
+            default_region = getattr(pi, '_default_region', None)
+            if default_region:
+                self._user['RAX-AUTH:defaultRegion'] = default_region
+
     def force_unauthenticate(self):
         """
         This unauthenticate and delete token file
@@ -204,6 +382,10 @@ class Auth(object):
         try:
             self._token = data['token']
             self._tenant_id = data['tenant_id']
+            self._tenant_name = data.get('tenant_name')
+            self._expires = data.get('expires')
+            self._service_catalog = data.get('service_catalog')
+            self._user = data.get('user')
             return True
         except KeyError as error:
             logger.error("cannot load token from data: '%s': %s", data, error)
@@ -217,14 +399,25 @@ class Auth(object):
         :returns: True or False (Boolean)
         """
         logger = logging.getLogger(__name__)
-        data = {'token': self._token, 'tenant_id': self._tenant_id}
+        data = {'token': self._token, 'tenant_id': self._tenant_id,
+                'tenant_name': self._tenant_name, 'expires': self._expires,
+                'service_catalog': self._service_catalog, 'user': self._user}
 
+        # written to a temporary file and renamed, so that other processes
+        # never read a partially written token file
+        tmp_filename = '%s.%d' % (self._token_filename, os.getpid())
         try:
-            with open(self._token_filename, 'w') as f:
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
                 json.dump(data, f)
+            os.rename(tmp_filename, self._token_filename)
             return True
-        except (TypeError, IOError) as error:
+        except (TypeError, IOError, OSError) as error:
             logger.error("cannot write data '%s' to file '%s': %s",
                          pprint.pformat(data), self._token_filename, error)
             logger.debug(traceback.format_exc())
+            try:
+                os.unlink(tmp_filename)
+            except OSError:
+                pass
             return False
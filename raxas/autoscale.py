@@ -20,67 +20,211 @@
 # limitations under the License.
 
 import argparse
-import logging.config
+import logging
 import socket
-from stevedore.named import NamedExtensionManager
+import threading
+import time
 
 from raxas import common
 from raxas.enums import *
-from raxas.colouredconsolehandler import ColouredConsoleHandler
-from raxas.auth import Auth
 from raxas.version import return_version
-from raxas.scaling_group import ScalingGroup
+from raxas.plugins import load_plugins
 
 
-# CHECK logging.conf
-logging_config = common.check_file('logging.conf')
+logger = logging.getLogger(__name__)
 
-if logging_config is None:
-    logging.handlers.ColouredConsoleHandler = ColouredConsoleHandler
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
 
-else:
+# seconds a plugin may spend in make_decision() before it counts as no data
+DEFAULT_PLUGIN_TIMEOUT = 30
 
-    logging_conf_file = logging_config
-    logging.handlers.ColouredConsoleHandler = ColouredConsoleHandler
-    logging.config.fileConfig(logging_conf_file)
-    logger = logging.getLogger(__name__)
+# when this node was last found to be a slave, per group
+SCHEDULE_CACHE = '.raxas-schedule.cache'
 
+# plugin objects whose make_decision() is running, possibly since a cycle
+# which stopped waiting for it
+_running_plugins = set()
+_running_plugins_lock = threading.Lock()
 
-def autoscale(group, config_data, args):
-    """This function executes scale up or scale down policy
+
+def get_scaling_group(group, config_data):
+    """This function builds the ScalingGroup object for a configured group
 
     :param group: group name
     :param config_data: json configuration data
-    :param args: user provided arguments
-    :returns: enums.ScaleEvent
+    :returns: raxas.scaling_group.ScalingGroup
     """
     try:
         group_config = config_data['autoscale_groups'][group]
     except KeyError:
-        return common.exit_with_error('Unable to get scaling group config for group: %s', group)
+        return common.exit_with_error('Unable to get scaling group config for group: %s' % group)
+
+    from raxas.scaling_group import ScalingGroup
+
+    return ScalingGroup(group_config, group)
+
+
+def slave_backoff(group, slave_interval):
+    """This function returns how long this node should still skip a group
+       it was found to be a slave of.
+
+    :param group: group name
+    :param slave_interval: seconds between runs on slave nodes
+    :returns: seconds left, 0 if the group is due
+    """
+    if not slave_interval:
+        return 0
+
+    slave_since = common.read_cache(SCHEDULE_CACHE).get(group, {}).get('slave_since')
+    if slave_since is None:
+        return 0
+    return max(0, slave_since + slave_interval - time.time())
+
+
+def record_node_status(group, status):
+    """This function remembers whether this node is a slave of a group,
+       for slave_backoff()
+
+    :param group: group name
+    :param status: enums.NodeStatus
+    """
+    if status == NodeStatus.Slave:
+        common.write_cache(SCHEDULE_CACHE, group, {'slave_since': time.time()})
+    elif group in common.read_cache(SCHEDULE_CACHE):
+        common.write_cache(SCHEDULE_CACHE, group, None)
+
+
+def cached_node_status(group, master_ttl):
+    """This function tells whether this node is a master of a group from
+       the master servers cached by ScalingGroup.is_master, without any API call.
+
+    A cached leader is only trusted until its lease expires.
+
+    :param group: group name
+    :param master_ttl: seconds the cached master servers are trusted
+    :returns: enums.NodeStatus, Unknown if there is no recent cache or the
+              server UUID is not cached
+    """
+    if not master_ttl:
+        return NodeStatus.Unknown
+
+    cached = common.read_cache(common.MASTERS_CACHE).get(group, {})
+    expires = min(cached.get('checked', 0) + master_ttl,
+                  cached.get('expires', float('inf')))
+    if expires < time.time():
+        return NodeStatus.Unknown
+
+    node_id = common.read_uuid_cache()
+    if node_id is None:
+        return NodeStatus.Unknown
+
+    if node_id in cached.get('masters', []):
+        return NodeStatus.Master
+    return NodeStatus.Slave
+
+
+def due_groups(groups, args):
+    """This function leaves out the groups this node was recently found to
+       be a slave of, either from the master servers cached within
+       --master-ttl seconds or when --slave-interval is used.
+
+    :param groups: list of group names
+    :param args: user provided arguments
+    :returns: list of group names
+    """
+    if not args.get('cluster'):
+        return groups
+
+    due = []
+    for group in groups:
+        backoff = slave_backoff(group, args.get('slave_interval'))
+        if cached_node_status(group, args.get('master_ttl')) == NodeStatus.Slave:
+            logger.info('Node is not a master of group %s according to the '
+                        'cached master servers, nothing to do', group)
+        elif backoff:
+            logger.info('Node is a slave of group %s, next check in %ds',
+                        group, backoff)
+        else:
+            due.append(group)
+    return due
+
+
+def make_decision(name, plugin):
+    """This function returns the decision of a plugin, unless the plugin is
+       still busy with a call which timed out in an earlier cycle.
+
+    Plugin objects are reused between daemon cycles and hold state, so a
+    call left running in the background must finish before the next one.
+
+    :param name: plugin name
+    :param plugin: plugin object
+    :returns: decision of the plugin or None if it was skipped
+    """
+    with _running_plugins_lock:
+        if plugin in _running_plugins:
+            logger.warning('Plugin %s is still running since an earlier cycle, skipping it',
+                           name)
+            return None
+        _running_plugins.add(plugin)
+
+    try:
+        return plugin.make_decision()
+    finally:
+        with _running_plugins_lock:
+            _running_plugins.discard(plugin)
+
+
+def autoscale(group, config_data, args, scaling_group=None, plugins=None,
+              deadline=None):
+    """This function executes scale up or scale down policy
 
-    scaling_group = ScalingGroup(group_config, group)
+    Once the deadline has passed, the remaining phases are skipped and
+    enums.ScaleEvent.NoAction is returned, unless the policy was already
+    executed.
+
+    :param group: group name
+    :param config_data: json configuration data
+    :param args: user provided arguments
+    :param scaling_group: raxas.scaling_group.ScalingGroup to reuse, built
+                          from config_data if not provided
+    :param plugins: dict of plugin name -> plugin object returned by
+                    load_plugins() to reuse, loaded again if not provided
+    :param deadline: common.Deadline of the run, no limit if not provided
+    :returns: enums.ScaleEvent
+    """
+    if scaling_group is None:
+        scaling_group = get_scaling_group(group, config_data)
+
+    if deadline is None:
+        deadline = common.Deadline(None)
 
     logger.info('Cluster Mode Enabled: %s', args.get('cluster', False))
 
     if args['cluster']:
-        if scaling_group.is_master in [NodeStatus.Slave, NodeStatus.Unknown]:
+        node_status = scaling_group.is_master
+        if args.get('slave_interval'):
+            record_node_status(group, node_status)
+        if node_status in [NodeStatus.Slave, NodeStatus.Unknown]:
             return ScaleEvent.NotMaster
+        if not deadline.check('master check'):
+            return ScaleEvent.NoAction
+
+    if plugins is None:
+        plugins = load_plugins(scaling_group)
+
+    names = sorted(plugins.keys())
+    timeouts = [deadline.timeout((scaling_group.plugin_config.get(name) or {}).get(
+                'timeout', DEFAULT_PLUGIN_TIMEOUT)) for name in names]
 
-    plugin_config = scaling_group.plugin_config
-    mgr = NamedExtensionManager(
-        namespace='raxas.ext',
-        names=plugin_config.keys(),
-        invoke_on_load=True,
-        invoke_args=(scaling_group,)
-        )
-    logger.info('Loaded plugins: %s' % mgr.names())
-
-    results = [result for result
-               in mgr.map_method('make_decision')
-               if result is not None]
+    # fetch the group state once here, rather than from every plugin thread
+    scaling_group.state
+
+    decisions = common.run_concurrently(
+        lambda name: make_decision(name, plugins[name]),
+        names, max_workers=len(names), timeouts=timeouts)
+    if not deadline.check('plugins'):
+        return ScaleEvent.NoAction
+
+    results = [result for result in decisions if result is not None]
     scaling_decision = sum(results)
     if scaling_decision <= -1:
         scaling_decision = -1
@@ -94,11 +238,23 @@ def autoscale(group, config_data, args):
 
     logger.info('Threshold reached - Scaling %s', scale.name)
     if not args['dry_run']:
-        scaling_group.execute_webhook(scale, HookType.Pre)
-
-        if scaling_group.execute_policy(scale) == ScaleEvent.Success:
-            scaling_group.execute_webhook(scale, HookType.Post)
+        if not scaling_group.holds_lease():
+            return ScaleEvent.NoAction
+
+        scaling_group.execute_webhook(scale, HookType.Pre,
+                                      timeout=deadline.remaining())
+        if not deadline.check('pre webhooks'):
+            return ScaleEvent.NoAction
+
+        policy_result = scaling_group.execute_policy(scale)
+        if policy_result == ScaleEvent.Success:
+            if deadline.check('policy'):
+                scaling_group.execute_webhook(scale, HookType.Post,
+                                              timeout=deadline.remaining())
+                deadline.check('post webhooks')
             return ScaleEvent.Success
+        elif policy_result == ScaleEvent.NoAction:
+            return ScaleEvent.NoAction
         else:
             return ScaleEvent.Error
     else:
@@ -106,6 +262,44 @@ def autoscale(group, config_data, args):
         return ScaleEvent.Success
 
 
+def autoscale_groups(scaling_groups, config_data, args, plugins=None,
+                     deadline=None):
+    """This function evaluates several groups concurrently, sharing the
+       current authenticated session
+
+    :param scaling_groups: dict of group name -> raxas.scaling_group.ScalingGroup
+    :param config_data: json configuration data
+    :param args: user provided arguments
+    :param plugins: dict of group name -> plugins returned by
+                    load_plugins(), loaded again if not provided
+    :param deadline: common.Deadline of the run, no limit if not provided
+    :returns: dict of group name -> enums.ScaleEvent
+    """
+    plugins = plugins or {}
+    deadline = deadline or common.Deadline(None)
+    groups = sorted(scaling_groups.keys())
+
+    results = common.run_concurrently(
+        lambda group: autoscale(group, config_data, args,
+                                scaling_group=scaling_groups[group],
+                                plugins=plugins.get(group),
+                                deadline=deadline),
+        groups, max_workers=args.get('max_workers', 4),
+        timeouts=deadline.timeout(None))
+    if None in results:
+        # groups still running or waiting for a worker when the deadline passed
+        deadline.check('groups')
+
+    summary = {}
+    for group, result in zip(groups, results):
+        if result is None:
+            result = ScaleEvent.NoAction if deadline.exhausted_phase else ScaleEvent.Error
+        summary[group] = result
+        logger.info('Group %s: %s', group, summary[group].name)
+
+    return summary
+
+
 def parse_args():
     """This function validates user arguments and data in configuration file.
 
@@ -131,17 +325,138 @@ def parse_args():
                         action='store_true',
                         help='Do not actually perform any scaling operations '
                              'or call webhooks')
+    parser.add_argument('--daemon', required=False, default=False,
+                        action='store_true',
+                        help='Keep running and evaluate the group every '
+                             '--interval seconds instead of exiting')
+    parser.add_argument('--interval', required=False, default=60, type=int,
+                        help='Seconds between evaluations in --daemon mode '
+                             '(default: 60)')
+    parser.add_argument('--all-groups', required=False, default=False,
+                        action='store_true',
+                        help='Evaluate every group in the config file '
+                             'instead of a single one')
+    parser.add_argument('--jitter', required=False, default=0, type=int,
+                        help='Wait up to this many seconds before a run, '
+                             'always the same delay on a given server '
+                             '(default: 0)')
+    parser.add_argument('--slave-interval', required=False, default=0,
+                        type=int,
+                        help='With --cluster, seconds to wait before checking '
+                             'a group again once this node was found to be '
+                             'one of its slaves (default: 0, every run)')
+    parser.add_argument('--master-ttl', required=False, default=300, type=int,
+                        help='With --cluster, seconds the master servers of '
+                             'a group are remembered, so slave nodes exit '
+                             'without any API call (default: 300, 0 to '
+                             'check every run)')
+    parser.add_argument('--deadline', required=False, default=50, type=int,
+                        help='Seconds a run may take before the remaining '
+                             'steps are skipped, 0 for no limit (default: 50)')
+    parser.add_argument('--lock-file', required=False,
+                        help='File locked while a run is in progress, so '
+                             'runs of the same groups never overlap '
+                             '(default: %s in %s, named after the config '
+                             'file and the groups)'
+                             % (common.RUN_LOCK_FILE % '<hash>', common.CACHE_DIR))
+    parser.add_argument('--max-workers', required=False, default=4, type=int,
+                        help='Maximum number of groups evaluated at the same '
+                             'time with --all-groups (default: 4)')
     args = vars(parser.parse_args())
 
     return args
 
 
+def run_daemon(groups, config_data, args, session):
+    """This function evaluates groups every args['interval'] seconds until
+       the process is stopped.
+
+    The scaling group objects, the plugin objects and the pyrax connections are
+    kept between cycles; only the group state is fetched again each time and
+    authentication only happens when the token has expired. A plugin still
+    busy with a call which timed out in an earlier cycle is skipped. The
+    leases held by this node are given up when the loop stops.
+
+    :param groups: list of group names
+    :param config_data: json configuration data
+    :param args: user provided arguments
+    :param session: authenticated raxas.auth.Auth object
+    """
+    interval = max(1, args['interval'])
+    scaling_groups = dict((group, get_scaling_group(group, config_data))
+                          for group in groups)
+    plugins = dict((group, load_plugins(scaling_group))
+                   for group, scaling_group in scaling_groups.items())
+
+    logger.info('Running in daemon mode, interval: %ss', interval)
+    try:
+        while True:
+            started = time.time()
+            due = dict((group, scaling_groups[group])
+                       for group in due_groups(sorted(scaling_groups.keys()), args))
+
+            if not args['dry_run']:
+                drain_outboxes(sorted(scaling_groups.keys()), config_data,
+                               common.Deadline(interval, started=started))
+
+            if not due:
+                logger.info('No group to evaluate in this cycle')
+            elif not session.is_authenticated() and not session.authenticate():
+                logger.error('Authentication failed, retrying in %ss', interval)
+            else:
+                for scaling_group in due.values():
+                    scaling_group.refresh()
+
+                deadline = common.Deadline(min(args['deadline'] or interval, interval),
+                                           started=started)
+                autoscale_groups(due, config_data, args, plugins, deadline)
+                logger.info('Cycle finished in %.2fs', time.time() - started)
+
+            time.sleep(max(0, interval - (time.time() - started)))
+    finally:
+        release_leases(scaling_groups)
+
+
+def drain_outboxes(groups, config_data, deadline=None):
+    """This function sends the webhooks left in the outboxes of the groups
+       by earlier runs, from a background thread.
+
+    :param groups: list of group names
+    :param config_data: json configuration data
+    :param deadline: common.Deadline of the flush, no limit if not provided
+    :returns: threading.Thread flushing the outboxes
+    """
+    from raxas import outbox
+    from raxas import webhooks
+
+    outboxes = {}
+    for group in groups:
+        options = webhooks.get_options(
+            config_data['autoscale_groups'].get(group, {}).get('webhook_options'))
+        group_outbox = outbox.get_outbox(options)
+        if group_outbox is not None and group_outbox.path not in outboxes:
+            outboxes[group_outbox.path] = (group_outbox, options)
+
+    return outbox.drain_async(outboxes.values(), deadline=deadline)
+
+
+def release_leases(scaling_groups):
+    """This function gives up the leases held by this node, so other nodes
+       take over straight away when the daemon stops.
+
+    :param scaling_groups: dict of group name -> raxas.scaling_group.ScalingGroup
+    """
+    for scaling_group in scaling_groups.values():
+        scaling_group.release_lease()
+
+
 def main():
     """This function calls auth class for authentication and autoscale to
        execute scaling policy
 
     """
     args = parse_args()
+    common.setup_logging()
     logger.info(return_version())
     for arg in args:
         logger.debug('argument provided by user ' + arg + ' : ' +
@@ -158,33 +473,95 @@ def main():
         common.exit_with_error('Failed to read config file: ' + config_file)
 
     as_group = args.get('as_group')
-    if not as_group:
-        if len(config_data['autoscale_groups'].keys()) == 1:
-            as_group = config_data['autoscale_groups'].keys()[0]
-        else:
-            logger.debug("Getting system hostname")
-            hostname = socket.gethostname()
-            as_group = hostname.rsplit('-', 1)[0]
-
-    username = common.get_auth_value(args, config_data, 'os_username')
-    api_key = common.get_auth_value(args, config_data, 'os_password')
-    region = common.get_auth_value(args, config_data, 'os_region_name')
-    if None in (username, api_key, region):
-        common.exit_with_error('Authentication credentials not set')
-    region = region.upper()
-
-    session = Auth(username, api_key, region)
-    if not session.authenticate():
-        common.exit_with_error('Authentication failed')
-
-    scale_result = autoscale(as_group, config_data, args)
-    if scale_result == ScaleEvent.Error:
-        common.exit_with_error(None)
+    if args['all_groups']:
+        groups = sorted(config_data['autoscale_groups'].keys())
     else:
-        log_name = None
-        if hasattr(logger.root.handlers[0], 'baseFilename'):
-            log_name = ': ' % logger.root.handlers[0].baseFilename
-        logger.info('completed successfully %s', (log_name if log_name else ''))
+        if not as_group:
+            if len(config_data['autoscale_groups'].keys()) == 1:
+                as_group = config_data['autoscale_groups'].keys()[0]
+            else:
+                logger.debug("Getting system hostname")
+                hostname = socket.gethostname()
+                as_group = hostname.rsplit('-', 1)[0]
+        groups = [as_group]
+
+    # kept open, and so locked, until the run is over
+    run_lock = common.acquire_run_lock(
+        args['lock_file'] or common.get_run_lock_path(config_file, groups))
+    if not run_lock:
+        logger.info('Skipping this run')
+        return
+
+    jitter = common.get_jitter(args['jitter'])
+    if jitter:
+        logger.info('Waiting %.2fs before starting', jitter)
+        time.sleep(jitter)
+    deadline = common.Deadline(args['deadline'])
+
+    drain_thread = None
+    try:
+        # the daemon drains the outboxes and checks which groups are due on
+        # every cycle instead
+        if not args['daemon']:
+            # webhooks which earlier runs could not deliver, also when this node
+            # is no longer a master and stops below
+            if not args['dry_run']:
+                drain_thread = drain_outboxes(groups, config_data, deadline)
+
+            groups = due_groups(groups, args)
+            if not groups:
+                logger.info('No group to evaluate in this run')
+                return
+
+        username = common.get_auth_value(args, config_data, 'os_username')
+        api_key = common.get_auth_value(args, config_data, 'os_password')
+        region = common.get_auth_value(args, config_data, 'os_region_name')
+        if None in (username, api_key, region):
+            common.exit_with_error('Authentication credentials not set')
+        region = region.upper()
+
+        from raxas.auth import Auth
+
+        session = Auth(username, api_key, region)
+        if not session.authenticate():
+            common.exit_with_error('Authentication failed')
+
+        if args['daemon']:
+            try:
+                run_daemon(groups, config_data, args, session)
+            except KeyboardInterrupt:
+                logger.info('Stopping daemon')
+            return
+
+        if args['all_groups']:
+            scaling_groups = dict((group, get_scaling_group(group, config_data))
+                                  for group in groups)
+            summary = autoscale_groups(scaling_groups, config_data, args,
+                                       deadline=deadline)
+            scale_result = (ScaleEvent.Error if ScaleEvent.Error in summary.values()
+                            else ScaleEvent.Success)
+        elif deadline.check('authentication'):
+            scale_result = autoscale(as_group, config_data, args, deadline=deadline)
+        else:
+            scale_result = ScaleEvent.NoAction
+        if deadline.exhausted_phase is not None:
+            logger.warning('Run ran out of its %ss budget in phase: %s',
+                           args['deadline'], deadline.exhausted_phase)
+        if scale_result == ScaleEvent.Error:
+            common.exit_with_error(None)
+        else:
+            log_name = None
+            if hasattr(logger.root.handlers[0], 'baseFilename'):
+                log_name = ': ' % logger.root.handlers[0].baseFilename
+            logger.info('completed successfully %s', (log_name if log_name else ''))
+    finally:
+        # the next run can start as soon as the lock is released, it must
+        # not flush the same outboxes at the same time as this one
+        if drain_thread is not None:
+            drain_thread.join(deadline.remaining())
+        # closing the file releases the lock
+        if run_lock is not True:
+            run_lock.close()
 
 
 if __name__ == '__main__':
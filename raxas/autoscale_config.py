@@ -18,29 +18,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pyrax
 import argparse
-from pyrax.exceptions import NoSuchContainer, NoSuchObject
-import logging.config
+import logging
 from raxas import common
-from raxas.colouredconsolehandler import ColouredConsoleHandler
-from raxas.auth import Auth
 from raxas.version import return_version
 
-# CHECK logging.conf
-logging_config = common.check_file('logging.conf')
-
-if logging_config is None:
-    logging.handlers.ColouredConsoleHandler = ColouredConsoleHandler
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-
-else:
-
-    logging_conf_file = logging_config
-    logging.handlers.ColouredConsoleHandler = ColouredConsoleHandler
-    logging.config.fileConfig(logging_conf_file)
-    logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 
 def parse_args():
@@ -78,6 +61,8 @@ def download_config_private(config_data, args):
     :param args: passed in arguments
 
     """
+    import pyrax
+    from pyrax.exceptions import NoSuchContainer, NoSuchObject
 
     cf = pyrax.cloudfiles
 
@@ -105,6 +90,7 @@ def main():
 
     """
     args = parse_args()
+    common.setup_logging()
 
     # CONFIG.ini
     config_file = common.check_file(args['config_file'])
@@ -133,6 +119,8 @@ def main():
     if region is None:
         common.exit_with_error('No os_region_name defined.')
 
+    from raxas.auth import Auth
+
     session = Auth(username, api_key, region)
 
     if session.authenticate() is True:
@@ -20,12 +20,45 @@
 
 from __future__ import print_function
 import os
-import pyrax
 import sys
 import json
 import logging
+import threading
+import time
+import traceback
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from uuid import UUID
-import netifaces
+
+# directory for caches which should not survive a reboot
+CACHE_DIR = '/dev/shm'
+
+# held by the running autoscale process, so runs of the same groups never
+# overlap, formatted with a hash of the configuration file and the groups
+RUN_LOCK_FILE = '.raxas-autoscale-%s.lock'
+
+# master servers of each group, as last seen by this server
+MASTERS_CACHE = '.raxas-masters.cache'
+
+# directory for data which must survive a reboot
+DATA_DIR = '/var/lib/rax-autoscaler'
+
+# server UUID keyed by the server's MAC addresses, kept across reboots
+PERSISTENT_UUID_CACHE = os.path.join(DATA_DIR, 'uuid.json')
+
+# metadata written to the config drive if the server was spun up with
+# config_drive set to True
+METADATA_FILES = ['/mnt/config/openstack/latest/meta_data.json',
+                  '/media/configdrive/openstack/latest/meta_data.json']
+
+_cache_lock = threading.Lock()
+
+# seconds Cloud server objects are kept in the server index
+SERVER_INDEX_TTL = 60
+
+# server id -> (expiry time, novaclient server object)
+_server_index = {}
+_server_index_lock = threading.Lock()
 
 
 def get_logger():
@@ -38,6 +71,24 @@ def get_logger():
     return logger
 
 
+def setup_logging():
+    """This function configures logging from logging.conf if one can be found,
+       otherwise messages are logged to the console.
+
+    """
+    import logging.config
+    import logging.handlers
+    from raxas.colouredconsolehandler import ColouredConsoleHandler
+
+    logging.handlers.ColouredConsoleHandler = ColouredConsoleHandler
+
+    logging_config = check_file('logging.conf')
+    if logging_config is None:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.config.fileConfig(logging_config)
+
+
 def check_file(fname):
     """This function checks if file exists and is readable.
 
@@ -128,18 +179,264 @@ def write_uuid_cache(uuid):
         logger.error('unable to write uuid cache file: %s', error.args)
 
 
+def read_cache(name):
+    """This function reads a json cache file from CACHE_DIR.
+
+    :param name: cache file name
+    :returns: dict, empty if the cache is missing or unreadable
+    """
+    logger = get_logger()
+
+    if sys.platform.startswith(('win32', 'cygwin')):
+        return {}
+
+    try:
+        with open(os.path.join(CACHE_DIR, name), 'r') as cache_file:
+            data = json.load(cache_file)
+    except (IOError, ValueError) as error:
+        logger.debug('unable to read cache %s: %s', name, error)
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+
+def write_cache(name, key, value):
+    """This function stores a value in a json cache file in CACHE_DIR.
+
+    The cache is updated while holding an exclusive lock on a sibling .lock
+    file, so autoscale processes updating other keys of the same cache do not
+    undo each other's changes. The file is written to a temporary file first
+    and renamed, so concurrent readers never see a partially written cache.
+
+    :param name: cache file name
+    :param key: key to update
+    :param value: json serializable value, None removes the key
+    """
+    logger = get_logger()
+
+    if sys.platform.startswith(('win32', 'cygwin')):
+        return
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    path = os.path.join(CACHE_DIR, name)
+    with _cache_lock:
+        lock_file = None
+        try:
+            if fcntl is not None:
+                try:
+                    lock_file = open('%s.lock' % path, 'a')
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                except (IOError, OSError) as error:
+                    logger.warning('unable to lock cache %s: %s', path, error)
+
+            data = read_cache(name)
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+            tmp_path = '%s.%d' % (path, os.getpid())
+            try:
+                with open(tmp_path, 'w') as cache_file:
+                    json.dump(data, cache_file)
+                os.rename(tmp_path, path)
+            except (IOError, OSError, TypeError) as error:
+                logger.error('unable to write cache %s: %s', path, error)
+        finally:
+            # closing the file releases the lock
+            if lock_file is not None:
+                lock_file.close()
+
+
+def get_local_addresses():
+    """This function returns the addresses of this server's network interfaces.
+
+    :returns: tuple of (list of IPv4 addresses, sorted list of MAC addresses),
+              loopback addresses are left out
+    """
+    import netifaces
+
+    local_ips = []
+    macs = set()
+    for interface in netifaces.interfaces():  # pylint: disable=E1101
+        addresses = netifaces.ifaddresses(interface)  # pylint: disable=E1101
+        for ip in addresses.get(netifaces.AF_INET, []):  # pylint: disable=E1101
+            if ip.get('addr') and not ip['addr'].startswith('127.'):
+                local_ips.append(ip['addr'])
+        for link in addresses.get(netifaces.AF_LINK, []):  # pylint: disable=E1101
+            if link.get('addr') and link['addr'] != '00:00:00:00:00:00':
+                macs.add(link['addr'].lower())
+
+    return local_ips, sorted(macs)
+
+
+def read_metadata_uuid():
+    """This function reads the server UUID from the config drive metadata.
+
+    :returns: UUID as a string or None if no metadata could be found
+    """
+    logger = get_logger()
+
+    for file_path in METADATA_FILES:
+        try:
+            with open(file_path, 'r') as metadata_file:
+                return str(UUID(json.load(metadata_file)['uuid']))
+        except (IOError, OSError):
+            continue
+        except (ValueError, KeyError, TypeError) as error:
+            logger.info('invalid metadata found in %s : %s', file_path, error)
+
+    return None
+
+
+def read_persistent_uuid(macs):
+    """This function reads the server UUID stored for a set of MAC addresses.
+
+    A server built from an image of this server has other MAC addresses, so
+    it never picks up this server's UUID.
+
+    :param macs: sorted list of MAC addresses
+    :returns: UUID as a string or None if none was stored
+    """
+    if not macs or sys.platform.startswith(('win32', 'cygwin')):
+        return None
+
+    try:
+        with open(PERSISTENT_UUID_CACHE, 'r') as cache_file:
+            data = json.load(cache_file)
+        return str(UUID(data[','.join(macs)]))
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def write_persistent_uuid(macs, uuid):
+    """This function stores the server UUID for a set of MAC addresses, in a
+       file which survives a reboot.
+
+    :param macs: sorted list of MAC addresses
+    :param uuid: server UUID
+    """
+    logger = get_logger()
+
+    if not macs or sys.platform.startswith(('win32', 'cygwin')):
+        return
+
+    try:
+        directory = os.path.dirname(PERSISTENT_UUID_CACHE)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%d' % (PERSISTENT_UUID_CACHE, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            # only the current MAC addresses are kept, an older entry would
+            # belong to the image this server was built from
+            json.dump({','.join(macs): uuid}, cache_file)
+        os.rename(tmp_path, PERSISTENT_UUID_CACHE)
+    except (IOError, OSError) as error:
+        logger.info('unable to write uuid cache %s: %s',
+                    PERSISTENT_UUID_CACHE, error)
+
+
+def server_has_ips(server, local_ips):
+    """This function checks if a server has any of the local IP addresses.
+
+    :param server: novaclient server object
+    :param local_ips: list of IP addresses
+    :returns: True or False (Boolean)
+    """
+    server_ips = [ip for network in server.networks.values() for ip in network]
+    return len(set(server_ips).intersection(local_ips)) > 0
+
+
+def find_server_by_ips(servers_api, active_servers, local_ips):
+    """This function finds the active server with any of the local IP
+       addresses using a single filtered list request.
+
+    :param servers_api: novaclient servers manager
+    :param active_servers: list of server UUIDs in the scaling group
+    :param local_ips: list of IP addresses
+    :returns: UUID as a string or None if no server matched
+    """
+    import re
+
+    logger = get_logger()
+
+    if not local_ips:
+        return None
+
+    ip_filter = '^(%s)$' % '|'.join(re.escape(ip) for ip in local_ips)
+    try:
+        servers = servers_api.list(search_opts={'ip': ip_filter})
+    except Exception as error:
+        logger.info('unable to list servers by ip address: %s', error)
+        return None
+
+    index_servers(servers)
+
+    active_servers = set(active_servers)
+    for server in servers:
+        # the filter is only a hint, some deployments ignore it
+        if server.id in active_servers and server_has_ips(server, local_ips):
+            return server.id
+
+    return None
+
+
+def find_server_concurrently(active_servers, local_ips, max_workers=8):
+    """This function gets the details of the active servers on a pool of
+       threads and returns as soon as one has any of the local IP addresses.
+
+    :param active_servers: list of server UUIDs in the scaling group
+    :param local_ips: list of IP addresses
+    :param max_workers: maximum number of requests running at the same time
+    :returns: UUID as a string or None if no server matched
+    """
+    if not active_servers or not local_ips:
+        return None
+
+    found = threading.Event()
+
+    def check(server_id):
+        if found.is_set():
+            return None
+        server = get_server(server_id)
+        if server is None:
+            return None
+        return server.id if server_has_ips(server, local_ips) else None
+
+    pool = ThreadPool(processes=max(1, min(max_workers, len(active_servers))))
+    try:
+        for server_id in pool.imap_unordered(check, active_servers):
+            if server_id is not None:
+                found.set()
+                return server_id
+    finally:
+        # no join: requests still running are left to finish on their own
+        # and the ones not started yet return straight away
+        pool.close()
+
+    return None
+
+
 def get_machine_uuid(scaling_group):
     """This function will search for the server's UUID and return it.
 
-    First it searches in a rax-autoscaler cache, followed by cloud-init cache.
-    If it cannot find a cached UUID, it will get the details of each server in
-    the scaling group in turn and attempt to match the local IP address with
-    that of the server object returned from the API
+    First it searches in a rax-autoscaler cache, followed by cloud-init cache,
+    the config drive metadata and the UUID stored for this server's MAC
+    addresses. If none of them has the UUID, it lists the servers with the
+    local IP addresses in a single request, then falls back to getting the
+    details of the servers in the scaling group concurrently until one has
+    a local IP address.
 
     :param scaling_group: raxas.scaling_group.ScalingGroup object
     :return: None if no UUID could be matched against a cache file or the API.
              UUID as a string
     """
+    import pyrax
+
     logger = get_logger()
 
     uuid = read_uuid_cache()
@@ -147,30 +444,35 @@ def get_machine_uuid(scaling_group):
         logger.info('found server UUID from cache: %s', uuid)
         return uuid
 
-    # if we didn't get anything from any cache files, we'll loop through the
-    # servers in the scaling group, get the server details and cross check the
-    # ip addresses against what's on *this* server
+    uuid = read_metadata_uuid()
+    if uuid is not None:
+        logger.info('found server UUID from metadata: %s', uuid)
+        write_uuid_cache(uuid)
+        return uuid
 
-    local_ips = []
-    for interface in netifaces.interfaces():  # pylint: disable=E1101
-        try:
-            for ip in netifaces.ifaddresses(interface)[netifaces.AF_INET]:  # pylint: disable=E1101
-                if ip['addr'] != '127.0.0.1':
-                    local_ips.append(ip['addr'])
-        except KeyError:
-            continue
+    local_ips, macs = get_local_addresses()
 
-    servers_api = pyrax.cloudservers
-    for active_uuid in scaling_group.active_servers:
-        server = servers_api.servers.get(active_uuid)
+    uuid = read_persistent_uuid(macs)
+    if uuid is not None:
+        logger.info('found server UUID from %s: %s', PERSISTENT_UUID_CACHE, uuid)
+        write_uuid_cache(uuid)
+        return uuid
 
-        server_ips = [ip for network in server.networks.values()
-                      for ip in network]
-        matching_ips = set(server_ips).intersection(local_ips)
-        if len(matching_ips) > 0:
-            logger.info('found uuid from matching ip address: %s', server.id)
-            write_uuid_cache(server.id)
-            return server.id
+    # if we didn't get anything from any cache files, we'll ask the API for
+    # the server in the scaling group with the ip addresses of *this* server
+
+    servers_api = pyrax.cloudservers.servers
+    active_servers = scaling_group.active_servers
+
+    uuid = find_server_by_ips(servers_api, active_servers, local_ips)
+    if uuid is None:
+        uuid = find_server_concurrently(active_servers, local_ips)
+
+    if uuid is not None:
+        logger.info('found uuid from matching ip address: %s', uuid)
+        write_uuid_cache(uuid)
+        write_persistent_uuid(macs, uuid)
+        return uuid
 
     # only reached if we couldn't read from the cache file and couldn't find
     # this server's ip address in the scaling group's active server list
@@ -227,17 +529,234 @@ def exit_with_error(msg):
     sys.exit(1)
 
 
-def get_server(server_id):
-    """ It gets Cloud server object by server_id
+def index_servers(servers, ttl=SERVER_INDEX_TTL):
+    """This function adds Cloud server objects to the server index, so
+       get_server() returns them without calling the API.
 
+    :param servers: list of novaclient server objects
+    :param ttl: seconds the servers are kept in the index
     """
-    cs = pyrax.cloudservers
+    expires = time.time() + ttl
+    with _server_index_lock:
+        for server in servers:
+            _server_index[server.id] = (expires, server)
+
+
+def get_server(server_id, ttl=SERVER_INDEX_TTL):
+    """This function returns the Cloud server object with the given id.
+
+    Servers are kept in an index shared by every caller in this process, so
+    repeated lookups within ttl seconds do not call the API again.
+
+    :param server_id: server UUID
+    :param ttl: seconds the server is kept in the index, 0 always calls the API
+    :returns: novaclient server object or None if there is no such server
+    """
+    import pyrax
+
+    logger = get_logger()
+
+    with _server_index_lock:
+        expires, server = _server_index.get(server_id, (0, None))
+    if expires > time.time():
+        return server
+
     try:
-        return [s for s in cs.list() if s.id == server_id]
-    except:
-        logging.info('no cloud server with id: %s', server_id)
+        server = pyrax.cloudservers.servers.get(server_id)
+    except Exception as error:
+        logger.info('no cloud server with id: %s (%s)', server_id, error)
         return None
 
+    index_servers([server], ttl)
+    return server
+
+
+def run_concurrently(func, items, max_workers=4, timeouts=None):
+    """This function calls func once for every item on a bounded pool of threads.
+
+    Calls which do not finish in time are not interrupted, they carry on in
+    the background after this function returns. Callers reusing objects
+    between calls must not start a new call on an object still in use.
+
+    :param func: function taking a single item as argument
+    :param items: list of items
+    :param max_workers: maximum number of threads running at the same time
+    :param timeouts: seconds to wait for each call, counted from the moment
+                     the calls are submitted. Either a single value or a list
+                     in the same order as items, None waits indefinitely.
+    :returns: list of results in the same order as items. None is returned
+              for calls which raised an exception or did not finish in time.
+    """
+    logger = get_logger()
+
+    if not items:
+        return []
+
+    if not isinstance(timeouts, (list, tuple)):
+        timeouts = [timeouts] * len(items)
+
+    def call(item):
+        try:
+            return func(item)
+        except Exception as error:
+            logger.error('Call for %s failed: %s', item, error)
+            logger.debug(traceback.format_exc())
+            return None
+
+    pool = ThreadPool(processes=max(1, min(max_workers, len(items))))
+    started = time.time()
+    pending = [pool.apply_async(call, (item,)) for item in items]
+    # no join: workers stuck on a call which timed out must not block us
+    pool.close()
+
+    results = []
+    for item, result, timeout in zip(items, pending, timeouts):
+        try:
+            if timeout is None:
+                results.append(result.get())
+            else:
+                results.append(result.get(max(0, started + timeout - time.time())))
+        except TimeoutError:
+            logger.error('Call for %s did not finish within %ss', item, timeout)
+            results.append(None)
+
+    return results
+
+
+def get_jitter(max_jitter):
+    """This function returns how long this server should wait before a run,
+       so that servers started by the same cron entry do not all call the
+       APIs at the same second.
+
+    The delay is derived from the server UUID, or the hostname if the UUID
+    is not cached, so every server keeps the same offset between runs.
+
+    :param max_jitter: maximum delay in seconds
+    :returns: delay in seconds, between 0 and max_jitter
+    """
+    import hashlib
+    import socket
+
+    if not max_jitter or max_jitter <= 0:
+        return 0
+
+    key = read_uuid_cache() or socket.gethostname()
+    digest = int(hashlib.sha1(str(key).encode('utf-8')).hexdigest(), 16)
+    return (digest % 1000) * max_jitter / 1000.0
+
+
+def get_run_lock_path(config_file, groups):
+    """This function returns the default lock file of a run.
+
+    Runs of other groups, or with another configuration file, use another
+    lock file and so never wait for each other.
+
+    :param config_file: configuration file name
+    :param groups: list of group names evaluated by the run
+    :returns: lock file name in CACHE_DIR
+    """
+    import hashlib
+
+    key = '\n'.join([os.path.abspath(config_file)] + sorted(groups))
+    return os.path.join(CACHE_DIR, RUN_LOCK_FILE %
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def acquire_run_lock(path):
+    """This function takes an exclusive lock on a file without waiting, so only
+       one autoscale process uses it at a time. The lock is held until the
+       returned file is closed or the process exits.
+
+    If the lock file cannot be opened or file locking is not available, the
+    run carries on without the lock.
+
+    :param path: lock file name
+    :returns: lock file object or True if the lock is held by this process,
+              False if another process holds it
+    """
+    logger = get_logger()
+
+    try:
+        import fcntl
+    except ImportError:
+        logger.debug('file locking is not available, running without lock')
+        return True
+
+    try:
+        lock_file = open(path, 'a+')
+    except IOError as error:
+        logger.warning('unable to open lock file %s: %s', path, error)
+        return True
+
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_file.seek(0)
+        logger.warning('another run (pid %s) is still in progress',
+                       lock_file.read().strip() or 'unknown')
+        lock_file.close()
+        return False
+
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write('%d\n' % os.getpid())
+    lock_file.flush()
+    return lock_file
+
+
+class Deadline(object):
+    """Time budget of a run, split in phases.
+
+    The deadline is checked at the end of every phase, the first phase found
+    to have ended after the deadline is remembered in exhausted_phase.
+    """
+
+    def __init__(self, seconds, started=None):
+        """
+        :param seconds: time budget in seconds, None or 0 for no limit
+        :param started: unix time the run started, now if not provided
+        """
+        self.seconds = seconds
+        self.started = time.time() if started is None else started
+        self.exhausted_phase = None
+
+    def remaining(self):
+        """This function returns the seconds left before the deadline.
+
+        :returns: float or None if there is no limit
+        """
+        if not self.seconds:
+            return None
+        return max(0, self.started + self.seconds - time.time())
+
+    def timeout(self, timeout):
+        """This function limits a timeout to the time left before the deadline.
+
+        :param timeout: timeout in seconds or None
+        :returns: timeout in seconds or None if there is no limit
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def check(self, phase):
+        """This function checks the deadline at the end of a phase.
+
+        :param phase: name of the phase which just ended
+        :returns: True if the run may carry on, False once the deadline passed
+        """
+        if self.remaining() != 0:
+            return True
+
+        if self.exhausted_phase is None:
+            self.exhausted_phase = phase
+        get_logger().warning('Run did not finish %s within its %ss budget',
+                             phase, self.seconds)
+        return False
+
 
 def is_ipv4(address):
     """It checks if address is valid IP v4
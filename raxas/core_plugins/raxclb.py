@@ -18,12 +18,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import calendar
 import pyrax
+import time
+from raxas import common
 from raxas.core_plugins.base import PluginBase
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 from pyrax.exceptions import NotFound
 
+# usage records of every load balancer, per load balancer and connection type
+USAGE_CACHE = '.raxas-clb-usage.cache'
+
+
+def parse_usage_time(value):
+    """This function converts the time of a usage record, such as
+       2014-08-21T16:00:00-05:00 or 2014-08-21T16:00:00Z, to a unix timestamp
+
+    :param value: time string
+    :returns: int
+    """
+    value = value.strip()
+    offset = 0
+    if value.endswith('Z'):
+        value = value[:-1]
+    elif len(value) > 6 and value[-6] in '+-' and value[-3] == ':':
+        sign = 1 if value[-6] == '+' else -1
+        offset = sign * (int(value[-5:-3]) * 3600 + int(value[-2:]) * 60)
+        value = value[:-6]
+    parsed = datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(parsed.timetuple()) - offset
+
 
 class Raxclb(PluginBase):
     """ Rackspace cloud load balancer plugin.
@@ -40,8 +65,12 @@ class Raxclb(PluginBase):
         self.scale_down_threshold = config.get('scale_down_threshold', 1)
         self.check_type = config.get('check_type', '')
         self.lb_ids = config.get('loadbalancers', [])
+        self.lb_ids_ttl = config.get('lb_ids_ttl', 300)
+        self.max_concurrency = int(config.get('max_concurrency', 4))
         self.check_time = 2
         self.scaling_group = scaling_group
+        self._group_lb_ids = None
+        self._group_lb_ids_expiry = 0
 
     @property
     def name(self):
@@ -56,32 +85,16 @@ class Raxclb(PluginBase):
                  -1    scale down
                   None No data available
         """
-
-        logger = logging.getLogger(__name__)
-
         clb = pyrax.cloud_loadbalancers
 
-        if not self.lb_ids:
-            launch_config = self.scaling_group.launch_config
-            if launch_config is None:
-                return None
-
-            try:
-                self.lb_ids = [lb.get('loadBalancerId') for lb
-                               in launch_config.get('load_balancers')]
-            except TypeError:
-                logger.error('No loadbalancer found, please either define a '
-                             'loadbalancer to check or add one to the scaling group.')
-                return None
-
-        start_time = datetime.utcnow() - timedelta(hours=int(self.check_time))
-
-        results = []
+        lb_ids = self.get_lb_ids()
+        if not lb_ids:
+            return None
 
         active_server_count = self.scaling_group.state['active_capacity']
 
-        self.scale_up_threshold = self.scale_up_threshold * active_server_count
-        self.scale_down_threshold = self.scale_down_threshold * active_server_count
+        scale_up_threshold = self.scale_up_threshold * active_server_count
+        scale_down_threshold = self.scale_down_threshold * active_server_count
 
         if self.check_type.upper() == 'SSL':
             hist_check = 'averageNumConnectionsSsl'
@@ -91,36 +104,135 @@ class Raxclb(PluginBase):
             hist_check = 'averageNumConnections'
             cur_check = 'currentConn'
 
-        for lb in self.lb_ids:
-            try:
-                check_clb = clb.get(lb)
-            except NotFound:
-                logger.error('Loadbalancer specified does not exist')
-                return None
-
-            usage = check_clb.get_usage(start=start_time)
-            current_usage = check_clb.get_stats()
-
-            records = []
-
-            for record in usage.get('loadBalancerUsageRecords'):
-                records.append(record.get(hist_check))
-
-            try:
-                current_conn = current_usage.get(cur_check)
-                average_historical = sum(records) / len(records)
-                average = ((current_conn * 1.5) + average_historical) / 2
-            except ZeroDivisionError:
-                average = current_usage.get(cur_check)
-
-            if average > self.scale_up_threshold:
-                results.append(1)
-                logger.info("Raxclb reports scale up for lb %s", lb)
-            elif average < self.scale_down_threshold:
-                results.append(-1)
-                logger.info("Raxclb reports scale down for lb %s", lb)
-            else:
-                results.append(0)
-                logger.info("Raxclb reports normal for lb %s", lb)
+        results = common.run_concurrently(
+            lambda lb: self.get_lb_decision(clb, lb, hist_check, cur_check,
+                                            scale_up_threshold, scale_down_threshold),
+            lb_ids, max_workers=self.max_concurrency)
+        results = [result for result in results if result is not None]
+
+        if not results:
+            return None
 
         return sum(results)
+
+    def get_lb_ids(self):
+        """This function returns the load balancers to check, either the
+           configured ones or the ones in the scaling group launch config.
+
+        Load balancers taken from the launch config are remembered for
+        lb_ids_ttl seconds, so a plugin kept between runs does not request the
+        launch config every time.
+
+        :returns: list of load balancer ids or None
+        """
+        logger = logging.getLogger(__name__)
+
+        if self.lb_ids:
+            return self.lb_ids
+
+        if self._group_lb_ids is not None and time.time() < self._group_lb_ids_expiry:
+            return self._group_lb_ids
+
+        launch_config = self.scaling_group.launch_config
+        if launch_config is None:
+            return None
+
+        try:
+            lb_ids = [lb.get('loadBalancerId') for lb
+                      in launch_config.get('load_balancers')]
+        except TypeError:
+            logger.error('No loadbalancer found, please either define a '
+                         'loadbalancer to check or add one to the scaling group.')
+            return None
+
+        self._group_lb_ids = lb_ids
+        self._group_lb_ids_expiry = time.time() + self.lb_ids_ttl
+        return lb_ids
+
+    def get_lb_decision(self, clb, lb, hist_check, cur_check,
+                        scale_up_threshold, scale_down_threshold):
+        """This function decides to scale up or scale down for one load balancer
+
+        :param clb: pyrax cloud load balancers client
+        :param lb: load balancer id
+        :param hist_check: usage record field to average
+        :param cur_check: stats field holding the current connection count
+        :param scale_up_threshold: connection count for the whole group
+                                   above which to scale up
+        :param scale_down_threshold: connection count for the whole group
+                                     below which to scale down
+        :returns: 1    scale up
+                  0    do nothing
+                 -1    scale down
+                  None No data available
+        """
+        logger = logging.getLogger(__name__)
+
+        try:
+            check_clb = clb.get(lb)
+        except NotFound:
+            logger.error('Loadbalancer %s does not exist', lb)
+            return None
+
+        average_historical = self.get_usage_average(check_clb, lb, hist_check)
+        current_usage = check_clb.get_stats()
+
+        current_conn = current_usage.get(cur_check)
+        if average_historical is None:
+            average = current_conn
+        else:
+            average = ((current_conn * 1.5) + average_historical) / 2
+
+        if average > scale_up_threshold:
+            logger.info("Raxclb reports scale up for lb %s", lb)
+            return 1
+        elif average < scale_down_threshold:
+            logger.info("Raxclb reports scale down for lb %s", lb)
+            return -1
+        else:
+            logger.info("Raxclb reports normal for lb %s", lb)
+            return 0
+
+    def get_usage_average(self, loadbalancer, lb_id, hist_check):
+        """This function returns the average connection count of the usage
+           records of the last check_time hours.
+
+        Records are kept between runs, so only the newest stored record, which
+        is the one still being updated, and any later ones are requested. The
+        sum of the stored values is updated as records are added, updated
+        and dropped.
+
+        :param loadbalancer: pyrax load balancer
+        :param lb_id: load balancer id
+        :param hist_check: usage record field to average
+        :returns: float or None if there are no records
+        """
+        window_start = time.time() - int(self.check_time) * 3600
+        key = '%s:%s' % (lb_id, hist_check)
+        cached = common.read_cache(USAGE_CACHE).get(key, {})
+        records = cached.get('records', {})
+        total = cached.get('sum', 0.0)
+
+        start = max([window_start] + [started for started, _ in records.values()])
+        usage = loadbalancer.get_usage(start=datetime.utcfromtimestamp(start))
+
+        for record in usage.get('loadBalancerUsageRecords') or []:
+            value = record.get(hist_check)
+            if value is None:
+                continue
+            record_id = str(record.get('id', record['startTime']))
+            if record_id in records:
+                total -= records[record_id][1]
+            records[record_id] = [parse_usage_time(record['startTime']), value]
+            total += value
+
+        for record_id, (started, value) in list(records.items()):
+            if started < window_start:
+                total -= value
+                del records[record_id]
+
+        common.write_cache(USAGE_CACHE, key, {'records': records, 'sum': total})
+
+        if not records:
+            return None
+        return float(total) / len(records)
@@ -19,11 +19,164 @@
 # limitations under the License.
 
 import logging
+import math
 import random
 import time
+from array import array
 import pyrax
+from pyrax.cloudmonitoring import CloudMonitorCheck, CloudMonitorEntity
+from pyrax.exceptions import NotFound
+from raxas import aggregates
+from raxas import common
 from raxas.core_plugins.base import PluginBase
 
+# entities returned per page of the monitoring overview view
+OVERVIEW_PAGE_LIMIT = 1000
+
+# entity ids filtered on per request to the overview view
+OVERVIEW_ENTITY_FILTER_LIMIT = 100
+
+# entity and check ids of the scaling check, per group and check
+CHECK_CACHE = '.raxas-checks.cache'
+
+# agent id -> entity id of the servers in each group
+ENTITY_INDEX_CACHE = '.raxas-entities.cache'
+
+# recent data points of every check, per group and check
+METRIC_CACHE = '.raxas-metrics.cache'
+
+# cluster statistics carried over between runs, per group and check
+STATS_CACHE = '.raxas-stats.cache'
+
+# seconds after which a stored moving average is too old to carry on
+EWMA_MAX_AGE = 900
+
+# seconds of data looked back at when nothing newer is stored
+METRIC_LOOKBACK = 300
+
+# smallest interval between data points of a check, in seconds
+METRIC_PERIOD = 30
+
+# servers sampled before the first confidence interval is computed, one
+# batch with the default max_concurrency
+ADAPTIVE_MIN_SAMPLES = 5
+
+# two sided z-scores of the supported confidence levels
+Z_SCORES = {0.8: 1.282, 0.9: 1.645, 0.95: 1.960, 0.98: 2.326, 0.99: 2.576}
+
+# degrees of freedom of T_QUANTILES, z-scores are used above the last one
+T_DEGREES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 15, 20, 30]
+
+# two sided Student-t quantiles of the supported confidence levels
+T_QUANTILES = {
+    0.8: [3.078, 1.886, 1.638, 1.533, 1.476, 1.440, 1.415,
+          1.397, 1.383, 1.372, 1.356, 1.341, 1.325, 1.310],
+    0.9: [6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895,
+          1.860, 1.833, 1.812, 1.782, 1.753, 1.725, 1.697],
+    0.95: [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365,
+           2.306, 2.262, 2.228, 2.179, 2.131, 2.086, 2.042],
+    0.98: [31.821, 6.965, 4.541, 3.747, 3.365, 3.143, 2.998,
+           2.896, 2.821, 2.764, 2.681, 2.602, 2.528, 2.457],
+    0.99: [63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499,
+           3.355, 3.250, 3.169, 3.055, 2.947, 2.845, 2.750],
+}
+
+
+def t_quantile(confidence, degrees):
+    """This function returns the two sided Student-t quantile of a confidence
+       level.
+
+    Between two tabulated degrees of freedom the smaller one is used, which
+    only widens the interval.
+
+    :param confidence: one of the confidence levels of Z_SCORES
+    :param degrees: degrees of freedom, at least 1
+    :returns: float
+    """
+    if degrees > T_DEGREES[-1]:
+        return Z_SCORES[confidence]
+
+    quantile = None
+    for table_degrees, value in zip(T_DEGREES, T_QUANTILES[confidence]):
+        if table_degrees <= degrees:
+            quantile = value
+    return quantile
+
+
+def confidence_interval(values, population, quantile, min_stddev=0.0):
+    """This function returns the confidence interval of the mean of a population
+       estimated from a sample of it.
+
+    The finite population correction is applied, so the interval shrinks to
+    the sample mean once every member of the population has been sampled.
+
+    :param values: list of sampled values, at least 2
+    :param population: size of the population the values were drawn from
+    :param quantile: Student-t quantile of the wanted confidence level
+    :param min_stddev: smallest standard deviation assumed for the population
+    :returns: (low, high) tuple
+    """
+    count = len(values)
+    mean = sum(values) / count
+    variance = sum((value - mean) ** 2 for value in values) / (count - 1)
+    variance = max(variance, min_stddev ** 2)
+    margin = quantile * math.sqrt(variance / count)
+    if population > 1:
+        margin *= math.sqrt(max(0.0, float(population - count) / (population - 1)))
+    return mean - margin, mean + margin
+
+
+class MetricWindow(object):
+    """Bounded buffer of the most recent data points of a check.
+
+    Timestamps and values are kept in two arrays of doubles, oldest first.
+    """
+
+    def __init__(self, size, timestamps=None, values=None):
+        self._size = max(1, size)
+        self._timestamps = array('d', timestamps or [])
+        self._values = array('d', values or [])
+        self._trim()
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def last_timestamp(self):
+        return self._timestamps[-1] if self._timestamps else None
+
+    def add(self, timestamp, value):
+        """This function adds a data point, points not newer than the last
+           stored one are ignored
+
+        :param timestamp: unix timestamp in seconds
+        :param value: float
+        """
+        if self._timestamps and timestamp <= self._timestamps[-1]:
+            return
+        self._timestamps.append(timestamp)
+        self._values.append(value)
+        self._trim()
+
+    def values(self, since):
+        """This function returns the values of the points not older than since
+
+        :param since: unix timestamp in seconds
+        :returns: list of floats, oldest first
+        """
+        return [value for timestamp, value in zip(self._timestamps, self._values)
+                if timestamp >= since]
+
+    def to_dict(self):
+        return {'timestamps': self._timestamps.tolist(),
+                'values': self._values.tolist()}
+
+    def _trim(self):
+        excess = len(self._values) - self._size
+        if excess > 0:
+            del self._timestamps[:excess]
+            del self._values[:excess]
+
 
 class Raxmon(PluginBase):
     """ Rackspace cloud monitoring plugin.
@@ -41,8 +194,26 @@ class Raxmon(PluginBase):
         self.metric_name = config.get('metric_name', '1m')
         self.check_type = config.get('check_type', 'agent.load_average')
         self.max_samples = config.get('max_samples', 10)
+        self.max_concurrency = config.get('max_concurrency', 5)
+        self.entity_index_ttl = config.get('entity_index_ttl', 3600)
+        self.window = config.get('window', 0)
+        self.windows = {}
+        self.sampling = config.get('sampling', 'fixed')
+        self.confidence = config.get('confidence', 0.95)
+        self.min_stddev = config.get('min_stddev')
+        self.aggregate = config.get('aggregate', 'mean')
+        self.trim = config.get('trim', 0.1)
+        self.ewma_alpha = config.get('ewma_alpha', 0.3)
         self.scaling_group = scaling_group
 
+        # the stopping rule of adaptive sampling bounds the mean only, it says
+        # nothing about a maximum or percentile of a handful of servers
+        if self.sampling == 'adaptive' and self.aggregate != 'mean':
+            logging.getLogger(__name__).warning(
+                'Adaptive sampling only supports the mean aggregate, '
+                'using fixed sampling for %s', self.aggregate)
+            self.sampling = 'fixed'
+
     @property
     def name(self):
         return 'raxmon'
@@ -59,48 +230,54 @@ class Raxmon(PluginBase):
         logger = logging.getLogger(__name__)
 
         results = []
-        cm = pyrax.cloud_monitoring
         active_servers = self.scaling_group.active_servers
 
-        entities = [entity for entity in cm.list_entities()
-                    if entity.agent_id in active_servers]
+        entities = self.read_check_cache()
+        if entities is None:
+            entities = self.get_entities(active_servers)
 
-        self.add_entity_checks(entities)
+            self.add_entity_checks(entities)
+            self.write_check_cache(entities)
 
         logger.info('Gathering Monitoring Data')
 
+        self.windows = self.read_metric_windows()
+
         # Shuffle entities so the sample uses different servers
         entities = random.sample(entities, len(entities))
+        check_ids = [check.id for _, checks in entities for check in checks
+                     if check.type == self.check_type]
 
-        for ent in entities:
-            ent_checks = ent.list_checks()
-            for check in ent_checks:
-                if check.type == self.check_type:
-                    data = check.get_metric_data_points(self.metric_name,
-                                                        int(time.time())-300,
-                                                        int(time.time()),
-                                                        points=2)
-                    if len(data) > 0:
-                        point = len(data)-1
-                        logger.info('Found metric for: %s, value: %s',
-                                    ent.name, str(data[point]['average']))
-                        results.append(float(data[point]['average']))
-                        break
+        population = len(entities)
+
+        # Fetch in batches no larger than needed, so no more API calls are
+        # made than needed to reach the wanted number of samples
+        while entities and not self.enough_samples(results, population):
+            batch = entities[:self.next_batch_size(results)]
+            entities = entities[len(batch):]
+            results.extend([value for value
+                            in common.run_concurrently(
+                                lambda pair: self.get_entity_metric(*pair),
+                                batch, max_workers=self.max_concurrency)
+                            if value is not None])
+
+        # Restrict number of data points to save on API calls
+        if self.sampling == 'adaptive':
+            logger.info('Sampled %s of %s servers', len(results), population)
+        elif len(results) >= self.max_samples:
+            logger.info('max_samples value of %s reached, not gathering any more statistics',
+                        self.max_samples)
 
-            # Restrict number of data points to save on API calls
-            if len(results) >= self.max_samples:
-                logger.info('max_samples value of %s reached, not gathering any more statistics',
-                            self.max_samples)
-                break
+        self.write_metric_windows(check_ids)
 
         if len(results) == 0:
             logger.error('No data available')
             return None
         else:
-            average = sum(results)/len(results)
+            average = self.aggregate_results(results)
 
-        logger.info('Cluster average for %s (%s) at: %s',
-                    self.check_type, self.metric_name, str(average))
+        logger.info('Cluster %s for %s (%s) at: %s',
+                    self.aggregate, self.check_type, self.metric_name, str(average))
 
         if average > self.scale_up_threshold:
             logger.info("Raxmon reports scale up.")
@@ -112,28 +289,378 @@ class Raxmon(PluginBase):
             logger.info('Cluster within target parameters')
             return 0
 
+    def aggregate_results(self, results):
+        """This function reduces the values sampled from the servers to the
+           single value compared with the thresholds.
+
+        The aggregate config option selects mean, max, p50, p90, p99,
+        trimmed_mean (without the 'trim' share of values at each end) or ewma
+        (the mean, smoothed across runs with weight 'ewma_alpha').
+
+        :param results: list of sampled values
+        :returns: float
+        """
+        logger = logging.getLogger(__name__)
+
+        if self.aggregate == 'trimmed_mean':
+            return aggregates.trimmed_mean(results, self.trim)
+
+        if self.aggregate == 'ewma':
+            stats = common.read_cache(STATS_CACHE).get(self.check_cache_key, {})
+            previous = None
+            if time.time() - stats.get('timestamp', 0) < EWMA_MAX_AGE:
+                previous = stats.get('ewma')
+            value = aggregates.ewma(aggregates.mean(results), previous, self.ewma_alpha)
+            common.write_cache(STATS_CACHE, self.check_cache_key,
+                               {'ewma': value, 'timestamp': time.time()})
+            return value
+
+        try:
+            return aggregates.AGGREGATES[self.aggregate](results)
+        except KeyError:
+            logger.warning('Unknown aggregate %s, using mean', self.aggregate)
+            return aggregates.mean(results)
+
+    def enough_samples(self, results, population):
+        """This function decides if enough servers have been sampled.
+
+        With fixed sampling max_samples servers are sampled. With adaptive
+        sampling servers are added until the confidence interval of the
+        cluster mean lies entirely above scale_up_threshold, below
+        scale_down_threshold or between the two, or until max_samples
+        servers have been sampled. The interval uses Student-t quantiles and
+        a standard deviation of at least spread_floor.
+
+        :param results: values sampled so far
+        :param population: number of servers which can be sampled
+        :returns: True or False (Boolean)
+        """
+        logger = logging.getLogger(__name__)
+
+        if self.sampling != 'adaptive' or len(results) >= self.max_samples:
+            return len(results) >= self.max_samples
+
+        if len(results) < min(ADAPTIVE_MIN_SAMPLES, population):
+            return False
+        if len(results) < 2:
+            return True
+
+        confidence = self.confidence
+        if confidence not in Z_SCORES:
+            logger.warning('Unsupported confidence %s, using 0.95', confidence)
+            confidence = 0.95
+
+        low, high = confidence_interval(
+            results, population, t_quantile(confidence, len(results) - 1),
+            min_stddev=self.spread_floor)
+        logger.debug('Confidence interval of the mean after %s samples: %s - %s',
+                     len(results), low, high)
+        return (low > self.scale_up_threshold or
+                high < self.scale_down_threshold or
+                (low >= self.scale_down_threshold and high <= self.scale_up_threshold))
+
+    def next_batch_size(self, results):
+        """This function returns how many servers to sample next
+
+        :param results: values sampled so far
+        :returns: int
+        """
+        remaining = self.max_samples - len(results)
+        if self.sampling != 'adaptive':
+            return remaining
+        if len(results) < ADAPTIVE_MIN_SAMPLES:
+            return min(ADAPTIVE_MIN_SAMPLES - len(results), remaining)
+        return min(self.max_concurrency, remaining)
+
+    @property
+    def spread_floor(self):
+        """Smallest standard deviation assumed for the sampled metric, so a few
+        servers reporting the same value do not stop the sampling. Set by
+        min_stddev, a quarter of the band between the thresholds by default.
+        """
+        if self.min_stddev is not None:
+            return self.min_stddev
+        return max(0.0, self.scale_up_threshold - self.scale_down_threshold) / 4
+
+    @property
+    def check_cache_key(self):
+        return '%s:%s:%s' % (self.scaling_group.group_uuid,
+                             self.check_type, self.metric_name)
+
+    @property
+    def window_size(self):
+        """Number of data points kept for each check"""
+        return max(self.window, METRIC_LOOKBACK) // METRIC_PERIOD + 1
+
+    @staticmethod
+    def build_entity(info):
+        """This function builds a pyrax entity object from its API data,
+           without making any API call
+        """
+        cm = pyrax.cloud_monitoring
+        return CloudMonitorEntity(cm._entity_manager, info, loaded=True)
+
+    @staticmethod
+    def build_check(entity, info):
+        """This function builds a pyrax check object from its API data,
+           without making any API call
+        """
+        return CloudMonitorCheck(entity._check_manager, info,
+                                 entity=entity, loaded=True)
+
+    def read_check_cache(self):
+        """This function returns the entities and scaling checks of the active
+           servers from the check cache.
+
+        The cache is only used if it was written for the current set of
+        active servers.
+
+        :returns: list of (entity, checks) tuples or None if not cached
+        """
+        logger = logging.getLogger(__name__)
+
+        cached = common.read_cache(CHECK_CACHE).get(self.check_cache_key)
+        if cached is None:
+            return None
+
+        if cached.get('active_servers') != sorted(self.scaling_group.active_servers):
+            logger.info('Active servers changed, ignoring cached checks')
+            return None
+
+        entities = []
+        for agent_id, ids in cached.get('entities', {}).items():
+            entity = self.build_entity({'id': ids['entity_id'],
+                                        'label': ids['label'],
+                                        'agent_id': agent_id})
+            check = self.build_check(entity, {'id': ids['check_id'],
+                                              'type': self.check_type})
+            entities.append((entity, [check]))
+
+        logger.info('Using cached monitoring checks')
+        return entities
+
+    def write_check_cache(self, entities):
+        """This function caches the entity and check ids of the active servers.
+
+        Nothing is cached unless every active server has the scaling check,
+        so a server without one is looked up again on the next run.
+
+        :param entities: list of (entity, checks) tuples
+        """
+        cached = {}
+        for entity, checks in entities:
+            for check in checks:
+                if check.type == self.check_type:
+                    cached[entity.agent_id] = {'entity_id': entity.id,
+                                               'label': getattr(entity, 'label', None),
+                                               'check_id': check.id}
+                    break
+
+        active_servers = sorted(self.scaling_group.active_servers)
+        if sorted(cached.keys()) != active_servers:
+            return
+
+        common.write_cache(CHECK_CACHE, self.check_cache_key,
+                           {'active_servers': active_servers,
+                            'entities': cached})
+
+    def get_entities(self, active_servers):
+        """This function returns the monitoring entities of the active servers
+           together with their checks.
+
+        The entity ids of the group's servers are indexed by agent id, and
+        only those entities are requested. The monitoring API cannot look
+        entities up by agent id, so servers missing from the index are
+        searched for in a scan of the account and added to the index. Servers
+        found without an entity are remembered too, so they are not searched
+        for again until the index is older than entity_index_ttl, when it is
+        rebuilt from scratch.
+
+        :param active_servers: list of server ids
+        :returns: list of (entity, checks) tuples
+        """
+        logger = logging.getLogger(__name__)
+
+        now = time.time()
+        active_servers = set(active_servers)
+        index = common.read_cache(ENTITY_INDEX_CACHE).get(self.scaling_group.group_uuid, {})
+
+        if now - index.get('timestamp', 0) < self.entity_index_ttl:
+            timestamp = index['timestamp']
+            entity_ids = index.get('entities', {})
+            no_entity = set(index.get('no_entity', []))
+        else:
+            logger.info('Refreshing monitoring entity index')
+            timestamp = now
+            entity_ids = {}
+            no_entity = set()
+
+        entities = []
+        known = [agent_id for agent_id in active_servers if agent_id in entity_ids]
+        if known:
+            entities.extend(self.get_overview(entity_ids=[entity_ids[agent_id]
+                                                          for agent_id in known]))
+
+        unknown = active_servers - set(entity_ids) - no_entity
+        if unknown:
+            logger.info('Looking up monitoring entities of %d servers', len(unknown))
+            found = self.get_overview(agent_ids=unknown)
+            entities.extend(found)
+            entity_ids.update((entity.agent_id, entity.id) for entity, _ in found)
+            no_entity.update(unknown - set(entity_ids))
+
+            common.write_cache(ENTITY_INDEX_CACHE, self.scaling_group.group_uuid,
+                               {'timestamp': timestamp,
+                                'entities': dict((agent_id, entity_id) for agent_id, entity_id
+                                                 in entity_ids.items()
+                                                 if agent_id in active_servers),
+                                'no_entity': sorted(no_entity & active_servers)})
+        return entities
+
+    def get_overview(self, entity_ids=None, agent_ids=None):
+        """This function returns monitoring entities together with their checks.
+
+        Everything comes from the paginated overview view, which saves
+        listing the checks of each entity separately.
+
+        :param entity_ids: only request these entities, all entities of the
+                           account are requested if None
+        :param agent_ids: set of agent ids, only entities of these agents
+                          are kept if not None
+        :returns: list of (entity, checks) tuples
+        """
+        if entity_ids is None:
+            return self._get_overview_pages('', agent_ids)
+
+        overview = []
+        for start in range(0, len(entity_ids), OVERVIEW_ENTITY_FILTER_LIMIT):
+            chunk = entity_ids[start:start + OVERVIEW_ENTITY_FILTER_LIMIT]
+            overview.extend(self._get_overview_pages(
+                ''.join('&entityId=%s' % entity_id for entity_id in chunk),
+                agent_ids))
+        return overview
+
+    def _get_overview_pages(self, query, agent_ids):
+        cm = pyrax.cloud_monitoring
+        overview = []
+        marker = None
+
+        while True:
+            uri = '/views/overview?limit=%d%s' % (OVERVIEW_PAGE_LIMIT, query)
+            if marker is not None:
+                uri += '&marker=%s' % marker
+            _, body = cm.method_get(uri)
+
+            for value in body.get('values', []):
+                if agent_ids is not None and value['entity'].get('agent_id') not in agent_ids:
+                    continue
+                entity = self.build_entity(value['entity'])
+                checks = [self.build_check(entity, check)
+                          for check in value.get('checks', [])]
+                overview.append((entity, checks))
+
+            marker = body.get('metadata', {}).get('next_marker')
+            if marker is None:
+                return overview
+
+    def read_metric_windows(self):
+        """This function loads the data points stored by previous runs
+
+        :returns: dict of check id -> MetricWindow
+        """
+        cached = common.read_cache(METRIC_CACHE).get(self.check_cache_key, {})
+        return dict((check_id, MetricWindow(self.window_size, points.get('timestamps'),
+                                            points.get('values')))
+                    for check_id, points in cached.items())
+
+    def write_metric_windows(self, check_ids):
+        """This function stores the data points of the given checks for the
+           next run, points of any other check are dropped
+
+        :param check_ids: ids of the checks of the active servers
+        """
+        common.write_cache(METRIC_CACHE, self.check_cache_key,
+                           dict((check_id, self.windows[check_id].to_dict())
+                                for check_id in check_ids
+                                if check_id in self.windows))
+
+    def get_entity_metric(self, entity, checks):
+        """This function returns the value of the configured metric for an entity
+
+        Only data points newer than the ones stored by previous runs are
+        requested. The value is the average of the points of the last
+        'window' seconds, or the latest point of the last 5 minutes if no
+        window is configured.
+
+        :param entity: pyrax cloud monitoring entity
+        :param checks: checks of the entity
+        :returns: float or None if no data is available
+        """
+        logger = logging.getLogger(__name__)
+
+        for check in checks:
+            if check.type == self.check_type:
+                now = int(time.time())
+                window = self.windows.get(check.id) or MetricWindow(self.window_size)
+                start = now - max(self.window, METRIC_LOOKBACK)
+                if window.last_timestamp is not None:
+                    start = max(start, int(window.last_timestamp) + 1)
+
+                try:
+                    data = check.get_metric_data_points(self.metric_name,
+                                                        start, now,
+                                                        resolution='FULL')
+                except NotFound:
+                    logger.warning('Check %s not found on entity %s, clearing check cache',
+                                   check.id, entity.id)
+                    common.write_cache(CHECK_CACHE, self.check_cache_key, None)
+                    continue
+
+                for point in data:
+                    window.add(point['timestamp'] / 1000.0, float(point['average']))
+                self.windows[check.id] = window
+
+                if self.window:
+                    values = window.values(now - self.window)
+                    if values:
+                        value = sum(values) / len(values)
+                        logger.info('Found %d points for: %s, average: %s',
+                                    len(values), entity.name, str(value))
+                        return value
+                else:
+                    values = window.values(now - METRIC_LOOKBACK)
+                    if values:
+                        logger.info('Found metric for: %s, value: %s',
+                                    entity.name, str(values[-1]))
+                        return values[-1]
+
+        return None
+
     def add_entity_checks(self, entities):
         """This function ensures each entity has a cloud monitoring check.
            If the specific check in the json configuration data already exists, it will take
            no action on that entity
 
+        :param entities: list of (entity, checks) tuples
         """
         logger = logging.getLogger(__name__)
 
         logger.info('Ensuring monitoring checks exist')
 
-        for entity in entities:
-            check_exists = len([c for c in entity.list_checks()
+        for entity, checks in entities:
+            check_exists = len([c for c in checks
                                 if c.type == self.check_type])
 
             if not check_exists:
                 ip_address = entity.ip_addresses.values()[0]
                 logger.debug('server_id: %s, ip_address: %s', entity.agent_id, ip_address)
-                entity.create_check(label='%s_%s' % (self.metric_name, self.check_type),
-                                    check_type=self.check_type,
-                                    details=self.check_config,
-                                    period=60, timeout=30,
-                                    target_alias=ip_address)
+                check = entity.create_check(label='%s_%s' % (self.metric_name, self.check_type),
+                                            check_type=self.check_type,
+                                            details=self.check_config,
+                                            period=60, timeout=30,
+                                            target_alias=ip_address)
+                if check is not None:
+                    checks.append(check)
                 logger.info('ADD - Cloud monitoring check (%s) to server with id: %s',
                             self.check_type, entity.agent_id)
             else:
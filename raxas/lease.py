@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import collections
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from raxas import common
+
+# seconds a leader keeps its lease without renewing it
+DEFAULT_LEASE_TTL = 180
+
+DEFAULT_LEASE_PATH = os.path.join(common.CACHE_DIR, '.raxas-leases')
+
+# holder: id of the node holding the lease
+# token: fencing token, increased every time the lease changes hands
+# expires: unix time the lease expires unless renewed
+Lease = collections.namedtuple('Lease', ['holder', 'token', 'expires'])
+
+
+class LeaseError(Exception):
+    """The lease backend could not be read or updated."""
+
+
+class LeaseBackend(object):
+    """ All lease backends must inherit from this base class.
+
+    A backend stores one lease per name and must be shared by every node
+    taking part in the election. Backends only implement get() and update(),
+    the election itself is built on top of them.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get(self, name):
+        """This function returns the stored lease.
+
+        :param name: lease name
+        :returns: Lease or None if there is none
+        :raises: LeaseError
+        """
+
+    @abc.abstractmethod
+    def update(self, name, func):
+        """This function replaces the stored lease with func(stored lease),
+           atomically with respect to every other node.
+
+        :param name: lease name
+        :param func: function taking a Lease or None and returning a Lease
+        :returns: the new Lease
+        :raises: LeaseError
+        """
+
+    def acquire(self, name, holder, ttl=DEFAULT_LEASE_TTL):
+        """This function takes the lease if it is free or expired, or renews
+           it if holder already holds it.
+
+        :param name: lease name
+        :param holder: id of the node asking for the lease
+        :param ttl: seconds the lease is valid for
+        :returns: Lease if holder holds the lease, None if another node does
+        """
+        now = time.time()
+
+        def take(lease):
+            if lease is None:
+                return Lease(holder, 1, now + ttl)
+            if lease.holder == holder and lease.expires >= now:
+                return Lease(holder, lease.token, now + ttl)
+            if lease.expires < now:
+                return Lease(holder, lease.token + 1, now + ttl)
+            return lease
+
+        lease = self.update(name, take)
+        return lease if lease.holder == holder else None
+
+    def release(self, name, lease):
+        """This function gives up a lease, so another node can take it
+           straight away.
+
+        :param name: lease name
+        :param lease: Lease returned by acquire()
+        """
+        def give_up(current):
+            if current is not None and current[:2] == lease[:2]:
+                return Lease(current.holder, current.token, 0)
+            return current or Lease(lease.holder, lease.token, 0)
+
+        self.update(name, give_up)
+
+    def is_valid(self, name, lease):
+        """This function checks that a lease is still held, with the same
+           fencing token, and has not expired.
+
+        :param name: lease name
+        :param lease: Lease returned by acquire()
+        :returns: True or False (Boolean)
+        """
+        current = self.get(name)
+        return (current is not None and current[:2] == lease[:2] and
+                current.expires >= time.time())
+
+
+class FileLeaseBackend(LeaseBackend):
+    """Leases stored in a json file, locked with flock while updated.
+
+    Only nodes which share the file, for example on a network file system
+    with working locks, take part in the same election.
+    """
+
+    def __init__(self, path=DEFAULT_LEASE_PATH):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as lease_file:
+                data = json.load(lease_file)
+        except IOError:
+            return {}
+        except ValueError as error:
+            raise LeaseError('invalid lease file %s: %s' % (self.path, error))
+        return data if isinstance(data, dict) else {}
+
+    def get(self, name):
+        data = self._read().get(name)
+        return Lease(*data) if data else None
+
+    def update(self, name, func):
+        try:
+            with open(self.path + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                data = self._read()
+                lease = func(Lease(*data[name]) if data.get(name) else None)
+                data[name] = list(lease)
+
+                tmp_path = '%s.%d' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as lease_file:
+                    json.dump(data, lease_file)
+                os.rename(tmp_path, self.path)
+        except (IOError, OSError) as error:
+            raise LeaseError('unable to update lease file %s: %s' % (self.path, error))
+
+        return lease
+
+
+class SqliteLeaseBackend(LeaseBackend):
+    """Leases stored in an SQLite database.
+
+    Only nodes which share the database file take part in the same election.
+    """
+
+    def __init__(self, path=DEFAULT_LEASE_PATH + '.db'):
+        self.path = path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS leases ('
+                           'name TEXT PRIMARY KEY, holder TEXT NOT NULL, '
+                           'token INTEGER NOT NULL, expires REAL NOT NULL)')
+        return connection
+
+    @staticmethod
+    def _select(connection, name):
+        row = connection.execute('SELECT holder, token, expires FROM leases '
+                                 'WHERE name = ?', (name,)).fetchone()
+        return Lease(*row) if row else None
+
+    def get(self, name):
+        try:
+            connection = self._connect()
+            try:
+                return self._select(connection, name)
+            finally:
+                connection.close()
+        except sqlite3.Error as error:
+            raise LeaseError('unable to read lease database %s: %s' % (self.path, error))
+
+    def update(self, name, func):
+        try:
+            connection = self._connect()
+            try:
+                # takes the write lock straight away, so no other node can
+                # read the lease before it is updated
+                connection.execute('BEGIN IMMEDIATE')
+                lease = func(self._select(connection, name))
+                connection.execute('INSERT OR REPLACE INTO leases '
+                                   '(name, holder, token, expires) VALUES (?, ?, ?, ?)',
+                                   (name,) + tuple(lease))
+                connection.execute('COMMIT')
+            finally:
+                # closing an open transaction rolls it back
+                connection.close()
+        except sqlite3.Error as error:
+            raise LeaseError('unable to update lease database %s: %s' % (self.path, error))
+
+        return lease
+
+
+LEASE_BACKENDS = {
+    'file': FileLeaseBackend,
+    'sqlite': SqliteLeaseBackend,
+}
+
+
+def get_lease_backend(config):
+    """This function builds the lease backend described in the lease section
+       of a group configuration.
+
+    :param config: dict with 'backend', either 'file', 'sqlite' or the
+                   'module:Class' of a LeaseBackend subclass, and the
+                   backend's other arguments, such as 'path'
+    :returns: LeaseBackend
+    """
+    from raxas.plugins import import_target
+
+    options = dict(config)
+    options.pop('ttl', None)
+    backend = options.pop('backend', 'file')
+
+    backend_class = LEASE_BACKENDS.get(backend)
+    if backend_class is None:
+        backend_class = import_target(backend)
+
+    return backend_class(**options)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from raxas import common
+from raxas import webhooks
+
+DEFAULT_OUTBOX_PATH = os.path.join(common.DATA_DIR, 'webhooks.db')
+
+# seconds a webhook taken by a flusher is hidden from the other flushers,
+# after which it is sent again if the flusher did not report back
+CLAIM_TTL = 300
+
+
+class OutboxError(Exception):
+    """The outbox could not be read or updated."""
+
+
+class Outbox(object):
+    """Webhooks waiting to be delivered, stored in an SQLite database.
+
+    Webhooks are appended by put() and removed once delivered, or once they
+    failed max_attempts times. Several processes can flush the same outbox,
+    a webhook is only handed to one of them at a time.
+    """
+
+    def __init__(self, path=DEFAULT_OUTBOX_PATH):
+        self.path = path
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute('CREATE TABLE IF NOT EXISTS webhooks ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'url TEXT NOT NULL, data TEXT NOT NULL, '
+                           'options TEXT NOT NULL, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, '
+                           'next_attempt REAL NOT NULL, created REAL NOT NULL)')
+        return connection
+
+    def _execute(self, func):
+        """This function runs func(connection) in a transaction holding the
+           write lock of the database.
+
+        :param func: function taking an sqlite3.Connection
+        :returns: result of func
+        :raises: OutboxError
+        """
+        try:
+            connection = self._connect()
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                result = func(connection)
+                connection.execute('COMMIT')
+                return result
+            finally:
+                # closing an open transaction rolls it back
+                connection.close()
+        except (sqlite3.Error, OSError) as error:
+            raise OutboxError('unable to update outbox %s: %s' % (self.path, error))
+
+    def put(self, hooks, data):
+        """This function appends webhooks to the outbox.
+
+        :param hooks: list of (url, options) tuples, see webhooks.get_hooks()
+        :param data: data to send as json
+        :raises: OutboxError
+        """
+        now = time.time()
+        rows = [(url, json.dumps(data), json.dumps(options), now, now)
+                for url, options in hooks]
+
+        self._execute(lambda connection: connection.executemany(
+            'INSERT INTO webhooks (url, data, options, next_attempt, created) '
+            'VALUES (?, ?, ?, ?, ?)', rows))
+
+    def claim(self, limit, claim_ttl=CLAIM_TTL):
+        """This function takes the oldest webhooks which are due.
+
+        :param limit: maximum number of webhooks
+        :param claim_ttl: seconds before the webhooks are handed out again
+        :returns: list of (id, url, data, options, attempts) tuples
+        :raises: OutboxError
+        """
+        now = time.time()
+
+        def take(connection):
+            rows = connection.execute(
+                'SELECT id, url, data, options, attempts FROM webhooks '
+                'WHERE next_attempt <= ? ORDER BY id LIMIT ?', (now, limit)).fetchall()
+            connection.executemany('UPDATE webhooks SET next_attempt = ? WHERE id = ?',
+                                   [(now + claim_ttl, row[0]) for row in rows])
+            return [(row_id, url, json.loads(data), json.loads(options), attempts)
+                    for row_id, url, data, options, attempts in rows]
+
+        return self._execute(take)
+
+    def settle(self, done, retries):
+        """This function records the outcome of claimed webhooks.
+
+        :param done: ids of the webhooks to remove
+        :param retries: list of (id, next attempt) tuples of the webhooks to
+                        send again later
+        :raises: OutboxError
+        """
+        def update(connection):
+            connection.executemany('DELETE FROM webhooks WHERE id = ?',
+                                   [(row_id,) for row_id in done])
+            connection.executemany('UPDATE webhooks SET attempts = attempts + 1, '
+                                   'next_attempt = ? WHERE id = ?',
+                                   [(retry_at, row_id) for row_id, retry_at in retries])
+
+        self._execute(update)
+
+    def flush(self, batch_size=50, max_attempts=10, max_backoff=3600,
+              max_workers=4, deadline=None):
+        """This function sends the webhooks which are due, a batch at a time.
+
+        A webhook which fails is sent again after its back-off, doubled after
+        every attempt and limited to max_backoff seconds.
+
+        :param batch_size: number of webhooks taken at a time
+        :param max_attempts: attempts after which a webhook is dropped
+        :param max_backoff: maximum seconds between two attempts
+        :param max_workers: maximum number of webhooks sent at the same time
+        :param deadline: common.Deadline after which no batch is started,
+                         no limit if not provided
+        :returns: number of webhooks delivered
+        :raises: OutboxError
+        """
+        logger = common.get_logger()
+
+        deadline = deadline or common.Deadline(None)
+        delivered_count = 0
+
+        while deadline.remaining() != 0:
+            rows = self.claim(batch_size)
+            if not rows:
+                break
+
+            # retries are scheduled here, not sent straight away
+            results = common.run_concurrently(
+                lambda row: webhooks.post(row[1], row[2], dict(row[3], retries=0),
+                                          deadline=deadline),
+                rows, max_workers=max_workers, timeouts=deadline.timeout(None))
+
+            delivered, dropped, retries = [], [], []
+            for (row_id, url, _, options, attempts), status_code in zip(rows, results):
+                if status_code is not None and \
+                        status_code not in webhooks.RETRY_STATUS_CODES:
+                    delivered.append(row_id)
+                elif attempts + 1 >= max_attempts:
+                    logger.error('Dropping webhook \'%s\' after %d attempts', url,
+                                 attempts + 1)
+                    dropped.append(row_id)
+                else:
+                    backoff = min(options['backoff'] * 2 ** attempts, max_backoff)
+                    retries.append((row_id, time.time() + backoff))
+
+            self.settle(delivered + dropped, retries)
+            delivered_count += len(delivered)
+            if len(rows) < batch_size:
+                break
+
+        return delivered_count
+
+
+def get_outbox(options):
+    """This function returns the outbox set in the webhook options of a group.
+
+    :param options: options returned by webhooks.get_options()
+    :returns: Outbox or None if the outbox is disabled
+    """
+    path = options.get('outbox')
+    if not path:
+        return None
+    return Outbox(DEFAULT_OUTBOX_PATH if path is True else path)
+
+
+def drain(outbox, options, deadline=None):
+    """This function flushes an outbox, logging errors instead of raising them.
+
+    :param outbox: Outbox
+    :param options: options returned by webhooks.get_options()
+    :param deadline: common.Deadline of the flush, no limit if not provided
+    :returns: number of webhooks delivered
+    """
+    logger = common.get_logger()
+
+    try:
+        delivered = outbox.flush(batch_size=options['outbox_batch'],
+                                 max_attempts=options['outbox_max_attempts'],
+                                 max_backoff=options['outbox_max_backoff'],
+                                 max_workers=options['max_workers'],
+                                 deadline=deadline)
+    except OutboxError as error:
+        logger.error(error)
+        return 0
+
+    if delivered:
+        logger.info('Delivered %d webhooks from %s', delivered, outbox.path)
+    return delivered
+
+
+def drain_async(outboxes, deadline=None):
+    """This function flushes outboxes from a background thread and returns
+       straight away.
+
+    The thread is not a daemon thread, so the process finishes the flush
+    before it exits. Outboxes which do not exist yet are skipped.
+
+    :param outboxes: list of (Outbox, options) tuples
+    :param deadline: common.Deadline of the flush, no limit if not provided
+    :returns: threading.Thread flushing the outboxes
+    """
+    def drain_all():
+        for outbox, options in outboxes:
+            if outbox.exists():
+                drain(outbox, options, deadline=deadline)
+
+    thread = threading.Thread(target=drain_all)
+    thread.start()
+    return thread
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import importlib
+import os
+import sys
+import threading
+
+from raxas import common
+
+PLUGIN_NAMESPACE = 'raxas.ext'
+
+# entry points of PLUGIN_NAMESPACE, keyed by a fingerprint of sys.path
+PLUGIN_CACHE = '.raxas-plugins.cache'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def path_fingerprint():
+    """This function returns a fingerprint of the sys.path entries and their
+       modification times.
+
+    Installing or removing a distribution changes the modification time of
+    the directory it is installed in, which invalidates the fingerprint.
+
+    :returns: str
+    """
+    entries = []
+    for path in sys.path:
+        try:
+            entries.append('%s:%s' % (path, os.stat(path or '.').st_mtime))
+        except OSError:
+            entries.append(path)
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+def scan_entry_points():
+    """This function scans the installed distributions for PLUGIN_NAMESPACE
+       entry points.
+
+    :returns: dict of plugin name -> 'module:attribute'
+    """
+    import pkg_resources
+
+    return dict((entry_point.name, '%s:%s' % (entry_point.module_name,
+                                              '.'.join(entry_point.attrs)))
+                for entry_point in pkg_resources.iter_entry_points(PLUGIN_NAMESPACE))
+
+
+def get_registry(use_cache=True, refresh=False):
+    """This function returns the plugins available in PLUGIN_NAMESPACE.
+
+    The entry points are only scanned once per process. Unless use_cache is
+    False, the result is also kept on disk in PLUGIN_CACHE and reused until
+    sys.path or the installed distributions change.
+
+    :param use_cache: read and write the on disk cache
+    :param refresh: scan the entry points again
+    :returns: dict of plugin name -> 'module:attribute'
+    """
+    logger = common.get_logger()
+
+    with _registry_lock:
+        if _registry and not refresh:
+            return dict(_registry)
+
+        fingerprint = path_fingerprint()
+        cached = common.read_cache(PLUGIN_CACHE) if use_cache and not refresh else {}
+        plugins = cached.get(fingerprint)
+
+        if plugins is None:
+            plugins = scan_entry_points()
+            logger.debug('Found plugins: %s', ', '.join(sorted(plugins)))
+            if use_cache:
+                common.write_cache(PLUGIN_CACHE, fingerprint, plugins)
+
+        _registry.clear()
+        _registry.update(plugins)
+        return dict(_registry)
+
+
+def import_target(target):
+    """This function imports the object a 'module:attribute' string refers to.
+
+    :param target: 'module:attribute' string
+    :returns: imported object
+    """
+    module_name, _, attrs = target.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in attrs.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def get_plugin_class(name):
+    """This function returns the class of a plugin.
+
+    If the registry points to code which no longer exists, the entry points
+    are scanned again before giving up.
+
+    :param name: plugin name as it appears in the configuration file
+    :returns: plugin class or None if the plugin is not available
+    """
+    logger = common.get_logger()
+
+    for refresh in (False, True):
+        target = get_registry(refresh=refresh).get(name)
+        if target is None:
+            continue
+        try:
+            return import_target(target)
+        except (ImportError, AttributeError) as error:
+            logger.debug('Unable to import plugin %s from %s: %s', name, target, error)
+
+    logger.error('Plugin %s is not available', name)
+    return None
+
+
+def load_plugins(scaling_group):
+    """This function instantiates the plugins enabled in the group configuration.
+
+    :param scaling_group: raxas.scaling_group.ScalingGroup
+    :returns: dict of plugin name -> plugin object
+    """
+    logger = common.get_logger()
+
+    plugins = {}
+    for name in scaling_group.plugin_config.keys():
+        plugin_class = get_plugin_class(name)
+        if plugin_class is None:
+            continue
+        try:
+            plugins[name] = plugin_class(scaling_group)
+        except Exception as error:
+            logger.error('Unable to load plugin %s: %s', name, error)
+
+    logger.info('Loaded plugins: %s', sorted(plugins))
+    return plugins
@@ -19,13 +19,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import json
-import requests
-import requests.exceptions
+import time
 import pyrax
 import pyrax.exceptions
 
 from raxas import common
 from raxas import enums
+from raxas import webhooks
 
 
 class ScalingGroup(object):
@@ -41,6 +41,8 @@ class ScalingGroup(object):
         self._scaling_group = None
         self._servers_state = None
         self._active_servers = None
+        self._lease_backend = None
+        self._lease = None
 
     @classmethod
     def check_config(cls, config):
@@ -109,10 +111,33 @@ class ScalingGroup(object):
         else:
             return self._active_servers
 
+    def refresh(self):
+        """This forgets the cached group state so it is fetched again on next use.
+
+        The pyrax scaling group object itself is kept, so a long running
+        process only pays for the get_state() call on each cycle.
+        """
+        self._servers_state = None
+        self._active_servers = None
+
+    @property
+    def lease_backend(self):
+        """The raxas.lease.LeaseBackend electing the leader of this group, or
+        None if the group has no lease section."""
+        if self._lease_backend is None and self._config.get('lease') is not None:
+            from raxas import lease
+            self._lease_backend = lease.get_lease_backend(self._config['lease'])
+        return self._lease_backend
+
     @property
     def is_master(self):
         """This property checks scaling group state and determines if this node is a master.
 
+        If the group has a lease section, the active server holding the lease
+        is the only master, otherwise the first two active servers are.
+        The master servers are also remembered in common.MASTERS_CACHE, so
+        later runs can tell whether this node is a slave without any API call.
+
         :returns: enums.NodeStatus
         """
         logger = common.get_logger()
@@ -123,6 +148,9 @@ class ScalingGroup(object):
             logger.error('Failed to get server uuid')
             return enums.NodeStatus.Unknown
 
+        if self._config.get('lease') is not None:
+            return self.elect_leader(node_id)
+
         active_count = len(self.active_servers)
         if active_count == 1:
             masters.append(self.active_servers[0])
@@ -133,6 +161,9 @@ class ScalingGroup(object):
             logger.error('Unknown cluster state')
             return enums.NodeStatus.Unknown
 
+        common.write_cache(common.MASTERS_CACHE, self._group_name,
+                           {'masters': masters, 'checked': time.time()})
+
         if node_id in masters:
             logger.info('Node is a master, continuing')
             return enums.NodeStatus.Master
@@ -140,6 +171,78 @@ class ScalingGroup(object):
             logger.info('Node is not a master, nothing to do. Exiting')
             return enums.NodeStatus.Slave
 
+    def elect_leader(self, node_id):
+        """This function takes or renews the lease of the group if this node
+           is one of its active servers.
+
+        :param node_id: server uuid of this node
+        :returns: enums.NodeStatus
+        """
+        from raxas import lease
+
+        logger = common.get_logger()
+
+        if node_id not in self.active_servers:
+            logger.info('Node is not an active server of the group, nothing to do. Exiting')
+            self._lease = None
+            return enums.NodeStatus.Slave
+
+        ttl = self._config['lease'].get('ttl', lease.DEFAULT_LEASE_TTL)
+        try:
+            self._lease = self.lease_backend.acquire(self.group_uuid, node_id, ttl)
+            leader = self._lease or self.lease_backend.get(self.group_uuid)
+        except lease.LeaseError as error:
+            logger.error('Unable to get the lease of the group: %s', error)
+            self._lease = None
+            return enums.NodeStatus.Unknown
+
+        # other nodes check the lease again once it expires
+        common.write_cache(common.MASTERS_CACHE, self._group_name,
+                           {'masters': [leader.holder], 'checked': time.time(),
+                            'expires': leader.expires})
+
+        if self._lease is not None:
+            logger.info('Node holds the lease (token %d), continuing', self._lease.token)
+            return enums.NodeStatus.Master
+        else:
+            logger.info('Node %s holds the lease, nothing to do. Exiting', leader.holder)
+            return enums.NodeStatus.Slave
+
+    def holds_lease(self):
+        """This function checks, right before acting on the group, that the
+           lease taken by is_master is still held with the same fencing token.
+
+        :returns: True if the lease is still held or no lease was taken
+        """
+        from raxas import lease
+
+        if self._lease is None:
+            return True
+
+        try:
+            if self.lease_backend.is_valid(self.group_uuid, self._lease):
+                return True
+        except lease.LeaseError as error:
+            common.get_logger().error('Unable to check the lease of the group: %s', error)
+
+        common.get_logger().error('Lease (token %d) is no longer held', self._lease.token)
+        return False
+
+    def release_lease(self):
+        """This function gives up the lease taken by is_master, if any, so
+           another node can take over straight away.
+        """
+        from raxas import lease
+
+        if self._lease is None:
+            return
+
+        try:
+            self.lease_backend.release(self.group_uuid, self._lease)
+        except lease.LeaseError as error:
+            common.get_logger().error('Unable to release the lease of the group: %s', error)
+        self._lease = None
+
     def get_group_value(self, key):
         """This function returns value in autoscale_groups section associated with
            provided key.
@@ -178,25 +281,62 @@ class ScalingGroup(object):
                          self._group_name, policy, hook)
             return None
 
-    def execute_webhook(self, policy, hook):
+    def execute_webhook(self, policy, hook, timeout=None):
         """This function makes webhook calls.
 
+        The webhooks are sent concurrently. Pre webhooks are waited for at
+        most pre_deadline seconds, after which scaling goes ahead. Post
+        webhooks are first written to the outbox, so the ones which fail
+        are sent again by later runs, and are sent in the background if
+        async_post is set.
+
         :param policy: raxas.enums.ScaleDirection
         :param hook: raxas.enums.HookType
+        :param timeout: seconds to wait for the webhooks, None to only apply
+                        the limits of the webhook_options section
+        :returns: dict of url -> status code, None if the webhooks went
+                  through the outbox or are sent in the background
         """
+        from raxas import outbox
+
         logger = common.get_logger()
 
         logger.info('Executing webhook: scale_%s:%s', policy.name, hook.name)
         urls = self.get_webhook_values(policy, hook)
+        options = webhooks.get_options(self._config.get('webhook_options'))
         data = json.dumps(self._config)
 
-        for url in urls:
-            logger.info('Sending POST request to url: \'%s\'', url)
-            try:
-                response = requests.post(url, json=data)
-                logger.info('Received status code %d from url: \'%s\'', response.status_code, url)
-            except requests.exceptions.RequestException as error:
-                logger.error(error)
+        if not urls:
+            return {}
+
+        if hook == enums.HookType.Post:
+            webhook_outbox = outbox.get_outbox(options)
+            if webhook_outbox is not None:
+                try:
+                    webhook_outbox.put(webhooks.get_hooks(urls, options), data)
+                except outbox.OutboxError as error:
+                    logger.error('Sending webhooks without the outbox: %s', error)
+                else:
+                    if options['async_post']:
+                        outbox.drain_async([(webhook_outbox, options)])
+                    elif timeout is None or timeout > 0:
+                        outbox.drain(webhook_outbox, options,
+                                     deadline=common.Deadline(timeout))
+                    return None
+
+            if options['async_post']:
+                webhooks.dispatch_async(urls, data, options)
+                return None
+
+        if hook == enums.HookType.Pre and options['pre_deadline']:
+            timeout = min(timeout, options['pre_deadline']) \
+                if timeout is not None else options['pre_deadline']
+
+        if timeout is not None and timeout <= 0:
+            logger.error('No time left to call webhooks')
+            return dict((url, None) for url, _ in webhooks.get_hooks(urls, options))
+
+        return webhooks.dispatch(urls, data, options, deadline=common.Deadline(timeout))
 
     def execute_policy(self, policy):
         """
@@ -213,6 +353,10 @@ class ScalingGroup(object):
             logger.info('Current active server count is 1, will not scale down')
             return enums.ScaleEvent.NoAction
 
+        if not self.holds_lease():
+            logger.error('Not scaling %s without the lease', policy.name)
+            return enums.ScaleEvent.NoAction
+
         try:
             self.scaling_group.get_policy(policy_id).execute()
         except pyrax.exceptions.PyraxException as error:
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from raxas import common
+
+# defaults of the webhook_options section of a group configuration
+DEFAULT_OPTIONS = {
+    'connect_timeout': 5,
+    'read_timeout': 10,
+    'retries': 2,
+    'backoff': 1,
+    'pre_deadline': 30,
+    'async_post': False,
+    'max_workers': 4,
+    # True for raxas.outbox.DEFAULT_OUTBOX_PATH, a path, or False to send
+    # post webhooks straight away
+    'outbox': True,
+    'outbox_batch': 50,
+    'outbox_max_attempts': 10,
+    'outbox_max_backoff': 3600,
+}
+
+# options which can also be set on a single webhook
+HOOK_OPTIONS = ['connect_timeout', 'read_timeout', 'retries', 'backoff']
+
+# status codes worth sending the request again for
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """This function returns the requests session shared by every webhook
+       call, so connections to the same host are reused.
+
+    :returns: requests.Session
+    """
+    import requests
+    import requests.adapters
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=10,
+                                                    pool_maxsize=10)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def get_options(config):
+    """This function returns the webhook options of a group.
+
+    :param config: webhook_options section of the group configuration or None
+    :returns: dict of option -> value, DEFAULT_OPTIONS for missing options
+    """
+    options = dict(DEFAULT_OPTIONS)
+    options.update(config or {})
+    return options
+
+
+def get_hooks(entries, options):
+    """This function turns the configured webhooks into (url, options) tuples.
+
+    :param entries: list of urls, or dicts with a 'url' key and any of
+                    HOOK_OPTIONS overriding the group options
+    :param options: group options returned by get_options()
+    :returns: list of (url, options) tuples
+    """
+    logger = common.get_logger()
+
+    hooks = []
+    for entry in entries or []:
+        if isinstance(entry, dict):
+            if not entry.get('url'):
+                logger.error('Webhook without url: %s', entry)
+                continue
+            hook_options = dict(options)
+            hook_options.update((key, entry[key]) for key in HOOK_OPTIONS if key in entry)
+            hooks.append((entry['url'], hook_options))
+        else:
+            hooks.append((entry, options))
+    return hooks
+
+
+def post(url, data, options, deadline=None):
+    """This function sends a webhook, retrying failed requests with an
+       exponential back-off.
+
+    :param url: webhook url
+    :param data: data to send as json
+    :param options: options returned by get_options()
+    :param deadline: common.Deadline no request or back-off may go past,
+                     no limit if not provided
+    :returns: status code of the last response or None if there was none
+    """
+    import requests.exceptions
+
+    logger = common.get_logger()
+
+    deadline = deadline or common.Deadline(None)
+    attempts = 1 + max(0, int(options['retries']))
+    status_code = None
+
+    for attempt in range(attempts):
+        if deadline.remaining() == 0:
+            logger.error('No time left to send webhook: \'%s\'', url)
+            break
+
+        logger.info('Sending POST request to url: \'%s\'', url)
+        try:
+            response = get_session().post(
+                url, json=data,
+                timeout=(deadline.timeout(options['connect_timeout']),
+                         deadline.timeout(options['read_timeout'])))
+            status_code = response.status_code
+            logger.info('Received status code %d from url: \'%s\'', status_code, url)
+            if status_code not in RETRY_STATUS_CODES:
+                return status_code
+        except requests.exceptions.RequestException as error:
+            logger.error('Webhook \'%s\' failed: %s', url, error)
+
+        if attempt + 1 < attempts:
+            delay = options['backoff'] * 2 ** attempt
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= delay:
+                break
+            time.sleep(delay)
+
+    return status_code
+
+
+def dispatch(entries, data, options, deadline=None):
+    """This function sends the webhooks concurrently.
+
+    :param entries: configured webhooks, see get_hooks()
+    :param data: data to send as json
+    :param options: options returned by get_options()
+    :param deadline: common.Deadline after which the webhooks still running
+                     are no longer waited for, no limit if not provided
+    :returns: dict of url -> status code, None for webhooks which failed or
+              did not finish in time
+    """
+    deadline = deadline or common.Deadline(None)
+    hooks = get_hooks(entries, options)
+
+    results = common.run_concurrently(
+        lambda hook: post(hook[0], data, hook[1], deadline=deadline),
+        hooks, max_workers=options['max_workers'],
+        timeouts=deadline.timeout(None))
+
+    return dict((url, result) for (url, _), result in zip(hooks, results))
+
+
+def dispatch_async(entries, data, options):
+    """This function sends the webhooks from a background thread and returns
+       straight away.
+
+    The thread is not a daemon thread, so the process finishes sending the
+    webhooks before it exits.
+
+    :param entries: configured webhooks, see get_hooks()
+    :param data: data to send as json
+    :param options: options returned by get_options()
+    :returns: threading.Thread sending the webhooks
+    """
+    thread = threading.Thread(target=dispatch, args=(entries, data, options))
+    thread.start()
+    return thread
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+
+from raxas import aggregates
+
+
+class AggregatesTest(unittest2.TestCase):
+    def test_mean(self):
+        self.assertEqual(2.0, aggregates.mean([1, 2, 3]))
+
+    def test_percentile(self):
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(3, aggregates.percentile(values, 50))
+        self.assertEqual(1, aggregates.percentile(values, 0))
+        self.assertEqual(5, aggregates.percentile(values, 100))
+        self.assertAlmostEqual(4.6, aggregates.percentile(values, 90))
+
+    def test_percentile_single_value(self):
+        self.assertEqual(7, aggregates.percentile([7], 99))
+
+    def test_trimmed_mean_drops_outliers(self):
+        values = [1.0] * 9 + [100.0]
+        self.assertEqual(1.0, aggregates.trimmed_mean(values, 0.1))
+
+    def test_trimmed_mean_keeps_small_samples(self):
+        self.assertEqual(2.0, aggregates.trimmed_mean([1.0, 3.0], 0.4))
+
+    def test_ewma(self):
+        self.assertEqual(1.0, aggregates.ewma(1.0, None, 0.5))
+        self.assertEqual(1.5, aggregates.ewma(2.0, 1.0, 0.5))
+
+    def test_named_aggregates(self):
+        values = [1, 2, 3, 10]
+        self.assertEqual(10, aggregates.AGGREGATES['max'](values))
+        self.assertEqual(2.5, aggregates.AGGREGATES['p50'](values))
@@ -18,6 +18,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest2
 from mock import patch, mock_open
 import pyrax
@@ -39,6 +47,11 @@ class AuthTest(unittest2.TestCase):
         self.tenant_id = "123456"
         self.api_key = "testtokenplsignore"
 
+    def setUp(self):
+        lock = patch.object(Auth, 'token_lock', contextlib.contextmanager(lambda self: (yield)))
+        lock.start()
+        self.addCleanup(lock.stop)
+
     def test_load_token_true(self):
         auth = Auth(self.username, self.api_key, self.region)
         with patch('__builtin__.open',
@@ -63,22 +76,17 @@ class AuthTest(unittest2.TestCase):
                    create=True):
             self.assertFalse(auth.load_token())
 
-    def test_save_token(self):
-        auth = Auth(self.username, self.api_key, self.region)
-        auth._tenant_id = self.tenant_id
-        auth._token = self.api_key
-        auth._token_filename = "token.file"
-        with patch('__builtin__.open', mock_open(), create=True) as mocked:
-            self.assertTrue(auth.save_token())
-            mocked.assert_called_once_with('token.file', 'w')
-
+    @patch.object(Auth, 'save_token', return_value=True)
+    @patch.object(Auth, 'store_identity')
     @patch('pyrax.auth_with_token', return_value=True)
-    def test_authenticate_token_success(self, mock_token):
+    def test_authenticate_token_success(self, mock_token, mock_store, mock_save):
         auth = Auth(self.username, self.api_key, self.region)
         auth._tenant_id = self.tenant_id
         auth._token = self.api_key
         auth._token_filename = "token.file"
         self.assertTrue(auth.authenticate_token())
+        self.assertTrue(mock_store.called)
+        self.assertTrue(mock_save.called)
 
     def test_authenticate_token_fail(self):
         auth = Auth(self.username, self.api_key, self.region)
@@ -174,6 +182,50 @@ class AuthTest(unittest2.TestCase):
         self.assertTrue(mock_identity.unauthenticate.called)
         self.assertTrue(mock_os.called)
 
+    @patch('pyrax.identity', create=True)
+    def test_is_authenticated_valid_token(self, mock_identity):
+        mock_identity.authenticated = True
+        mock_identity.expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        self.assertTrue(Auth.is_authenticated())
+
+    @patch('pyrax.identity', create=True)
+    def test_is_authenticated_expired_token(self, mock_identity):
+        mock_identity.authenticated = True
+        mock_identity.expires = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+
+        self.assertFalse(Auth.is_authenticated())
+
+    @patch('pyrax.identity', create=True)
+    def test_is_authenticated_token_expires_soon(self, mock_identity):
+        mock_identity.authenticated = True
+        mock_identity.expires = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+
+        self.assertFalse(Auth.is_authenticated())
+
+    @patch('pyrax.identity', create=True)
+    def test_is_authenticated_expired_token_local_timezone(self, mock_identity):
+        # pyrax keeps the expiry in UTC, whatever the local timezone is
+        old_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/Chicago'
+        time.tzset()
+        self.addCleanup(time.tzset)
+        if old_tz is None:
+            self.addCleanup(os.environ.pop, 'TZ')
+        else:
+            self.addCleanup(os.environ.__setitem__, 'TZ', old_tz)
+
+        mock_identity.authenticated = True
+        mock_identity.expires = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        self.assertFalse(Auth.is_authenticated())
+
+        mock_identity.expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.assertTrue(Auth.is_authenticated())
+
+    @patch('pyrax.identity', None, create=True)
+    def test_is_authenticated_no_identity(self):
+        self.assertFalse(Auth.is_authenticated())
+
     def test_tokenfilename(self):
         auth = Auth(self.username, self.api_key, self.region,
                     token_filename=self.token_file)
@@ -198,3 +250,190 @@ class AuthTest(unittest2.TestCase):
 
         self.assertTrue(mock_identity.unauthenticate.called)
         self.assertTrue(mock_os.called)
+
+    def fresh_token_contents(self, expires_in):
+        return json.dumps({
+            'token': self.api_key, 'tenant_id': self.tenant_id,
+            'tenant_name': self.tenant_id, 'expires': time.time() + expires_in,
+            'service_catalog': self.service_catalog(), 'user': self.user()})
+
+    @staticmethod
+    def service_catalog():
+        return [{'name': 'cloudServersOpenStack', 'type': 'compute',
+                 'endpoints': [{'region': 'HKG', 'tenantId': '123456',
+                                'publicURL': 'https://hkg.servers.api/v2/123456'}]}]
+
+    @staticmethod
+    def user():
+        return {'id': '1', 'name': 'AUTHUSER', 'roles': [],
+                'RAX-AUTH:defaultRegion': 'HKG'}
+
+    def test_load_token_with_expiry(self):
+        auth = Auth(self.username, self.api_key, self.region)
+        with patch('__builtin__.open',
+                   mock_open(read_data=self.fresh_token_contents(3600)), create=True):
+            self.assertTrue(auth.load_token())
+        self.assertTrue(auth.token_is_fresh())
+        self.assertEqual(self.service_catalog(), auth._service_catalog)
+
+    def test_token_is_fresh(self):
+        auth = Auth(self.username, self.api_key, self.region)
+        self.assertFalse(auth.token_is_fresh())
+
+        auth._service_catalog = self.service_catalog()
+        auth._user = self.user()
+        auth._expires = time.time() + 3600
+        self.assertTrue(auth.token_is_fresh())
+
+        auth._expires = time.time() + 60
+        self.assertFalse(auth.token_is_fresh())
+
+    @patch.object(Auth, 'token_lock')
+    @patch.object(Auth, 'authenticate_credentials', return_value=True)
+    @patch.object(Auth, 'authenticate_token', return_value=True)
+    @patch.object(Auth, 'restore_token', return_value=True)
+    def test_authenticate_fresh_token_without_lock(self, mock_restore, mock_token, mock_creds,
+                                                   mock_lock):
+        auth = Auth(self.username, self.api_key, self.region)
+        with patch('__builtin__.open',
+                   mock_open(read_data=self.fresh_token_contents(3600)), create=True):
+            self.assertTrue(auth.authenticate())
+
+        self.assertTrue(mock_restore.called)
+        self.assertFalse(mock_token.called)
+        self.assertFalse(mock_creds.called)
+        self.assertFalse(mock_lock.called)
+
+    @patch.object(Auth, 'authenticate_credentials', return_value=True)
+    @patch.object(Auth, 'authenticate_token', return_value=True)
+    @patch.object(Auth, 'restore_token', return_value=True)
+    def test_authenticate_token_expires_soon(self, mock_restore, mock_token, mock_creds):
+        auth = Auth(self.username, self.api_key, self.region)
+        with patch('__builtin__.open',
+                   mock_open(read_data=self.fresh_token_contents(60)), create=True):
+            self.assertTrue(auth.authenticate())
+
+        self.assertFalse(mock_restore.called)
+        self.assertFalse(mock_token.called)
+        self.assertTrue(mock_creds.called)
+
+    @patch('pyrax.services', (), create=True)
+    @patch('pyrax.regions', (), create=True)
+    @patch('pyrax.identity', None, create=True)
+    @patch('pyrax.connect_to_services')
+    def test_restore_token(self, mock_connect):
+        auth = Auth(self.username, self.api_key, self.region)
+        auth._token = self.api_key
+        auth._tenant_id = self.tenant_id
+        auth._tenant_name = self.tenant_id
+        expires = int(time.time()) + 3600
+        auth._expires = expires
+        auth._service_catalog = self.service_catalog()
+        auth._user = self.user()
+
+        self.assertTrue(auth.restore_token())
+        self.assertTrue(pyrax.identity.authenticated)
+        self.assertEqual(self.api_key, pyrax.identity.token)
+        self.assertEqual(('HKG',), pyrax.regions)
+        mock_connect.assert_called_once_with(region=self.region)
+
+        auth.store_identity()
+        self.assertEqual(self.user(), auth._user)
+        self.assertEqual(expires, auth._expires)
+
+    @patch('pyrax.identity', None, create=True)
+    @patch('pyrax.connect_to_services')
+    def test_restore_token_bad_catalog(self, mock_connect):
+        auth = Auth(self.username, self.api_key, self.region)
+        auth._expires = time.time() + 3600
+        auth._service_catalog = 'not a catalog'
+        auth._user = {}
+
+        self.assertFalse(auth.restore_token())
+
+
+class TokenFileTest(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.token_file = os.path.join(self.directory, 'token')
+
+    def test_save_token(self):
+        auth = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        auth._tenant_id = '123456'
+        auth._token = 'token'
+        auth._expires = 1400000000
+
+        self.assertTrue(auth.save_token())
+        self.assertEqual(['token'], os.listdir(self.directory))
+        self.assertEqual(0o600, os.stat(self.token_file).st_mode & 0o777)
+
+        other = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        self.assertTrue(other.load_token())
+        self.assertEqual('token', other._token)
+        self.assertEqual(1400000000, other._expires)
+
+    def test_save_token_failure_keeps_old_file(self):
+        with open(self.token_file, 'w') as f:
+            f.write('{"token": "old", "tenant_id": "123456"}')
+        auth = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        auth._token = object()
+
+        self.assertFalse(auth.save_token())
+        self.assertEqual(['token'], os.listdir(self.directory))
+        self.assertTrue(auth.load_token())
+        self.assertEqual('old', auth._token)
+
+    def test_token_lock_waits(self):
+        first = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        second = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        events = []
+
+        def wait_for_lock():
+            with second.token_lock():
+                events.append('second')
+
+        with first.token_lock():
+            thread = threading.Thread(target=wait_for_lock)
+            thread.start()
+            time.sleep(0.3)
+            events.append('first')
+        thread.join()
+
+        self.assertEqual(['first', 'second'], events)
+
+    def test_token_lock_timeout(self):
+        first = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        second = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+
+        with first.token_lock():
+            started = time.time()
+            with second.token_lock(timeout=0.2):
+                self.assertGreaterEqual(time.time() - started, 0.2)
+
+    @patch.object(Auth, 'authenticate_credentials')
+    @patch.object(Auth, 'restore_token', return_value=True)
+    def test_authenticate_reuses_token_saved_while_waiting(self, mock_restore, mock_creds):
+        auth = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        other = Auth('AUTHUSER', 'testtokenplsignore', 'HKG', token_filename=self.token_file)
+        other._token = 'new token'
+        other._tenant_id = '123456'
+        other._expires = time.time() + 3600
+        other._service_catalog = []
+        other._user = {}
+
+        locked = threading.Event()
+
+        def refresh():
+            with other.token_lock():
+                locked.set()
+                time.sleep(0.2)
+                other.save_token()
+
+        thread = threading.Thread(target=refresh)
+        thread.start()
+        locked.wait()
+        self.assertTrue(auth.authenticate())
+        thread.join()
+        self.assertFalse(mock_creds.called)
+        self.assertEqual('new token', auth._token)
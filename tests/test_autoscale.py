@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from mock import MagicMock, patch
+
+from tests.base_test import BaseTest
+from raxas import common
+from raxas.autoscale import (autoscale, autoscale_groups, cached_node_status,
+                             drain_outboxes, due_groups, main, record_node_status,
+                             run_daemon, slave_backoff)
+from raxas.enums import HookType, NodeStatus, ScaleDirection, ScaleEvent
+from raxas.scaling_group import ScalingGroup
+
+
+class AutoscaleTest(BaseTest):
+    def setUp(self):
+        self.args = {'cluster': False, 'dry_run': False}
+        self.scaling_group = MagicMock(spec=ScalingGroup)
+        self.scaling_group.plugin_config = {'up': {}}
+        self.scaling_group.execute_policy.return_value = ScaleEvent.Success
+        self.plugin = MagicMock()
+        self.plugin.make_decision.return_value = 1
+
+    def run_autoscale(self, deadline):
+        return autoscale('group0', self._config_parsed, self.args,
+                         scaling_group=self.scaling_group,
+                         plugins={'up': self.plugin}, deadline=deadline)
+
+    def test_autoscale_scale_up(self):
+        deadline = common.Deadline(60)
+
+        self.assertEqual(ScaleEvent.Success, self.run_autoscale(deadline))
+        self.scaling_group.execute_policy.assert_called_once_with(ScaleDirection.Up)
+        self.assertEqual(2, self.scaling_group.execute_webhook.call_count)
+        self.assertIsNone(deadline.exhausted_phase)
+
+    def test_autoscale_plugins_out_of_time(self):
+        def slow_decision():
+            time.sleep(0.5)
+            return 1
+
+        self.plugin.make_decision.side_effect = slow_decision
+        deadline = common.Deadline(0.1)
+
+        self.assertEqual(ScaleEvent.NoAction, self.run_autoscale(deadline))
+        self.assertFalse(self.scaling_group.execute_webhook.called)
+        self.assertFalse(self.scaling_group.execute_policy.called)
+        self.assertEqual('plugins', deadline.exhausted_phase)
+
+    def test_autoscale_skips_plugin_still_running(self):
+        patcher = patch('raxas.autoscale._running_plugins', new_callable=set)
+        running = patcher.start()
+        self.addCleanup(patcher.stop)
+        finished = threading.Event()
+        self.addCleanup(finished.set)
+
+        def stuck_decision():
+            finished.wait(5)
+            return 1
+
+        self.plugin.make_decision.side_effect = stuck_decision
+
+        self.assertEqual(ScaleEvent.NoAction, self.run_autoscale(common.Deadline(0.1)))
+        # the call which timed out is still running, the next cycle skips it
+        self.assertEqual(ScaleEvent.NoAction, self.run_autoscale(common.Deadline(0.1)))
+        self.assertEqual(1, self.plugin.make_decision.call_count)
+
+        finished.set()
+        for _ in range(50):
+            if not running:
+                break
+            time.sleep(0.01)
+        self.assertEqual(ScaleEvent.Success, self.run_autoscale(common.Deadline(60)))
+        self.assertEqual(2, self.plugin.make_decision.call_count)
+
+    def test_autoscale_pre_webhooks_out_of_time(self):
+        deadline = common.Deadline(60)
+
+        def slow_webhook(policy, hook, timeout=None):
+            self.assertLessEqual(timeout, 60)
+            deadline.started -= 60
+
+        self.scaling_group.execute_webhook.side_effect = slow_webhook
+
+        self.assertEqual(ScaleEvent.NoAction, self.run_autoscale(deadline))
+        self.assertFalse(self.scaling_group.execute_policy.called)
+        self.assertEqual('pre webhooks', deadline.exhausted_phase)
+
+    def test_autoscale_policy_out_of_time(self):
+        deadline = common.Deadline(60)
+
+        def slow_policy(policy):
+            deadline.started -= 60
+            return ScaleEvent.Success
+
+        self.scaling_group.execute_policy.side_effect = slow_policy
+
+        self.assertEqual(ScaleEvent.Success, self.run_autoscale(deadline))
+        self.assertEqual(1, self.scaling_group.execute_webhook.call_count)
+        self.assertEqual((ScaleDirection.Up, HookType.Pre),
+                         self.scaling_group.execute_webhook.call_args[0])
+        self.assertEqual('policy', deadline.exhausted_phase)
+
+    def test_autoscale_groups_out_of_time(self):
+        def slow_decision():
+            time.sleep(0.5)
+            return 1
+
+        self.plugin.make_decision.side_effect = slow_decision
+        deadline = common.Deadline(0.1)
+        self.args['max_workers'] = 1
+
+        summary = autoscale_groups({'group0': self.scaling_group}, self._config_parsed,
+                                   self.args, plugins={'group0': {'up': self.plugin}},
+                                   deadline=deadline)
+        self.assertEqual({'group0': ScaleEvent.NoAction}, summary)
+
+
+class ScheduleTest(BaseTest):
+    def setUp(self):
+        self.cache = {}
+        read_cache = patch('raxas.common.read_cache', side_effect=lambda name: dict(self.cache))
+        write_cache = patch('raxas.common.write_cache', side_effect=self.write_cache)
+        read_cache.start()
+        self.write_cache_mock = write_cache.start()
+        self.addCleanup(read_cache.stop)
+        self.addCleanup(write_cache.stop)
+
+    def write_cache(self, name, key, value):
+        if value is None:
+            self.cache.pop(key, None)
+        else:
+            self.cache[key] = value
+
+    def test_slave_backoff(self):
+        self.assertEqual(0, slave_backoff('group0', 600))
+
+        record_node_status('group0', NodeStatus.Slave)
+        self.assertGreater(slave_backoff('group0', 600), 590)
+        self.assertEqual(0, slave_backoff('group0', 0))
+        self.assertEqual(0, slave_backoff('group1', 600))
+
+        self.cache['group0']['slave_since'] -= 600
+        self.assertEqual(0, slave_backoff('group0', 600))
+
+    def test_record_node_status_master(self):
+        record_node_status('group0', NodeStatus.Slave)
+        record_node_status('group0', NodeStatus.Master)
+        self.assertEqual({}, self.cache)
+
+        record_node_status('group0', NodeStatus.Master)
+        self.assertEqual(2, self.write_cache_mock.call_count)
+
+    def test_due_groups(self):
+        record_node_status('group0', NodeStatus.Slave)
+        args = {'cluster': True, 'slave_interval': 600}
+
+        self.assertEqual(['group1'], due_groups(['group0', 'group1'], args))
+        args['cluster'] = False
+        self.assertEqual(['group0', 'group1'], due_groups(['group0', 'group1'], args))
+
+    @patch('raxas.common.read_uuid_cache', return_value='node')
+    def test_cached_node_status(self, read_uuid_cache_mock):
+        self.assertEqual(NodeStatus.Unknown, cached_node_status('group0', 300))
+
+        self.cache['group0'] = {'masters': ['master1', 'master2'], 'checked': time.time()}
+        self.assertEqual(NodeStatus.Slave, cached_node_status('group0', 300))
+        self.assertEqual(NodeStatus.Unknown, cached_node_status('group0', 0))
+
+        self.cache['group0']['masters'].append('node')
+        self.assertEqual(NodeStatus.Master, cached_node_status('group0', 300))
+
+        self.cache['group0']['checked'] -= 600
+        self.assertEqual(NodeStatus.Unknown, cached_node_status('group0', 300))
+
+    @patch('raxas.common.read_uuid_cache', return_value='node')
+    def test_cached_node_status_lease_expired(self, read_uuid_cache_mock):
+        self.cache['group0'] = {'masters': ['leader'], 'checked': time.time(),
+                                'expires': time.time() + 60}
+        self.assertEqual(NodeStatus.Slave, cached_node_status('group0', 300))
+
+        self.cache['group0']['expires'] -= 120
+        self.assertEqual(NodeStatus.Unknown, cached_node_status('group0', 300))
+
+    @patch('raxas.common.read_uuid_cache', return_value=None)
+    def test_cached_node_status_without_uuid(self, read_uuid_cache_mock):
+        self.cache['group0'] = {'masters': ['master1', 'master2'], 'checked': time.time()}
+        self.assertEqual(NodeStatus.Unknown, cached_node_status('group0', 300))
+
+    @patch('raxas.common.read_uuid_cache', return_value='node')
+    def test_due_groups_cached_masters(self, read_uuid_cache_mock):
+        self.cache['group0'] = {'masters': ['master1', 'master2'], 'checked': time.time()}
+        self.cache['group1'] = {'masters': ['node'], 'checked': time.time()}
+        args = {'cluster': True, 'master_ttl': 300}
+
+        self.assertEqual(['group1', 'group2'], due_groups(['group0', 'group1', 'group2'], args))
+
+    def test_autoscale_records_slave(self):
+        scaling_group = MagicMock(spec=ScalingGroup)
+        scaling_group.is_master = NodeStatus.Slave
+        args = {'cluster': True, 'dry_run': False, 'slave_interval': 600}
+
+        self.assertEqual(ScaleEvent.NotMaster,
+                         autoscale('group0', self._config_parsed, args,
+                                   scaling_group=scaling_group, plugins={}))
+        self.assertIn('group0', self.cache)
+
+    @patch('raxas.outbox.drain_async')
+    def test_drain_outboxes(self, drain_async_mock):
+        config_data = {'autoscale_groups': {
+            'group0': {},
+            'group1': {'webhook_options': {'outbox': '/tmp/group1.db'}},
+            'group2': {'webhook_options': {'outbox': False}},
+            'group3': {'webhook_options': {'retries': 5}}}}
+        deadline = common.Deadline(10)
+
+        drain_outboxes(['group0', 'group1', 'group2', 'group3'], config_data, deadline)
+
+        outboxes = sorted(drain_async_mock.call_args[0][0], key=lambda item: item[0].path)
+        self.assertEqual(['/tmp/group1.db', '/var/lib/rax-autoscaler/webhooks.db'],
+                         [webhook_outbox.path for webhook_outbox, _ in outboxes])
+        self.assertIs(deadline, drain_async_mock.call_args[1]['deadline'])
+
+    @patch('raxas.autoscale.drain_outboxes')
+    @patch('raxas.autoscale.autoscale_groups')
+    @patch('raxas.autoscale.load_plugins')
+    @patch('raxas.autoscale.get_scaling_group')
+    def test_run_daemon(self, get_scaling_group_mock, load_plugins_mock,
+                        autoscale_groups_mock, drain_outboxes_mock):
+        scaling_groups = {'group0': MagicMock(spec=ScalingGroup),
+                          'group1': MagicMock(spec=ScalingGroup)}
+        plugins = {'group0': {'up': MagicMock()}, 'group1': {'up': MagicMock()}}
+        get_scaling_group_mock.side_effect = lambda group, config: scaling_groups[group]
+        load_plugins_mock.side_effect = dict(
+            (scaling_groups[group], plugins[group]) for group in plugins).get
+
+        session = MagicMock()
+        # the token is still valid in the first cycle and expired in the second
+        session.is_authenticated.side_effect = [True, False]
+        session.authenticate.return_value = True
+
+        args = {'cluster': False, 'dry_run': False, 'interval': 60, 'deadline': 50}
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                raise KeyboardInterrupt
+
+        with patch('time.sleep', side_effect=sleep):
+            self.assertRaises(KeyboardInterrupt, run_daemon, ['group0', 'group1'],
+                              self._config_parsed, args, session)
+
+        # built once, reused by every cycle
+        self.assertEqual(2, get_scaling_group_mock.call_count)
+        self.assertEqual(2, load_plugins_mock.call_count)
+        self.assertEqual(2, autoscale_groups_mock.call_count)
+        for call in autoscale_groups_mock.call_args_list:
+            due, _, _, cycle_plugins, deadline = call[0]
+            self.assertEqual(scaling_groups, due)
+            self.assertEqual(plugins, cycle_plugins)
+            self.assertLessEqual(deadline.remaining(), 50)
+
+        for scaling_group in scaling_groups.values():
+            self.assertEqual(2, scaling_group.refresh.call_count)
+            scaling_group.release_lease.assert_called_once_with()
+
+        self.assertEqual(1, session.authenticate.call_count)
+        self.assertEqual(2, drain_outboxes_mock.call_count)
+
+    @patch('raxas.autoscale.drain_outboxes')
+    @patch('raxas.autoscale.autoscale_groups')
+    @patch('raxas.autoscale.load_plugins')
+    @patch('raxas.autoscale.get_scaling_group')
+    def test_run_daemon_dry_run(self, get_scaling_group_mock, load_plugins_mock,
+                                autoscale_groups_mock, drain_outboxes_mock):
+        args = {'cluster': False, 'dry_run': True, 'interval': 60, 'deadline': 50}
+
+        with patch('time.sleep', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, run_daemon, ['group0'],
+                              self._config_parsed, args, MagicMock())
+
+        self.assertTrue(autoscale_groups_mock.called)
+        self.assertFalse(drain_outboxes_mock.called)
+
+    def run_main(self, run_lock=True, **args):
+        self.acquire_run_lock_mock = MagicMock(return_value=run_lock)
+        defaults = {'lock_file': None, 'jitter': 0, 'deadline': 50,
+                    'config_file': 'config.json', 'as_group': 'group0',
+                    'all_groups': False, 'daemon': False, 'dry_run': False}
+        defaults.update(args)
+        patches = [patch('raxas.autoscale.parse_args', return_value=defaults),
+                   patch('raxas.common.setup_logging'),
+                   patch('raxas.common.acquire_run_lock', self.acquire_run_lock_mock),
+                   patch('raxas.common.check_file', return_value='config.json'),
+                   patch('raxas.common.get_config', return_value=self._config_parsed),
+                   # this node is not due, so the run stops before authenticating
+                   patch('raxas.autoscale.due_groups', return_value=[])]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        main()
+
+    @patch('raxas.autoscale.drain_outboxes')
+    def test_main_drains_outboxes_before_due_check(self, drain_outboxes_mock):
+        self.run_main()
+
+        self.assertEqual(['group0'], drain_outboxes_mock.call_args[0][0])
+
+    @patch('raxas.autoscale.drain_outboxes')
+    def test_main_waits_for_outboxes_before_releasing_lock(self, drain_outboxes_mock):
+        calls = MagicMock()
+        drain_outboxes_mock.return_value.join.side_effect = calls.join
+        lock_file = MagicMock()
+        lock_file.close.side_effect = calls.close
+
+        with patch('raxas.common.Deadline.remaining', return_value=12):
+            self.run_main(run_lock=lock_file)
+
+        self.assertEqual(['join', 'close'], [name for name, _, _ in calls.mock_calls])
+        drain_outboxes_mock.return_value.join.assert_called_once_with(12)
+
+    @patch('raxas.autoscale.drain_outboxes')
+    def test_main_dry_run_does_not_drain_outboxes(self, drain_outboxes_mock):
+        self.run_main(dry_run=True)
+
+        self.assertFalse(drain_outboxes_mock.called)
+
+    @patch('raxas.autoscale.drain_outboxes')
+    def test_main_run_lock_per_group(self, drain_outboxes_mock):
+        self.run_main(as_group='group0')
+        group0_lock = self.acquire_run_lock_mock.call_args[0][0]
+        self.run_main(as_group='group1')
+        group1_lock = self.acquire_run_lock_mock.call_args[0][0]
+
+        self.assertNotEqual(group0_lock, group1_lock)
+        self.assertEqual(common.get_run_lock_path('config.json', ['group0']), group0_lock)
+
+        self.run_main(lock_file='/tmp/run.lock')
+        self.acquire_run_lock_mock.assert_called_once_with('/tmp/run.lock')
@@ -22,7 +22,11 @@ from __future__ import with_statement
 
 import os
 import sys
+import multiprocessing
 import json
+import time
+import shutil
+import tempfile
 from mock import patch, mock_open, MagicMock
 
 from tests.base_test import BaseTest
@@ -32,6 +36,10 @@ from raxas.scaling_group import ScalingGroup
 
 
 class CommonTest(BaseTest):
+    def setUp(self):
+        common._server_index.clear()
+        self.addCleanup(common._server_index.clear)
+
     @patch('os.path.isfile', return_value=True)
     @patch('os.access', return_value=True)
     def test_check_file_should_return_abs_path(self, access_mock, isfile_mock):
@@ -122,13 +130,17 @@ class CommonTest(BaseTest):
         self.assertEqual(common.get_machine_uuid(None), '1234')
 
     @patch('raxas.common.read_uuid_cache', return_value=None)
+    @patch('raxas.common.read_metadata_uuid', return_value=None)
+    @patch('raxas.common.read_persistent_uuid', return_value=None)
+    @patch('raxas.common.write_persistent_uuid')
     @patch('raxas.common.write_uuid_cache')
     @patch('netifaces.interfaces')
     @patch('netifaces.ifaddresses')
     @patch('pyrax.cloudservers')
     def test_get_machine_uuid(self, cloud_servers_mock,
                               ifaddr_mock, interfaces_mock, write_uuid_mock,
-                              read_uuid_mock):
+                              write_persistent_mock, read_persistent_mock,
+                              read_metadata_mock, read_uuid_mock):
 
         uuid = 'eb8f2464-17a4-4796-a1ba-ab635ad287b9'
         scaling_group = MagicMock(spec=ScalingGroup)
@@ -136,9 +148,11 @@ class CommonTest(BaseTest):
         scaling_group.launch_config = {'load_balancers': [{'loadBalancerId': 231231}]}
         scaling_group.active_servers = [uuid]
 
-        ifaddr_mock.return_value = {2: [{'addr': '119.9.94.249'}]}
+        ifaddr_mock.return_value = {2: [{'addr': '119.9.94.249'}],
+                                    17: [{'addr': 'BC:76:4E:1C:19:45'}]}
         interfaces_mock.return_value = ['eth0']
 
+        cloud_servers_mock.servers.list.return_value = []
         get_mock = cloud_servers_mock.servers.get.return_value
         get_mock.networks.values.return_value = \
             [['119.9.94.249', '2401:1800:7800:102:be76:4eff:fe1c:1945'],
@@ -146,6 +160,142 @@ class CommonTest(BaseTest):
         get_mock.id = uuid
 
         self.assertEqual(common.get_machine_uuid(scaling_group), uuid)
+        write_uuid_mock.assert_called_once_with(uuid)
+        write_persistent_mock.assert_called_once_with(['bc:76:4e:1c:19:45'], uuid)
+
+    @patch('raxas.common.read_uuid_cache', return_value=None)
+    @patch('raxas.common.read_metadata_uuid', return_value=None)
+    @patch('raxas.common.read_persistent_uuid', return_value=None)
+    @patch('raxas.common.write_persistent_uuid')
+    @patch('raxas.common.write_uuid_cache')
+    @patch('raxas.common.get_local_addresses',
+           return_value=(['10.176.68.154'], ['bc:76:4e:1c:19:45']))
+    @patch('pyrax.cloudservers')
+    def test_get_machine_uuid_bulk_list(self, cloud_servers_mock, *args):
+        uuid = 'eb8f2464-17a4-4796-a1ba-ab635ad287b9'
+        scaling_group = MagicMock(spec=ScalingGroup)
+        scaling_group.active_servers = ['other', uuid]
+
+        other = MagicMock(id='not-in-group')
+        other.networks = {'private': ['10.176.68.154']}
+        server = MagicMock(id=uuid)
+        server.networks = {'private': ['10.176.68.154']}
+        cloud_servers_mock.servers.list.return_value = [other, server]
+
+        self.assertEqual(common.get_machine_uuid(scaling_group), uuid)
+        cloud_servers_mock.servers.list.assert_called_once_with(
+            search_opts={'ip': '^(10\\.176\\.68\\.154)$'})
+        self.assertFalse(cloud_servers_mock.servers.get.called)
+
+    @patch('raxas.common.read_uuid_cache', return_value=None)
+    @patch('raxas.common.read_metadata_uuid')
+    @patch('raxas.common.write_uuid_cache')
+    @patch('pyrax.cloudservers')
+    def test_get_machine_uuid_from_metadata(self, cloud_servers_mock,
+                                            write_uuid_mock, read_metadata_mock,
+                                            read_uuid_mock):
+        uuid = 'eb8f2464-17a4-4796-a1ba-ab635ad287b9'
+        read_metadata_mock.return_value = uuid
+
+        self.assertEqual(common.get_machine_uuid(None), uuid)
+        write_uuid_mock.assert_called_once_with(uuid)
+        self.assertFalse(cloud_servers_mock.servers.list.called)
+
+    @patch('raxas.common.read_uuid_cache', return_value=None)
+    @patch('raxas.common.read_metadata_uuid', return_value=None)
+    @patch('raxas.common.read_persistent_uuid', return_value='1234')
+    @patch('raxas.common.write_uuid_cache')
+    @patch('raxas.common.get_local_addresses', return_value=([], ['mac']))
+    @patch('pyrax.cloudservers')
+    def test_get_machine_uuid_from_persistent_cache(self, cloud_servers_mock,
+                                                    local_addresses_mock,
+                                                    write_uuid_mock, *args):
+        self.assertEqual(common.get_machine_uuid(None), '1234')
+        write_uuid_mock.assert_called_once_with('1234')
+        self.assertFalse(cloud_servers_mock.servers.list.called)
+
+    @patch('pyrax.cloudservers')
+    def test_find_server_concurrently(self, cloud_servers_mock):
+        servers = {}
+        for server_id, ip in (('a', '10.0.0.1'), ('b', '10.0.0.2'), ('c', '10.0.0.3')):
+            servers[server_id] = MagicMock(id=server_id)
+            servers[server_id].networks = {'private': [ip]}
+        cloud_servers_mock.servers.get.side_effect = lambda server_id: servers[server_id]
+
+        self.assertEqual('b', common.find_server_concurrently(
+            ['a', 'b', 'c'], ['10.0.0.2']))
+        self.assertIsNone(common.find_server_concurrently(
+            ['a', 'c'], ['10.0.0.2']))
+
+    @patch('pyrax.cloudservers')
+    def test_find_server_concurrently_api_error(self, cloud_servers_mock):
+        cloud_servers_mock.servers.get.side_effect = Exception('not found')
+
+        self.assertIsNone(common.find_server_concurrently(
+            ['a', 'b'], ['10.0.0.2']))
+
+    @patch('pyrax.cloudservers')
+    def test_get_server(self, cloud_servers_mock):
+        server = MagicMock(id='a')
+        cloud_servers_mock.servers.get.return_value = server
+
+        self.assertIs(server, common.get_server('a'))
+        self.assertIs(server, common.get_server('a'))
+        cloud_servers_mock.servers.get.assert_called_once_with('a')
+        self.assertFalse(cloud_servers_mock.list.called)
+
+    @patch('pyrax.cloudservers')
+    def test_get_server_expired(self, cloud_servers_mock):
+        cloud_servers_mock.servers.get.return_value = MagicMock(id='a')
+
+        common.get_server('a', ttl=0)
+        common.get_server('a', ttl=0)
+        self.assertEqual(2, cloud_servers_mock.servers.get.call_count)
+
+    @patch('pyrax.cloudservers')
+    def test_get_server_not_found(self, cloud_servers_mock):
+        cloud_servers_mock.servers.get.side_effect = Exception('not found')
+
+        self.assertIsNone(common.get_server('a'))
+
+    @patch('pyrax.cloudservers')
+    def test_get_server_from_listed_servers(self, cloud_servers_mock):
+        server = MagicMock(id='a')
+        server.networks = {'private': ['10.0.0.1']}
+        cloud_servers_mock.servers.list.return_value = [server]
+
+        self.assertEqual('a', common.find_server_by_ips(
+            cloud_servers_mock.servers, ['a'], ['10.0.0.1']))
+        self.assertIs(server, common.get_server('a'))
+        self.assertFalse(cloud_servers_mock.servers.get.called)
+
+    def test_read_metadata_uuid(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        metadata = os.path.join(tmp_dir, 'meta_data.json')
+        with open(metadata, 'w') as metadata_file:
+            json.dump({'uuid': 'eb8f2464-17a4-4796-a1ba-ab635ad287b9'}, metadata_file)
+
+        with patch('raxas.common.METADATA_FILES',
+                   [os.path.join(tmp_dir, 'missing.json'), metadata]):
+            self.assertEqual('eb8f2464-17a4-4796-a1ba-ab635ad287b9',
+                             common.read_metadata_uuid())
+
+        with patch('raxas.common.METADATA_FILES', [os.path.join(tmp_dir, 'missing.json')]):
+            self.assertIsNone(common.read_metadata_uuid())
+
+    def test_write_and_read_persistent_uuid(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        uuid = 'eb8f2464-17a4-4796-a1ba-ab635ad287b9'
+
+        with patch('raxas.common.PERSISTENT_UUID_CACHE',
+                   os.path.join(tmp_dir, 'lib', 'uuid.json')):
+            self.assertIsNone(common.read_persistent_uuid(['aa', 'bb']))
+            common.write_persistent_uuid(['aa', 'bb'], uuid)
+            self.assertEqual(uuid, common.read_persistent_uuid(['aa', 'bb']))
+            # an image of this server has other MAC addresses
+            self.assertIsNone(common.read_persistent_uuid(['aa', 'cc']))
 
     def test_get_user_value_from_config(self):
         sys.argv = ['/path/to/noserunner.py']
@@ -166,6 +316,151 @@ class CommonTest(BaseTest):
                                                'should raise KeyError'),
                          None)
 
+    def test_write_and_read_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        with patch('raxas.common.CACHE_DIR', cache_dir):
+            common.write_cache('.test.cache', 'a', {'value': 1})
+            common.write_cache('.test.cache', 'b', [1, 2])
+            self.assertEqual(common.read_cache('.test.cache'),
+                             {'a': {'value': 1}, 'b': [1, 2]})
+
+            common.write_cache('.test.cache', 'a', None)
+            self.assertEqual(common.read_cache('.test.cache'), {'b': [1, 2]})
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             ['.test.cache', '.test.cache.lock'])
+
+    def test_write_cache_from_concurrent_processes(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+
+        def write_keys(prefix):
+            for i in range(100):
+                common.write_cache('.test.cache', '%s%d' % (prefix, i), i)
+
+        with patch('raxas.common.CACHE_DIR', cache_dir):
+            processes = [multiprocessing.Process(target=write_keys, args=(prefix,))
+                         for prefix in ['a', 'b']]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join(30)
+
+            # no process undid the keys written by the other one
+            self.assertEqual(200, len(common.read_cache('.test.cache')))
+
+    def test_read_cache_returns_empty_when_missing(self):
+        with patch('raxas.common.CACHE_DIR', '/nonexistent'):
+            self.assertEqual(common.read_cache('.test.cache'), {})
+
+    def test_run_concurrently_keeps_order(self):
+        self.assertEqual(common.run_concurrently(lambda x: x * 2, [3, 1, 2]),
+                         [6, 2, 4])
+
+    def test_run_concurrently_returns_none_on_exception(self):
+        def func(item):
+            if item == 2:
+                raise ValueError('bad item')
+            return item
+
+        self.assertEqual(common.run_concurrently(func, [1, 2, 3]), [1, None, 3])
+
+    def test_run_concurrently_returns_none_on_timeout(self):
+        def func(item):
+            time.sleep(item)
+            return item
+
+        started = time.time()
+        self.assertEqual(common.run_concurrently(func, [0, 2], timeouts=[1, 0.1]),
+                         [0, None])
+        self.assertLess(time.time() - started, 1)
+
+    def test_run_concurrently_no_items(self):
+        self.assertEqual(common.run_concurrently(lambda x: x, []), [])
+
+    def test_acquire_run_lock(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        lock_path = os.path.join(lock_dir, 'run.lock')
+
+        lock = common.acquire_run_lock(lock_path)
+        self.assertTrue(lock)
+        with open(lock_path) as lock_file:
+            self.assertEqual(lock_file.read().strip(), str(os.getpid()))
+
+        self.assertFalse(common.acquire_run_lock(lock_path))
+
+        lock.close()
+        lock = common.acquire_run_lock(lock_path)
+        self.assertTrue(lock)
+        lock.close()
+
+    def test_get_run_lock_path(self):
+        path = common.get_run_lock_path('config.json', ['group1', 'group0'])
+
+        self.assertTrue(path.startswith(common.CACHE_DIR))
+        self.assertEqual(path, common.get_run_lock_path('config.json', ['group0', 'group1']))
+        self.assertNotEqual(path, common.get_run_lock_path('other.json',
+                                                           ['group0', 'group1']))
+        self.assertNotEqual(path, common.get_run_lock_path('config.json', ['group0']))
+
+    def test_acquire_run_lock_per_group(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        with patch('raxas.common.CACHE_DIR', lock_dir):
+            lock_a = common.acquire_run_lock(common.get_run_lock_path('config.json', ['A']))
+            lock_b = common.acquire_run_lock(common.get_run_lock_path('config.json', ['B']))
+            self.addCleanup(lock_a.close)
+            self.addCleanup(lock_b.close)
+
+            # both groups run at the same time, a second run of A is skipped
+            self.assertTrue(lock_a)
+            self.assertTrue(lock_b)
+            self.assertFalse(common.acquire_run_lock(
+                common.get_run_lock_path('config.json', ['A'])))
+
+    def test_acquire_run_lock_unwritable(self):
+        self.assertTrue(common.acquire_run_lock('/nonexistent/run.lock'))
+
+    @patch('raxas.common.read_uuid_cache', return_value='a3a1b1d7-2c56-4f46-9d2a-9bb0e9ef6bbd')
+    def test_get_jitter(self, read_uuid_cache_mock):
+        jitter = common.get_jitter(30)
+        self.assertGreaterEqual(jitter, 0)
+        self.assertLess(jitter, 30)
+        self.assertEqual(jitter, common.get_jitter(30))
+        self.assertEqual(common.get_jitter(0), 0)
+
+        read_uuid_cache_mock.return_value = 'b7e0d0a4-0b4f-4f57-8a0f-6f1a1e3c2d11'
+        self.assertNotEqual(jitter, common.get_jitter(30))
+
+    @patch('socket.gethostname', return_value='web-1')
+    @patch('raxas.common.read_uuid_cache', return_value=None)
+    def test_get_jitter_from_hostname(self, read_uuid_cache_mock, gethostname_mock):
+        self.assertEqual(common.get_jitter(30), common.get_jitter(30))
+        self.assertTrue(gethostname_mock.called)
+
+    def test_deadline_no_limit(self):
+        deadline = common.Deadline(0)
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(deadline.timeout(30), 30)
+        self.assertTrue(deadline.check('plugins'))
+
+    def test_deadline(self):
+        deadline = common.Deadline(10)
+        self.assertLessEqual(deadline.timeout(30), 10)
+        self.assertEqual(deadline.timeout(5), 5)
+        self.assertTrue(deadline.check('plugins'))
+        self.assertIsNone(deadline.exhausted_phase)
+
+        deadline.started = time.time() - 20
+        self.assertEqual(deadline.remaining(), 0)
+        self.assertEqual(deadline.timeout(None), 0)
+        self.assertFalse(deadline.check('plugins'))
+        self.assertFalse(deadline.check('pre webhooks'))
+        self.assertEqual(deadline.exhausted_phase, 'plugins')
+
     def test_is_ipv4(self):
         self.assertEqual(common.is_ipv4('127.0.0.1'), True)
         self.assertEqual(common.is_ipv4('1.2.3.4'), True)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest2
+
+from raxas import lease
+
+
+class LeaseBackendTests(object):
+    """Tests run against every lease backend."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.backend = self.make_backend(os.path.join(self.directory, 'leases'))
+
+    def test_acquire_free_lease(self):
+        acquired = self.backend.acquire('group', 'node1', ttl=60)
+
+        self.assertEqual('node1', acquired.holder)
+        self.assertEqual(1, acquired.token)
+        self.assertEqual(acquired, self.backend.get('group'))
+
+    def test_acquire_held_lease(self):
+        self.backend.acquire('group', 'node1', ttl=60)
+
+        self.assertIsNone(self.backend.acquire('group', 'node2', ttl=60))
+        self.assertEqual('node1', self.backend.get('group').holder)
+
+    def test_renew_keeps_token(self):
+        first = self.backend.acquire('group', 'node1', ttl=60)
+        renewed = self.backend.acquire('group', 'node1', ttl=120)
+
+        self.assertEqual(first.token, renewed.token)
+        self.assertGreater(renewed.expires, first.expires)
+
+    def test_expired_lease_is_taken_with_new_token(self):
+        first = self.backend.acquire('group', 'node1', ttl=-1)
+        second = self.backend.acquire('group', 'node2', ttl=60)
+
+        self.assertEqual('node2', second.holder)
+        self.assertEqual(first.token + 1, second.token)
+        self.assertFalse(self.backend.is_valid('group', first))
+        self.assertTrue(self.backend.is_valid('group', second))
+
+    def test_release(self):
+        first = self.backend.acquire('group', 'node1', ttl=60)
+        self.backend.release('group', first)
+
+        self.assertFalse(self.backend.is_valid('group', first))
+        second = self.backend.acquire('group', 'node2', ttl=60)
+        self.assertEqual(first.token + 1, second.token)
+
+    def test_release_lost_lease(self):
+        first = self.backend.acquire('group', 'node1', ttl=-1)
+        second = self.backend.acquire('group', 'node2', ttl=60)
+        self.backend.release('group', first)
+
+        self.assertTrue(self.backend.is_valid('group', second))
+
+    def test_leases_are_per_name(self):
+        self.backend.acquire('group1', 'node1', ttl=60)
+
+        self.assertIsNotNone(self.backend.acquire('group2', 'node2', ttl=60))
+        self.assertIsNone(self.backend.get('group3'))
+
+    def test_single_leader(self):
+        leaders = []
+
+        def elect(node):
+            if self.make_backend(self.backend.path).acquire('group', node, ttl=60):
+                leaders.append(node)
+
+        threads = [threading.Thread(target=elect, args=('node%d' % i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(leaders))
+
+
+class FileLeaseBackendTest(LeaseBackendTests, unittest2.TestCase):
+    make_backend = staticmethod(lease.FileLeaseBackend)
+
+    def test_invalid_file(self):
+        with open(self.backend.path, 'w') as lease_file:
+            lease_file.write('not json')
+
+        self.assertRaises(lease.LeaseError, self.backend.get, 'group')
+
+
+class SqliteLeaseBackendTest(LeaseBackendTests, unittest2.TestCase):
+    make_backend = staticmethod(lease.SqliteLeaseBackend)
+
+    def test_unusable_database(self):
+        backend = lease.SqliteLeaseBackend(self.directory)
+
+        self.assertRaises(lease.LeaseError, backend.acquire, 'group', 'node1')
+
+
+class GetLeaseBackendTest(unittest2.TestCase):
+    def test_builtin_backends(self):
+        backend = lease.get_lease_backend({'backend': 'sqlite', 'path': '/tmp/x.db', 'ttl': 60})
+        self.assertIsInstance(backend, lease.SqliteLeaseBackend)
+        self.assertEqual('/tmp/x.db', backend.path)
+
+        self.assertIsInstance(lease.get_lease_backend({}), lease.FileLeaseBackend)
+
+    def test_custom_backend(self):
+        backend = lease.get_lease_backend({'backend': 'raxas.lease:FileLeaseBackend',
+                                           'path': '/tmp/x'})
+        self.assertIsInstance(backend, lease.FileLeaseBackend)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import unittest2
+
+from mock import patch
+
+from raxas import outbox
+from raxas import webhooks
+
+
+class OutboxTest(unittest2.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.outbox = outbox.Outbox(os.path.join(tmp_dir, 'lib', 'webhooks.db'))
+        self.options = webhooks.get_options({'backoff': 10})
+
+        patcher = patch('raxas.webhooks.post', return_value=200)
+        self.post_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def put(self, *urls):
+        self.outbox.put([(url, self.options) for url in urls], 'data')
+
+    def test_put_and_claim(self):
+        self.assertFalse(self.outbox.exists())
+        self.put('url1', 'url2', 'url3')
+
+        self.assertTrue(self.outbox.exists())
+        rows = self.outbox.claim(2)
+        self.assertEqual(['url1', 'url2'], [row[1] for row in rows])
+        self.assertEqual('data', rows[0][2])
+        self.assertEqual(self.options, rows[0][3])
+
+        # claimed webhooks are not handed out again
+        self.assertEqual(['url3'], [row[1] for row in self.outbox.claim(2)])
+        self.assertEqual([], self.outbox.claim(2))
+
+    def test_claim_expires(self):
+        self.put('url1')
+
+        self.assertEqual(1, len(self.outbox.claim(10, claim_ttl=-1)))
+        self.assertEqual(1, len(self.outbox.claim(10)))
+
+    def test_flush(self):
+        self.put('url1', 'url2', 'url3')
+
+        self.assertEqual(3, self.outbox.flush(batch_size=2))
+        self.assertEqual(3, self.post_mock.call_count)
+        self.assertEqual(0, self.post_mock.call_args[0][2]['retries'])
+        self.assertEqual([], self.outbox.claim(10, claim_ttl=-1))
+
+    def test_flush_schedules_retries(self):
+        self.post_mock.return_value = 503
+        self.put('url1')
+
+        started = time.time()
+        self.assertEqual(0, self.outbox.flush())
+        self.assertEqual(1, self.post_mock.call_count)
+
+        with patch('time.time', return_value=started + 9):
+            self.assertEqual([], self.outbox.claim(10))
+        with patch('time.time', return_value=started + 11):
+            [row] = self.outbox.claim(10)
+        self.assertEqual(1, row[4])
+
+    def test_flush_backoff_is_exponential_and_bounded(self):
+        self.post_mock.return_value = None
+        self.put('url1')
+        started = time.time()
+
+        for attempt, backoff in enumerate([10, 20, 40, 50]):
+            with patch('time.time', return_value=started + 1000 * attempt):
+                self.outbox.flush(max_backoff=50)
+            with patch('time.time', return_value=started + 1000 * attempt + backoff - 1):
+                self.assertEqual([], self.outbox.claim(10, claim_ttl=0))
+            with patch('time.time', return_value=started + 1000 * attempt + backoff + 1):
+                self.assertEqual(1, len(self.outbox.claim(10, claim_ttl=0)))
+
+    def test_flush_drops_after_max_attempts(self):
+        self.post_mock.return_value = 500
+        self.put('url1')
+        started = time.time()
+
+        for attempt in range(3):
+            with patch('time.time', return_value=started + 1000 * attempt):
+                self.outbox.flush(max_attempts=3)
+
+        with patch('time.time', return_value=started + 10000):
+            self.assertEqual([], self.outbox.claim(10))
+        self.assertEqual(3, self.post_mock.call_count)
+
+    def test_flush_client_error_is_not_retried(self):
+        self.post_mock.return_value = 404
+        self.put('url1')
+
+        self.outbox.flush()
+        self.assertEqual([], self.outbox.claim(10, claim_ttl=-1))
+
+    def test_get_outbox(self):
+        self.assertIsNone(outbox.get_outbox({'outbox': False}))
+        self.assertEqual(outbox.DEFAULT_OUTBOX_PATH,
+                         outbox.get_outbox({'outbox': True}).path)
+        self.assertEqual('/tmp/outbox.db',
+                         outbox.get_outbox({'outbox': '/tmp/outbox.db'}).path)
+
+    def test_drain(self):
+        self.put('url1')
+
+        self.assertEqual(1, outbox.drain(self.outbox, self.options))
+
+    def test_drain_error(self):
+        with patch.object(self.outbox, 'flush', side_effect=outbox.OutboxError):
+            self.assertEqual(0, outbox.drain(self.outbox, self.options))
+
+    def test_drain_async(self):
+        missing = outbox.Outbox(self.outbox.path + '.missing')
+        self.put('url1')
+
+        thread = outbox.drain_async([(missing, self.options), (self.outbox, self.options)])
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(missing.exists())
+        self.assertEqual(1, self.post_mock.call_count)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+
+from mock import MagicMock, patch
+
+from raxas import plugins
+from raxas.core_plugins.raxclb import Raxclb
+from raxas.core_plugins.raxmon import Raxmon
+from raxas.scaling_group import ScalingGroup
+
+ENTRY_POINTS = {'raxmon': 'raxas.core_plugins.raxmon:Raxmon',
+                'raxclb': 'raxas.core_plugins.raxclb:Raxclb'}
+
+
+class PluginsTest(unittest2.TestCase):
+    def setUp(self):
+        plugins._registry.clear()
+        self.addCleanup(plugins._registry.clear)
+
+        patches = {
+            'read_cache': patch('raxas.common.read_cache', return_value={}),
+            'write_cache': patch('raxas.common.write_cache'),
+            'fingerprint': patch('raxas.plugins.path_fingerprint', return_value='fp'),
+            'scan': patch('raxas.plugins.scan_entry_points', return_value=dict(ENTRY_POINTS)),
+        }
+        self.mocks = {}
+        for name, patcher in patches.items():
+            self.mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_registry_scans_once(self):
+        self.assertEqual(ENTRY_POINTS, plugins.get_registry())
+        self.assertEqual(ENTRY_POINTS, plugins.get_registry())
+        self.assertEqual(1, self.mocks['scan'].call_count)
+        self.mocks['write_cache'].assert_called_once_with(
+            plugins.PLUGIN_CACHE, 'fp', ENTRY_POINTS)
+
+    def test_get_registry_from_disk_cache(self):
+        self.mocks['read_cache'].return_value = {'fp': {'raxmon': ENTRY_POINTS['raxmon']}}
+
+        self.assertEqual({'raxmon': ENTRY_POINTS['raxmon']}, plugins.get_registry())
+        self.assertFalse(self.mocks['scan'].called)
+        self.assertFalse(self.mocks['write_cache'].called)
+
+    def test_get_registry_disk_cache_other_fingerprint(self):
+        self.mocks['read_cache'].return_value = {'old': {'raxmon': 'gone:Raxmon'}}
+
+        self.assertEqual(ENTRY_POINTS, plugins.get_registry())
+        self.assertEqual(1, self.mocks['scan'].call_count)
+
+    def test_get_registry_without_disk_cache(self):
+        self.assertEqual(ENTRY_POINTS, plugins.get_registry(use_cache=False))
+        self.assertFalse(self.mocks['read_cache'].called)
+        self.assertFalse(self.mocks['write_cache'].called)
+
+    def test_get_plugin_class(self):
+        self.assertIs(Raxmon, plugins.get_plugin_class('raxmon'))
+        self.assertIs(Raxclb, plugins.get_plugin_class('raxclb'))
+
+    def test_get_plugin_class_stale_cache(self):
+        self.mocks['read_cache'].return_value = {'fp': {'raxmon': 'raxas.gone:Raxmon'}}
+
+        self.assertIs(Raxmon, plugins.get_plugin_class('raxmon'))
+        self.assertEqual(1, self.mocks['scan'].call_count)
+
+    def test_get_plugin_class_unknown(self):
+        self.assertIsNone(plugins.get_plugin_class('unknown'))
+
+    def test_load_plugins(self):
+        scaling_group = MagicMock(spec=ScalingGroup)
+        scaling_group.plugin_config = {'raxclb': {}, 'unknown': {}}
+
+        loaded = plugins.load_plugins(scaling_group)
+        self.assertEqual(['raxclb'], list(loaded.keys()))
+        self.assertIsInstance(loaded['raxclb'], Raxclb)
+        self.assertIs(scaling_group, loaded['raxclb'].scaling_group)
+
+    def test_load_plugins_broken_plugin(self):
+        scaling_group = MagicMock(spec=ScalingGroup)
+        scaling_group.plugin_config = {'raxclb': None}
+
+        self.assertEqual({}, plugins.load_plugins(scaling_group))
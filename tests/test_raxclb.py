@@ -18,13 +18,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import unittest2
+from datetime import datetime
 
-from mock import MagicMock, patch
+from mock import MagicMock, PropertyMock, patch
 from pyrax.exceptions import NotFound
 from pyrax.cloudloadbalancers import CloudLoadBalancer
 
-from raxas.core_plugins.raxclb import Raxclb
+from raxas.core_plugins.raxclb import Raxclb, parse_usage_time
 from raxas.scaling_group import ScalingGroup
 
 
@@ -33,12 +35,23 @@ class RaxclbTest(unittest2.TestCase):
     def __init__(self, *args, **kwargs):
         super(RaxclbTest, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def usage_time(age):
+        return datetime.utcfromtimestamp(int(time.time() - age)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
     def setUp(self):
         self.scaling_group = MagicMock(spec=ScalingGroup)
         self.scaling_group.plugin_config = {'raxclb': {}}
         self.scaling_group.launch_config = {'load_balancers': [{'loadBalancerId': 231231}]}
         self.scaling_group.state = {'active_capacity': 1}
 
+        read_cache = patch('raxas.common.read_cache', return_value={})
+        write_cache = patch('raxas.common.write_cache')
+        self.read_cache_mock = read_cache.start()
+        self.write_cache_mock = write_cache.start()
+        self.addCleanup(read_cache.stop)
+        self.addCleanup(write_cache.stop)
+
     def test_make_decision_no_lb(self, mock_clb):
         self.scaling_group.launch_config = {'test': 'case'}
 
@@ -52,6 +65,63 @@ class RaxclbTest(unittest2.TestCase):
         rclb = Raxclb(self.scaling_group)
         self.assertIsNone(rclb.make_decision())
 
+    def test_make_decision_skips_missing_lb(self, mock_clb):
+        self.scaling_group.plugin_config = {'raxclb': {'loadbalancers': [1, 'doesnotexist']}}
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_stats.return_value = {'currentConn': 100}
+
+        def get_lb(lb):
+            if lb == 'doesnotexist':
+                raise NotFound(404)
+            return fakelb
+
+        mock_clb.get.side_effect = get_lb
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual(1, rclb.make_decision())
+        self.assertEqual(2, mock_clb.get.call_count)
+
+    def test_make_decision_sums_lbs(self, mock_clb):
+        self.scaling_group.plugin_config = {'raxclb': {'loadbalancers': [1, 2, 3]}}
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_stats.return_value = {'currentConn': 100}
+        mock_clb.get.return_value = fakelb
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual(3, rclb.make_decision())
+
+    def test_make_decision_repeated(self, mock_clb):
+        self.scaling_group.state = {'active_capacity': 2}
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_stats.return_value = {'currentConn': 80}
+        mock_clb.get.return_value = fakelb
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual(0, rclb.make_decision())
+        self.assertEqual(0, rclb.make_decision())
+        self.assertEqual(50, rclb.scale_up_threshold)
+        self.assertEqual(1, rclb.scale_down_threshold)
+
+    def test_get_lb_ids_from_launch_config_is_remembered(self, mock_clb):
+        launch_config = PropertyMock(
+            return_value={'load_balancers': [{'loadBalancerId': 231231}]})
+        type(self.scaling_group).launch_config = launch_config
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual([231231], rclb.get_lb_ids())
+        self.assertEqual([231231], rclb.get_lb_ids())
+        self.assertEqual(1, launch_config.call_count)
+
+        rclb._group_lb_ids_expiry = 0
+        self.assertEqual([231231], rclb.get_lb_ids())
+        self.assertEqual(2, launch_config.call_count)
+
+    def test_get_lb_ids_configured(self, mock_clb):
+        self.scaling_group.plugin_config = {'raxclb': {'loadbalancers': [1, 2]}}
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual([1, 2], rclb.get_lb_ids())
+
     def test_make_decision_scaleup(self, mock_clb):
         fakelb = MagicMock(spec=CloudLoadBalancer)
         fakelb.get_stats.return_value = {'currentConn': 100}
@@ -82,11 +152,55 @@ class RaxclbTest(unittest2.TestCase):
         fakelb.get_stats.return_value = {'currentConnSsl': 20}
         fakelb.get_usage.return_value = {
             'loadBalancerUsageRecords': [
-                {'averageNumConnectionsSsl': 5},
-                {'averageNumConnectionsSsl': 8}
+                {'id': 1, 'startTime': self.usage_time(3000), 'averageNumConnectionsSsl': 5},
+                {'id': 2, 'startTime': self.usage_time(600), 'averageNumConnectionsSsl': 8}
             ]
         }
         mock_clb.get.return_value = fakelb
 
         rclb = Raxclb(self.scaling_group)
         self.assertEqual(0, rclb.make_decision())
+
+    def test_get_usage_average_requests_from_newest_record(self, mock_clb):
+        newest = int(time.time() - 600)
+        self.read_cache_mock.return_value = {
+            '231231:averageNumConnections': {
+                'records': {'1': [time.time() - 4000, 10], '2': [newest, 20]},
+                'sum': 30}}
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_usage.return_value = {'loadBalancerUsageRecords': [
+            {'id': 2, 'startTime': self.usage_time(600), 'averageNumConnections': 40},
+            {'id': 3, 'startTime': self.usage_time(60), 'averageNumConnections': 30}]}
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual(80 / 3.0, rclb.get_usage_average(fakelb, 231231,
+                                                          'averageNumConnections'))
+
+        fakelb.get_usage.assert_called_once_with(start=datetime.utcfromtimestamp(newest))
+        stored = self.write_cache_mock.call_args[0][2]
+        self.assertEqual(['1', '2', '3'], sorted(stored['records'].keys()))
+        self.assertEqual(80, stored['sum'])
+
+    def test_get_usage_average_drops_old_records(self, mock_clb):
+        self.read_cache_mock.return_value = {
+            '231231:averageNumConnections': {
+                'records': {'1': [time.time() - 8000, 10], '2': [time.time() - 600, 20]},
+                'sum': 30}}
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_usage.return_value = {'loadBalancerUsageRecords': []}
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertEqual(20, rclb.get_usage_average(fakelb, 231231, 'averageNumConnections'))
+        self.assertEqual(20, self.write_cache_mock.call_args[0][2]['sum'])
+
+    def test_get_usage_average_no_records(self, mock_clb):
+        fakelb = MagicMock(spec=CloudLoadBalancer)
+        fakelb.get_usage.return_value = {'loadBalancerUsageRecords': []}
+
+        rclb = Raxclb(self.scaling_group)
+        self.assertIsNone(rclb.get_usage_average(fakelb, 231231, 'averageNumConnections'))
+
+    def test_parse_usage_time(self, mock_clb):
+        self.assertEqual(1408636800, parse_usage_time('2014-08-21T16:00:00Z'))
+        self.assertEqual(1408654800, parse_usage_time('2014-08-21T16:00:00-05:00'))
+        self.assertEqual(1408636800, parse_usage_time('2014-08-21T16:00:00.000Z'))
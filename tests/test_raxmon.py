@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest2
+
+from mock import MagicMock, patch
+from pyrax.exceptions import NotFound
+
+from raxas.core_plugins.raxmon import (MetricWindow, Raxmon, Z_SCORES, confidence_interval,
+                                       t_quantile)
+from raxas.scaling_group import ScalingGroup
+
+
+def fake_entity(agent_id, average, check_type='agent.load_average'):
+    check = MagicMock()
+    check.type = check_type
+    check.id = 'ch-%s' % agent_id
+    check.get_metric_data_points.return_value = [
+        {'timestamp': int(time.time() - 60) * 1000, 'average': average}]
+    entity = MagicMock()
+    entity.agent_id = agent_id
+    entity.name = 'server-%s' % agent_id
+    return entity, [check]
+
+
+def fake_metric_calls(entities):
+    return [checks[0].get_metric_data_points for _, checks in entities]
+
+
+@patch('pyrax.cloud_monitoring', create=True)
+@patch.object(Raxmon, 'get_overview')
+class RaxmonTest(unittest2.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(RaxmonTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.scaling_group = MagicMock(spec=ScalingGroup)
+        self.scaling_group.plugin_config = {'raxmon': {}}
+        self.scaling_group.group_uuid = 'group id'
+        self.scaling_group.active_servers = ['a', 'b', 'c']
+
+        read_cache = patch('raxas.common.read_cache', return_value={})
+        write_cache = patch('raxas.common.write_cache')
+        self.read_cache_mock = read_cache.start()
+        self.write_cache_mock = write_cache.start()
+        self.addCleanup(read_cache.stop)
+        self.addCleanup(write_cache.stop)
+
+    def test_make_decision_scaleup(self, mock_overview, mock_cm):
+        mock_overview.return_value = [fake_entity('a', 0.9),
+                                      fake_entity('b', 0.8)]
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertEqual(1, rmon.make_decision())
+
+    def test_make_decision_scaledown(self, mock_overview, mock_cm):
+        mock_overview.return_value = [fake_entity('a', 0.1),
+                                      fake_entity('b', 0.2)]
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertEqual(-1, rmon.make_decision())
+
+    def test_make_decision_donothing(self, mock_overview, mock_cm):
+        mock_overview.return_value = [fake_entity('a', 0.5),
+                                      fake_entity('b', 0.5)]
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertEqual(0, rmon.make_decision())
+
+    def test_make_decision_no_data(self, mock_overview, mock_cm):
+        entity, checks = fake_entity('a', 0.5)
+        checks[0].get_metric_data_points.return_value = []
+        mock_overview.return_value = [(entity, checks)]
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertIsNone(rmon.make_decision())
+
+    def test_make_decision_respects_max_samples(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'max_samples': 2}}
+        entities = [fake_entity('a', 0.5), fake_entity('b', 0.5), fake_entity('c', 0.5)]
+        mock_overview.return_value = entities
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertEqual(0, rmon.make_decision())
+
+        fetched = [call for call in fake_metric_calls(entities) if call.called]
+        self.assertEqual(2, len(fetched))
+
+    def test_make_decision_refills_missing_samples(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'max_samples': 2}}
+        entities = [fake_entity('a', 0.9), fake_entity('b', 0.9), fake_entity('c', 0.9)]
+        fake_metric_calls(entities)[0].return_value = []
+        mock_overview.return_value = entities
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertEqual(1, rmon.make_decision())
+
+    def test_add_entity_checks_creates_missing_check(self, mock_overview, mock_cm):
+        entity, checks = fake_entity('a', 0.5, check_type='remote.ping')
+        entity.ip_addresses = {'private0_v4': '10.0.0.1'}
+
+        rmon = Raxmon(self.scaling_group)
+        rmon.add_entity_checks([(entity, checks)])
+
+        self.assertEqual(1, entity.create_check.call_count)
+
+    def test_add_entity_checks_skips_existing_check(self, mock_overview, mock_cm):
+        entity, checks = fake_entity('a', 0.5)
+
+        rmon = Raxmon(self.scaling_group)
+        rmon.add_entity_checks([(entity, checks)])
+
+        self.assertEqual(0, entity.create_check.call_count)
+
+    def test_make_decision_writes_check_cache(self, mock_overview, mock_cm):
+        self.scaling_group.active_servers = ['a', 'b']
+        mock_overview.return_value = [fake_entity('a', 0.5), fake_entity('b', 0.5)]
+
+        Raxmon(self.scaling_group).make_decision()
+
+        check_cache_calls = [c for c in self.write_cache_mock.call_args_list
+                             if c[0][0] == '.raxas-checks.cache']
+        self.assertEqual(1, len(check_cache_calls))
+        cached = check_cache_calls[0][0][2]
+        self.assertEqual(['a', 'b'], cached['active_servers'])
+        self.assertEqual(['a', 'b'], sorted(cached['entities'].keys()))
+
+    def test_make_decision_does_not_cache_incomplete_checks(self, mock_overview, mock_cm):
+        mock_overview.return_value = [fake_entity('a', 0.5), fake_entity('b', 0.5)]
+
+        Raxmon(self.scaling_group).make_decision()
+
+        self.assertNotIn('.raxas-checks.cache',
+                         [c[0][0] for c in self.write_cache_mock.call_args_list])
+
+    def test_make_decision_uses_check_cache(self, mock_overview, mock_cm):
+        self.scaling_group.active_servers = ['a']
+        self.read_cache_mock.side_effect = lambda name: {
+            '.raxas-checks.cache': {
+                'group id:agent.load_average:1m': {
+                    'active_servers': ['a'],
+                    'entities': {'a': {'entity_id': 'en1', 'label': 'server-a',
+                                       'check_id': 'ch1'}}}}}.get(name, {})
+
+        with patch.object(Raxmon, 'get_entity_metric', return_value=0.9) as metric_mock:
+            self.assertEqual(1, Raxmon(self.scaling_group).make_decision())
+
+        self.assertEqual(0, mock_overview.call_count)
+        entity, checks = metric_mock.call_args[0]
+        self.assertEqual('en1', entity.id)
+        self.assertEqual('ch1', checks[0].id)
+
+    def test_make_decision_ignores_stale_check_cache(self, mock_overview, mock_cm):
+        self.scaling_group.active_servers = ['a', 'b']
+        self.read_cache_mock.side_effect = lambda name: {
+            '.raxas-checks.cache': {
+                'group id:agent.load_average:1m': {
+                    'active_servers': ['a'],
+                    'entities': {'a': {'entity_id': 'en1', 'label': 'server-a',
+                                       'check_id': 'ch1'}}}}}.get(name, {})
+        mock_overview.return_value = [fake_entity('a', 0.5), fake_entity('b', 0.5)]
+
+        self.assertEqual(0, Raxmon(self.scaling_group).make_decision())
+        self.assertEqual(1, mock_overview.call_count)
+
+    def test_get_entity_metric_not_found_clears_cache(self, mock_overview, mock_cm):
+        entity, checks = fake_entity('a', 0.5)
+        checks[0].get_metric_data_points.side_effect = NotFound(404)
+
+        rmon = Raxmon(self.scaling_group)
+        self.assertIsNone(rmon.get_entity_metric(entity, checks))
+        self.write_cache_mock.assert_called_once_with(
+            '.raxas-checks.cache', 'group id:agent.load_average:1m', None)
+
+    def test_make_decision_adaptive_stops_when_obvious(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive'}}
+        self.scaling_group.active_servers = [str(i) for i in range(20)]
+        entities = [fake_entity(str(i), 0.95 + i * 0.001) for i in range(20)]
+        mock_overview.return_value = entities
+
+        self.assertEqual(1, Raxmon(self.scaling_group).make_decision())
+
+        fetched = [call for call in fake_metric_calls(entities) if call.called]
+        self.assertEqual(5, len(fetched))
+
+    def test_make_decision_adaptive_in_band_samples_less_than_fixed(self, mock_overview,
+                                                                    mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive'}}
+        self.scaling_group.active_servers = [str(i) for i in range(20)]
+        entities = [fake_entity(str(i), 0.45 + i * 0.005) for i in range(20)]
+        mock_overview.return_value = entities
+
+        for _ in range(20):
+            for call in fake_metric_calls(entities):
+                call.reset_mock()
+            self.assertEqual(0, Raxmon(self.scaling_group).make_decision())
+
+            fetched = [call for call in fake_metric_calls(entities) if call.called]
+            self.assertLess(len(fetched), 10)
+
+    def test_make_decision_adaptive_stops_at_max_samples(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive'}}
+        self.scaling_group.active_servers = [str(i) for i in range(20)]
+        entities = [fake_entity(str(i), 0.3 + (i % 2) * 0.55) for i in range(20)]
+        mock_overview.return_value = entities
+
+        # whatever the order the servers are sampled in, a group close to a
+        # threshold never samples more servers than fixed sampling would
+        counts = []
+        for _ in range(20):
+            for call in fake_metric_calls(entities):
+                call.reset_mock()
+            Raxmon(self.scaling_group).make_decision()
+
+            counts.append(len([call for call in fake_metric_calls(entities) if call.called]))
+        self.assertEqual(10, max(counts))
+
+    def test_enough_samples_identical_values(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive'}}
+        rmon = Raxmon(self.scaling_group)
+
+        self.assertFalse(rmon.enough_samples([0.85] * 3, 20))
+        self.assertFalse(rmon.enough_samples([0.3] * 4, 20))
+        self.assertTrue(rmon.enough_samples([0.85] * 3, 3))
+
+    def test_enough_samples_min_stddev(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive'}}
+        self.assertAlmostEqual(0.05, Raxmon(self.scaling_group).spread_floor)
+        self.assertTrue(Raxmon(self.scaling_group).enough_samples([0.7] * 5, 20))
+
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive',
+                                                       'min_stddev': 0.2}}
+        self.assertFalse(Raxmon(self.scaling_group).enough_samples([0.7] * 5, 20))
+
+    def test_adaptive_sampling_requires_mean_aggregate(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'sampling': 'adaptive',
+                                                       'aggregate': 'p99'}}
+        rmon = Raxmon(self.scaling_group)
+
+        self.assertEqual('fixed', rmon.sampling)
+        self.assertFalse(rmon.enough_samples([0.95] * 5, 20))
+
+    def test_make_decision_p90_aggregate(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'aggregate': 'p90'}}
+        self.scaling_group.active_servers = [str(i) for i in range(10)]
+        mock_overview.return_value = [fake_entity(str(i), 0.9 if i == 0 else 0.5)
+                                      for i in range(10)]
+
+        self.assertEqual(0, Raxmon(self.scaling_group).make_decision())
+
+        self.scaling_group.plugin_config = {'raxmon': {'aggregate': 'max'}}
+        self.assertEqual(1, Raxmon(self.scaling_group).make_decision())
+
+    def test_aggregate_results_ewma(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'aggregate': 'ewma',
+                                                       'ewma_alpha': 0.5}}
+        self.read_cache_mock.return_value = {
+            'group id:agent.load_average:1m': {'ewma': 0.2, 'timestamp': time.time()}}
+
+        self.assertAlmostEqual(0.5, Raxmon(self.scaling_group).aggregate_results([0.8]))
+        stored = self.write_cache_mock.call_args[0][2]
+        self.assertAlmostEqual(0.5, stored['ewma'])
+
+    def test_aggregate_results_ewma_ignores_old_average(self, mock_overview, mock_cm):
+        self.scaling_group.plugin_config = {'raxmon': {'aggregate': 'ewma'}}
+        self.read_cache_mock.return_value = {
+            'group id:agent.load_average:1m': {'ewma': 0.2, 'timestamp': time.time() - 3600}}
+
+        self.assertAlmostEqual(0.8, Raxmon(self.scaling_group).aggregate_results([0.8]))
+
+    def test_get_entity_metric_requests_only_new_points(self, mock_overview, mock_cm):
+        now = time.time()
+        entity, checks = fake_entity('a', 0.5)
+        checks[0].get_metric_data_points.return_value = [
+            {'timestamp': int(now - 10) * 1000, 'average': 0.9}]
+        rmon = Raxmon(self.scaling_group)
+        rmon.windows = {'ch-a': MetricWindow(10, [now - 70], [0.1])}
+
+        self.assertEqual(0.9, rmon.get_entity_metric(entity, checks))
+        start = checks[0].get_metric_data_points.call_args[0][1]
+        self.assertEqual(int(now - 70) + 1, start)
+        self.assertEqual(2, len(rmon.windows['ch-a']))
+
+    def test_get_entity_metric_averages_window(self, mock_overview, mock_cm):
+        now = time.time()
+        self.scaling_group.plugin_config = {'raxmon': {'window': 900}}
+        entity, checks = fake_entity('a', 0.5)
+        checks[0].get_metric_data_points.return_value = [
+            {'timestamp': int(now - 10) * 1000, 'average': 0.8}]
+        rmon = Raxmon(self.scaling_group)
+        rmon.windows = {'ch-a': MetricWindow(rmon.window_size,
+                                             [now - 1200, now - 600], [5.0, 0.2])}
+
+        self.assertAlmostEqual(0.5, rmon.get_entity_metric(entity, checks))
+
+    def test_make_decision_stores_metric_windows(self, mock_overview, mock_cm):
+        mock_overview.return_value = [fake_entity('a', 0.5)]
+
+        Raxmon(self.scaling_group).make_decision()
+
+        metric_calls = [c for c in self.write_cache_mock.call_args_list
+                        if c[0][0] == '.raxas-metrics.cache']
+        self.assertEqual(1, len(metric_calls))
+        self.assertEqual(['ch-a'], metric_calls[0][0][2].keys())
+
+    def test_get_entities_refreshes_index(self, mock_overview, mock_cm):
+        entity, checks = fake_entity('a', 0.5)
+        entity.id = 'en1'
+        mock_overview.return_value = [(entity, checks)]
+
+        self.assertEqual([(entity, checks)], Raxmon(self.scaling_group).get_entities(['a']))
+
+        mock_overview.assert_called_once_with(agent_ids=set(['a']))
+        cached = self.write_cache_mock.call_args[0][2]
+        self.assertEqual({'a': 'en1'}, cached['entities'])
+
+    def test_get_entities_uses_index(self, mock_overview, mock_cm):
+        self.read_cache_mock.return_value = {
+            'group id': {'timestamp': time.time(), 'entities': {'a': 'en1', 'b': 'en2'}}}
+
+        Raxmon(self.scaling_group).get_entities(['a'])
+
+        mock_overview.assert_called_once_with(entity_ids=['en1'])
+        self.assertEqual(0, self.write_cache_mock.call_count)
+
+    def test_get_entities_looks_up_unseen_server_only(self, mock_overview, mock_cm):
+        self.read_cache_mock.return_value = {
+            'group id': {'timestamp': time.time(), 'entities': {'a': 'en1'}}}
+        entity, checks = fake_entity('b', 0.5)
+        entity.id = 'en2'
+        mock_overview.side_effect = [[fake_entity('a', 0.5)], [(entity, checks)]]
+
+        Raxmon(self.scaling_group).get_entities(['a', 'b'])
+
+        self.assertEqual([((), {'entity_ids': ['en1']}), ((), {'agent_ids': set(['b'])})],
+                         mock_overview.call_args_list)
+        cached = self.write_cache_mock.call_args[0][2]
+        self.assertEqual({'a': 'en1', 'b': 'en2'}, cached['entities'])
+
+    def test_get_entities_scans_once_per_ttl(self, mock_overview, mock_cm):
+        caches = {}
+        self.read_cache_mock.side_effect = lambda name: caches.get(name, {})
+        self.write_cache_mock.side_effect = \
+            lambda name, key, value: caches.setdefault(name, {}).update({key: value})
+
+        def overview(entity_ids=None, agent_ids=None):
+            # server c has no monitoring agent
+            found = []
+            for agent_id in sorted(agent_ids or []):
+                if agent_id != 'c':
+                    entity, checks = fake_entity(agent_id, 0.5)
+                    entity.id = 'en-%s' % agent_id
+                    found.append((entity, checks))
+            return found
+
+        mock_overview.side_effect = overview
+        rmon = Raxmon(self.scaling_group)
+
+        def scans():
+            return [call[1]['agent_ids'] for call in mock_overview.call_args_list
+                    if 'agent_ids' in call[1]]
+
+        rmon.get_entities(['a', 'c'])
+        rmon.get_entities(['a', 'c'])
+        self.assertEqual([set(['a', 'c'])], scans())
+
+        # a new server is looked up once, the agentless one is not again
+        rmon.get_entities(['a', 'b', 'c'])
+        rmon.get_entities(['a', 'b', 'c'])
+        self.assertEqual([set(['a', 'c']), set(['b'])], scans())
+
+        with patch('time.time', return_value=time.time() + 7200):
+            rmon.get_entities(['a', 'b', 'c'])
+        self.assertEqual([set(['a', 'c']), set(['b']), set(['a', 'b', 'c'])], scans())
+
+    def test_get_entities_expired_index_refreshes(self, mock_overview, mock_cm):
+        self.read_cache_mock.return_value = {
+            'group id': {'timestamp': time.time() - 7200, 'entities': {'a': 'en1'}}}
+
+        Raxmon(self.scaling_group).get_entities(['a'])
+
+        mock_overview.assert_called_once_with(agent_ids=set(['a']))
+
+
+@patch('pyrax.cloud_monitoring', create=True)
+class RaxmonOverviewTest(unittest2.TestCase):
+    def setUp(self):
+        self.scaling_group = MagicMock(spec=ScalingGroup)
+        self.scaling_group.plugin_config = {'raxmon': {}}
+
+    def test_get_overview_follows_pagination(self, mock_cm):
+        pages = [
+            {'values': [{'entity': {'id': 'en1', 'agent_id': 'a'},
+                         'checks': [{'id': 'ch1', 'type': 'agent.load_average'}]}],
+             'metadata': {'next_marker': 'en2'}},
+            {'values': [{'entity': {'id': 'en2', 'agent_id': 'b'},
+                         'checks': []}],
+             'metadata': {'next_marker': None}},
+        ]
+        mock_cm.method_get.side_effect = [(None, page) for page in pages]
+
+        overview = Raxmon(self.scaling_group).get_overview()
+
+        self.assertEqual(2, mock_cm.method_get.call_count)
+        self.assertIn('marker=en2', mock_cm.method_get.call_args[0][0])
+        self.assertEqual(['a', 'b'], [entity.agent_id for entity, _ in overview])
+        self.assertEqual(['ch1'], [check.id for check in overview[0][1]])
+
+    def test_get_overview_keeps_requested_agents(self, mock_cm):
+        page = {'values': [{'entity': {'id': 'en1', 'agent_id': 'a'}, 'checks': []},
+                           {'entity': {'id': 'en2', 'agent_id': 'z'}, 'checks': []},
+                           {'entity': {'id': 'en3', 'agent_id': None}, 'checks': []}],
+                'metadata': {'next_marker': None}}
+        mock_cm.method_get.return_value = (None, page)
+
+        overview = Raxmon(self.scaling_group).get_overview(agent_ids=set(['a']))
+
+        self.assertEqual(['en1'], [entity.id for entity, _ in overview])
+
+    def test_get_overview_filters_entity_ids(self, mock_cm):
+        mock_cm.method_get.return_value = (None, {'values': [], 'metadata': {}})
+
+        Raxmon(self.scaling_group).get_overview(entity_ids=['en1', 'en2'])
+
+        self.assertIn('&entityId=en1&entityId=en2', mock_cm.method_get.call_args[0][0])
+
+
+class MetricWindowTest(unittest2.TestCase):
+    def test_add_ignores_older_points(self):
+        window = MetricWindow(5)
+        window.add(10, 1.0)
+        window.add(10, 2.0)
+        window.add(5, 3.0)
+
+        self.assertEqual(1, len(window))
+        self.assertEqual(10, window.last_timestamp)
+
+    def test_size_is_bounded(self):
+        window = MetricWindow(3)
+        for timestamp in range(10):
+            window.add(timestamp, float(timestamp))
+
+        self.assertEqual([7.0, 8.0, 9.0], window.values(0))
+
+    def test_values_since(self):
+        window = MetricWindow(5, [1, 2, 3], [1.0, 2.0, 3.0])
+
+        self.assertEqual([2.0, 3.0], window.values(2))
+
+    def test_to_dict_round_trip(self):
+        window = MetricWindow(5, [1, 2], [1.5, 2.5])
+        points = window.to_dict()
+
+        self.assertEqual(points, MetricWindow(5, **points).to_dict())
+
+
+class ConfidenceIntervalTest(unittest2.TestCase):
+    def test_t_quantile(self):
+        self.assertEqual(4.303, t_quantile(0.95, 2))
+        self.assertEqual(2.179, t_quantile(0.95, 13))
+        self.assertEqual(1.96, t_quantile(0.95, 31))
+        for confidence in Z_SCORES:
+            self.assertGreater(t_quantile(confidence, 30), Z_SCORES[confidence])
+
+    def test_min_stddev(self):
+        low, high = confidence_interval([0.85] * 3, 20, 4.303, min_stddev=0.2)
+
+        self.assertLess(low, 0.6)
+        self.assertGreater(high, 1.0)
+        self.assertEqual((0.85, 0.85), confidence_interval([0.85] * 3, 20, 4.303))
+
+    def test_interval_contains_mean(self):
+        low, high = confidence_interval([1.0, 2.0, 3.0], 100, 1.96)
+
+        self.assertLess(low, 2.0)
+        self.assertGreater(high, 2.0)
+        self.assertAlmostEqual(2.0, (low + high) / 2)
+
+    def test_full_population_has_no_margin(self):
+        self.assertEqual((2.0, 2.0), confidence_interval([1.0, 2.0, 3.0], 3, 1.96))
+
+    def test_interval_narrows_with_samples(self):
+        low_few, high_few = confidence_interval([1.0, 3.0] * 2, 1000, 1.96)
+        low_many, high_many = confidence_interval([1.0, 3.0] * 20, 1000, 1.96)
+
+        self.assertLess(high_many - low_many, high_few - low_few)
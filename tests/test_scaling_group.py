@@ -18,12 +18,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mock import patch, Mock, MagicMock
+import os
+import shutil
+import tempfile
+from mock import patch, Mock, MagicMock, ANY
 from pyrax.autoscale import ScalingGroup as pyrax_ScalingGroup
 from pyrax.fakes import FakeScalingGroup, FakeIdentity
 import pyrax.exceptions
 from raxas.enums import *
-import requests
 
 from tests.base_test import BaseTest
 from raxas.scaling_group import ScalingGroup
@@ -40,6 +42,17 @@ class TestScalingGroup(BaseTest):
             'active_capacity': 1
         }
 
+        write_cache = patch('raxas.common.write_cache')
+        self.write_cache_mock = write_cache.start()
+        self.addCleanup(write_cache.stop)
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.outbox_path = os.path.join(tmp_dir, 'webhooks.db')
+        outbox_path = patch('raxas.outbox.DEFAULT_OUTBOX_PATH', self.outbox_path)
+        outbox_path.start()
+        self.addCleanup(outbox_path.stop)
+
     @patch('raxas.common.exit_with_error')
     def test_does_not_exit_with_valid_config(self, exit_mock):
         scaling_group = ScalingGroup(self.group_config, 'group0')
@@ -186,6 +199,20 @@ class TestScalingGroup(BaseTest):
         state_mock.__get__ = Mock(return_value='Invalid!')
         self.assertEqual(scaling_group.active_servers, self._state['active'])
 
+    @patch.object(ScalingGroup, 'scaling_group')
+    def test_refresh_fetches_state_again(self, scaling_group_mock):
+        scaling_group_mock.get_state.return_value = self._state
+
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+        self.assertEqual(scaling_group.active_servers, self._state['active'])
+
+        new_state = dict(self._state, active=['123-456-789-0000', '123-456-789-0001'])
+        scaling_group_mock.get_state.return_value = new_state
+        scaling_group.refresh()
+
+        self.assertEqual(scaling_group.active_servers, new_state['active'])
+        self.assertEqual(2, scaling_group_mock.get_state.call_count)
+
     @patch.object(ScalingGroup, 'scaling_group')
     def test_launch_config_returned_correctly(self, scaling_group_mock):
         fake_launch_config = {'fake': 'launch_config'}
@@ -234,27 +261,90 @@ class TestScalingGroup(BaseTest):
         scaling_group = ScalingGroup(self.group_config, 'group0')
 
         self.assertEqual(NodeStatus.Slave, scaling_group.is_master)
+        self.write_cache_mock.assert_called_once_with(
+            '.raxas-masters.cache', 'group0', {'masters': [78910, 434987], 'checked': ANY})
 
-    @patch('requests.post')
-    def test_webhook_call_status_200(self, post_mock):
-        post_mock.return_value.status_code = 200
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call(self, dispatch_mock):
+        dispatch_mock.return_value = {'postup1': 200}
+        self.group_config['webhook_options'] = {'outbox': False}
         scaling_group = ScalingGroup(self.group_config, 'group0')
 
-        scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post)
-        self.assertEqual(post_mock.call_count, 1)
+        self.assertEqual({'postup1': 200},
+                         scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post))
+        urls, _, options = dispatch_mock.call_args[0]
+        self.assertEqual(['postup1'], urls)
+        self.assertIsNone(dispatch_mock.call_args[1]['deadline'].remaining())
 
-    @patch('raxas.common.get_logger')
-    @patch('requests.post')
-    def test_webhook_call_request_exception(self, post_mock, get_logger_mock):
-        logger_mock = MagicMock(autospec=True)
-        get_logger_mock.return_value = logger_mock
-        post_mock.return_value.status_code = 500
-        post_mock.side_effect = requests.exceptions.RequestException
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call_pre_deadline(self, dispatch_mock):
+        self.group_config['webhook_options'] = {'pre_deadline': 5}
         scaling_group = ScalingGroup(self.group_config, 'group0')
 
-        scaling_group.execute_webhook(ScaleDirection.Down, HookType.Pre)
-        self.assertEqual(post_mock.call_count, 2)
-        self.assertEqual(logger_mock.error.call_count, 2)
+        scaling_group.execute_webhook(ScaleDirection.Down, HookType.Pre, timeout=50)
+        self.assertLessEqual(dispatch_mock.call_args[1]['deadline'].remaining(), 5)
+
+        scaling_group.execute_webhook(ScaleDirection.Down, HookType.Pre, timeout=2)
+        self.assertLessEqual(dispatch_mock.call_args[1]['deadline'].remaining(), 2)
+
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call_no_time_left(self, dispatch_mock):
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+
+        self.assertEqual({'predwn1': None, 'predwn2': None},
+                         scaling_group.execute_webhook(ScaleDirection.Down,
+                                                       HookType.Pre, timeout=0))
+        self.assertFalse(dispatch_mock.called)
+
+    @patch('raxas.webhooks.dispatch_async')
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call_async_post(self, dispatch_mock, dispatch_async_mock):
+        self.group_config['webhook_options'] = {'async_post': True, 'outbox': False}
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+
+        self.assertIsNone(scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post))
+        self.assertEqual(['postup1'], dispatch_async_mock.call_args[0][0])
+        self.assertFalse(dispatch_mock.called)
+
+        scaling_group.execute_webhook(ScaleDirection.Up, HookType.Pre)
+        self.assertTrue(dispatch_mock.called)
+
+    @patch('raxas.outbox.drain')
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call_post_outbox(self, dispatch_mock, drain_mock):
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+
+        self.assertIsNone(scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post,
+                                                        timeout=10))
+        self.assertFalse(dispatch_mock.called)
+        webhook_outbox = drain_mock.call_args[0][0]
+        self.assertEqual(self.outbox_path, webhook_outbox.path)
+        self.assertEqual(['postup1'], [row[1] for row in webhook_outbox.claim(10)])
+
+        # no time left, the next run sends them
+        drain_mock.reset_mock()
+        scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post, timeout=0)
+        self.assertFalse(drain_mock.called)
+
+    @patch('raxas.outbox.drain_async')
+    def test_webhook_call_post_outbox_async(self, drain_async_mock):
+        self.group_config['webhook_options'] = {'async_post': True}
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+
+        self.assertIsNone(scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post))
+        [(webhook_outbox, _)] = drain_async_mock.call_args[0][0]
+        self.assertEqual(self.outbox_path, webhook_outbox.path)
+
+    @patch('raxas.webhooks.dispatch')
+    def test_webhook_call_post_outbox_error(self, dispatch_mock):
+        # a file where the outbox directory should be
+        open(self.outbox_path, 'w').close()
+        self.group_config['webhook_options'] = {
+            'outbox': os.path.join(self.outbox_path, 'webhooks.db')}
+        scaling_group = ScalingGroup(self.group_config, 'group0')
+
+        scaling_group.execute_webhook(ScaleDirection.Up, HookType.Post)
+        self.assertEqual(['postup1'], dispatch_mock.call_args[0][0])
 
     @patch.object(ScalingGroup, 'active_servers')
     def test_execute_policy_one_active(self, active_servers_mock):
@@ -308,3 +398,67 @@ class TestScalingGroup(BaseTest):
         scaling_group = ScalingGroup(self.group_config, 'group0')
         self.assertIsNone(scaling_group.get_group_value('fakeKey'))
         self.assertEqual(1, logger_mock.error.call_count)
+
+    def lease_group(self):
+        lease_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lease_dir)
+        config = dict(self.group_config,
+                      lease={'backend': 'sqlite', 'path': os.path.join(lease_dir, 'leases.db')})
+        return ScalingGroup(config, 'group0')
+
+    @patch.object(ScalingGroup, 'active_servers')
+    @patch('raxas.common.get_machine_uuid')
+    def test_is_master_lease_single_leader(self, get_machine_uuid_mock, active_servers_mock):
+        active_servers_mock.__get__ = Mock(return_value=['node1', 'node2', 'node3'])
+        first = self.lease_group()
+        second = ScalingGroup(first._config, 'group0')
+
+        get_machine_uuid_mock.return_value = 'node2'
+        self.assertEqual(NodeStatus.Master, first.is_master)
+        get_machine_uuid_mock.return_value = 'node1'
+        self.assertEqual(NodeStatus.Slave, second.is_master)
+        self.write_cache_mock.assert_called_with(
+            '.raxas-masters.cache', 'group0',
+            {'masters': ['node2'], 'checked': ANY, 'expires': ANY})
+
+        self.assertTrue(first.holds_lease())
+        first.release_lease()
+        self.assertEqual(NodeStatus.Master, second.is_master)
+
+    @patch.object(ScalingGroup, 'active_servers')
+    @patch('raxas.common.get_machine_uuid', return_value='node4')
+    def test_is_master_lease_inactive_node(self, get_machine_uuid_mock, active_servers_mock):
+        active_servers_mock.__get__ = Mock(return_value=['node1', 'node2'])
+        scaling_group = self.lease_group()
+
+        self.assertEqual(NodeStatus.Slave, scaling_group.is_master)
+        self.assertIsNone(scaling_group.lease_backend.get(scaling_group.group_uuid))
+
+    @patch.object(ScalingGroup, 'active_servers')
+    @patch('raxas.common.get_machine_uuid', return_value='node1')
+    def test_is_master_lease_backend_error(self, get_machine_uuid_mock, active_servers_mock):
+        active_servers_mock.__get__ = Mock(return_value=['node1', 'node2'])
+        config = dict(self.group_config, lease={'backend': 'file', 'path': '/nonexistent/leases'})
+        scaling_group = ScalingGroup(config, 'group0')
+
+        self.assertEqual(NodeStatus.Unknown, scaling_group.is_master)
+
+    @patch('pyrax.autoscale')
+    @patch.object(ScalingGroup, 'active_servers')
+    @patch('raxas.common.get_machine_uuid', return_value='node1')
+    def test_execute_policy_lease_lost(self, get_machine_uuid_mock, active_servers_mock,
+                                       autoscale_mock):
+        fake_scaling_group = MagicMock(spec=FakeScalingGroup)
+        autoscale_mock.get.return_value = fake_scaling_group
+        active_servers_mock.__get__ = Mock(return_value=['node1', 'node2'])
+        scaling_group = self.lease_group()
+        self.assertEqual(NodeStatus.Master, scaling_group.is_master)
+
+        # another node took over after the lease expired
+        scaling_group.lease_backend.update(
+            scaling_group.group_uuid,
+            lambda current: current._replace(holder='node2', token=current.token + 1))
+
+        self.assertFalse(scaling_group.holds_lease())
+        self.assertEqual(ScaleEvent.NoAction, scaling_group.execute_policy(ScaleDirection.Up))
+        self.assertFalse(fake_scaling_group.get_policy.called)
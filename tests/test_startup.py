@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+import unittest2
+
+# modules which are too slow to import before they are needed
+HEAVY_MODULES = ['pyrax', 'netifaces', 'requests', 'pkg_resources', 'stevedore']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StartupTest(unittest2.TestCase):
+    def imported_modules(self, module):
+        """Import module in a new interpreter and return the heavy modules
+        it pulled in, along with the logging handlers it installed."""
+        code = ('import json, logging, sys; import %s; '
+                'print(json.dumps([[m for m in %r if m in sys.modules], '
+                'len(logging.root.handlers)]))' % (module, HEAVY_MODULES))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=ROOT, env=env)
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def test_autoscale_import(self):
+        self.assertEqual([[], 0], self.imported_modules('raxas.autoscale'))
+
+    def test_autoscale_config_import(self):
+        self.assertEqual([[], 0], self.imported_modules('raxas.autoscale_config'))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# this file is part of 'RAX-AutoScaler'
+#
+# Copyright 2014 Rackspace US, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import requests.exceptions
+import unittest2
+
+from mock import MagicMock, patch
+
+from raxas import common
+from raxas import webhooks
+
+
+class SessionTest(unittest2.TestCase):
+    def test_get_session_is_shared(self):
+        webhooks._session = None
+        self.addCleanup(setattr, webhooks, '_session', None)
+
+        self.assertIs(webhooks.get_session(), webhooks.get_session())
+
+
+class WebhooksTest(unittest2.TestCase):
+    def setUp(self):
+        self.options = webhooks.get_options({'retries': 2, 'backoff': 0.01})
+
+        patcher = patch('raxas.webhooks.get_session')
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.session.post.return_value.status_code = 200
+
+    def test_get_options(self):
+        self.assertEqual(webhooks.DEFAULT_OPTIONS, webhooks.get_options(None))
+        self.assertEqual(3, webhooks.get_options({'retries': 3})['retries'])
+
+    def test_get_hooks(self):
+        hooks = webhooks.get_hooks(['url1', {'url': 'url2', 'read_timeout': 1},
+                                    {'read_timeout': 1}], self.options)
+
+        self.assertEqual(['url1', 'url2'], [url for url, _ in hooks])
+        self.assertEqual(10, hooks[0][1]['read_timeout'])
+        self.assertEqual(1, hooks[1][1]['read_timeout'])
+
+    def test_post(self):
+        self.assertEqual(200, webhooks.post('url', 'data', self.options))
+        self.session.post.assert_called_once_with('url', json='data', timeout=(5, 10))
+
+    def test_post_timeouts_limited_by_deadline(self):
+        webhooks.post('url', 'data', self.options, deadline=common.Deadline(2))
+
+        connect_timeout, read_timeout = self.session.post.call_args[1]['timeout']
+        self.assertLessEqual(connect_timeout, 2)
+        self.assertLessEqual(read_timeout, 2)
+
+    def test_post_retries_server_errors(self):
+        self.session.post.return_value.status_code = 503
+
+        self.assertEqual(503, webhooks.post('url', 'data', self.options))
+        self.assertEqual(3, self.session.post.call_count)
+
+    def test_post_retries_request_exceptions(self):
+        response = MagicMock(status_code=200)
+        self.session.post.side_effect = [requests.exceptions.ConnectionError, response]
+
+        self.assertEqual(200, webhooks.post('url', 'data', self.options))
+        self.assertEqual(2, self.session.post.call_count)
+
+    def test_post_does_not_retry_client_errors(self):
+        self.session.post.return_value.status_code = 404
+
+        self.assertEqual(404, webhooks.post('url', 'data', self.options))
+        self.assertEqual(1, self.session.post.call_count)
+
+    def test_post_backoff_stops_at_deadline(self):
+        self.session.post.side_effect = requests.exceptions.Timeout
+        options = webhooks.get_options({'retries': 5, 'backoff': 10})
+
+        started = time.time()
+        self.assertIsNone(webhooks.post('url', 'data', options,
+                                        deadline=common.Deadline(5)))
+        self.assertEqual(1, self.session.post.call_count)
+        self.assertLess(time.time() - started, 1)
+
+    def test_dispatch_is_concurrent(self):
+        options = webhooks.get_options({'max_workers': 2, 'retries': 0})
+        both_sent = threading.Event()
+        calls = []
+
+        def post(url, **kwargs):
+            calls.append(url)
+            if len(calls) == 2:
+                both_sent.set()
+            both_sent.wait(1)
+            return MagicMock(status_code=200 if both_sent.is_set() else 500)
+
+        self.session.post.side_effect = post
+
+        self.assertEqual({'url1': 200, 'url2': 200},
+                         webhooks.dispatch(['url1', 'url2'], 'data', options))
+
+    def test_dispatch_stops_waiting_at_deadline(self):
+        def slow_post(url, **kwargs):
+            time.sleep(0.5)
+            return MagicMock(status_code=200)
+
+        self.session.post.side_effect = slow_post
+
+        started = time.time()
+        self.assertEqual({'url1': None}, webhooks.dispatch(
+            ['url1'], 'data', self.options, deadline=common.Deadline(0.1)))
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_dispatch_async(self):
+        thread = webhooks.dispatch_async(['url1', 'url2'], 'data', self.options)
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(thread.daemon)
+        self.assertEqual(2, self.session.post.call_count)